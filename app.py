@@ -2,6 +2,7 @@
 # app.py (Multi-user version with Groq API, Database, and Authentication)
 from fastapi import FastAPI, Depends, HTTPException, status, Request
 from pydantic import BaseModel
+from typing import Literal
 import requests
 
 # Use database instead of JSON files
@@ -9,18 +10,30 @@ from database import (
     DatabaseBackedMemory as Memory,
     DatabaseBackedKnowledgeStore as KnowledgeStore,
     init_db,
+    knowledge_search_cache,
+    memory_compaction_candidates,
+    memory_writer,
+    session_writer,
+    load_session,
+    MEMORY_TOKEN_BUDGET,
+    get_app_state,
+    set_app_state,
     User,
     SessionLocal
 )
 from tools import get_time, get_time_human_short
+from cache import VersionedCache
+from session_store import SessionStore
+from prompt_budget import TokenBudget, estimate_tokens, truncate_tokens
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, StreamingResponse, HTMLResponse
+import asyncio
 import os
 import sys
 import subprocess
 import threading
 import time
-from groq import Groq
+from groq import AsyncGroq
 
 # Authentication imports
 from auth import (
@@ -41,8 +54,155 @@ from sqlalchemy.orm import Session
 init_db()
 
 # Load knowledge seed on startup
+def _seed_entries(seed_data: dict) -> list[dict]:
+    """Turn knowledge_seed.json into knowledge entries, each with a stable seed_key"""
+    entries = []
+    
+    def add(seed_key, name, description, keywords):
+        entries.append({'seed_key': seed_key, 'name': name, 'description': description, 'keywords': list(keywords)})
+    
+    # Load warehouse overview
+    if 'warehouse_overview' in seed_data:
+        overview = seed_data['warehouse_overview']
+        add('warehouse_overview',
+            overview.get('name', 'Berry Hill ITAD Warehouse'),
+            f"Location: {overview.get('location', '')}. Mission: {overview.get('mission', '')}",
+            ['warehouse', 'overview', 'location', 'mission'])
+    
+    # Load workflow items
+    if 'workflow' in seed_data:
+        for i, item in enumerate(seed_data['workflow']):
+            try:
+                add(f"workflow:{item.get('name') or i}",
+                    item.get('name', ''),
+                    item.get('description', ''),
+                    item.get('keywords', []))
+            except Exception as e:
+                logger.warning(f"Failed to load workflow item {item.get('name')}: {e}")
+    
+    # Load erasure procedures (NEW - CRITICAL FOR DEVICE-SPECIFIC KNOWLEDGE)
+    if 'erasure_procedures' in seed_data:
+        procs = seed_data['erasure_procedures']
+        for device_type, procedure in procs.items():
+            try:
+                name = procedure.get('name', device_type)
+                method = procedure.get('method', '')
+                process = procedure.get('process', [])
+                process_text = '\n'.join(process) if isinstance(process, list) else str(process)
+                
+                add(f"erasure_procedures:{device_type}",
+                    f"Erasure: {name}",
+                    f"Method: {method}\n\nProcedure:\n{process_text}",
+                    procedure.get('keywords', []) + [device_type, 'erasure', 'procedure'])
+            except Exception as e:
+                logger.warning(f"Failed to load erasure procedure {device_type}: {e}")
+    
+    # Load diagnostics and troubleshooting (NEW)
+    if 'diagnostics_and_troubleshooting' in seed_data:
+        diags = seed_data['diagnostics_and_troubleshooting']
+        for issue_key, issue_data in diags.items():
+            try:
+                issue_name = issue_data.get('issue', issue_key)
+                solutions = issue_data.get('solutions', [])
+                solutions_text = '\n'.join(solutions) if isinstance(solutions, list) else str(solutions)
+                
+                add(f"diagnostics_and_troubleshooting:{issue_key}",
+                    f"Troubleshooting: {issue_name}",
+                    f"Problem: {issue_name}\n\nSolutions:\n{solutions_text}",
+                    issue_data.get('keywords', []) + ['troubleshooting', 'diagnostic', 'issue'])
+            except Exception as e:
+                logger.warning(f"Failed to load diagnostic {issue_key}: {e}")
+    
+    # Load general device knowledge (NEW)
+    if 'general_device_knowledge' in seed_data:
+        gen_knowledge = seed_data['general_device_knowledge']
+        
+        # Load BIOS access keys
+        if 'bios_access_keys' in gen_knowledge:
+            bios_keys = gen_knowledge['bios_access_keys']
+            description = "BIOS Access Keys by Manufacturer:\n\n"
+            for mfr, keys in bios_keys.items():
+                if isinstance(keys, dict) and mfr != 'notes':
+                    description += f"{mfr.upper()}: BIOS={keys.get('bios_entry', 'N/A')}, Boot={keys.get('boot_menu', 'N/A')}\n"
+            
+            add('general_device_knowledge:bios_access_keys',
+                "BIOS Access Keys",
+                description,
+                ['bios', 'keys', 'boot', 'menu', 'access', 'dell', 'hp', 'lenovo', 'acer', 'asus'])
+        
+        # Load BIOS password recovery
+        if 'bios_password_recovery' in gen_knowledge:
+            recovery = gen_knowledge['bios_password_recovery']
+            for recovery_type, details in recovery.items():
+                try:
+                    add(f"bios_password_recovery:{recovery_type}",
+                        f"BIOS Recovery: {recovery_type}",
+                        details.get('description', '') + '\n\nProcess:\n' + '\n'.join(details.get('process', [])),
+                        details.get('keywords', []) + ['bios', 'password', 'recovery'])
+                except Exception as e:
+                    logger.warning(f"Failed to load BIOS recovery {recovery_type}: {e}")
+    
+    # Load QA grading info
+    if 'qa_grading' in seed_data:
+        qa = seed_data['qa_grading']
+        process_text = '\n'.join(qa.get('process', [])) if 'process' in qa else ''
+        add('qa_grading',
+            "QA Grading",
+            f"Grading Scale: {qa.get('grading_scale', 'A-D')}\n\nProcess:\n{process_text}",
+            ['qa', 'grading', 'quality', 'assessment'])
+    
+    # Load quarantine rules
+    if 'quarantine_rules' in seed_data:
+        quar = seed_data['quarantine_rules']
+        triggers = '\n'.join(quar.get('triggers', [])) if 'triggers' in quar else ''
+        process_text = '\n'.join(quar.get('process', [])) if 'process' in quar else ''
+        add('quarantine_rules',
+            "Quarantine Rules",
+            f"Triggers:\n{triggers}\n\nProcess:\n{process_text}",
+            ['quarantine', 'locked', 'password', 'mdm', 'firmware'])
+    
+    # Load common issues
+    if 'common_issues' in seed_data:
+        issues = seed_data['common_issues']
+        for issue_key, issue_data in issues.items():
+            try:
+                issue_name = issue_data.get('issue', issue_key)
+                resolution = issue_data.get('resolution', issue_data.get('solutions', ''))
+                add(f"common_issues:{issue_key}",
+                    f"Known Issue: {issue_name}",
+                    f"{issue_name}\n\nResolution: {resolution}",
+                    issue_data.get('keywords', []) + ['issue', 'known-issue'])
+            except Exception as e:
+                logger.warning(f"Failed to load common issue {issue_key}: {e}")
+    
+    # Load additional resources
+    if 'additional_resources' in seed_data:
+        resources = seed_data['additional_resources']
+        for resource_key, resource_data in resources.items():
+            try:
+                location = resource_data.get('location', '')
+                description = resource_data.get('description', '')
+                add(f"additional_resources:{resource_key}",
+                    f"Resource: {resource_key}",
+                    f"Location: {location}\n\nDescription: {description}",
+                    ['resource', resource_key])
+            except Exception as e:
+                logger.warning(f"Failed to load resource {resource_key}: {e}")
+    
+    # seed keys must be unique or upserts would fight over the same row
+    seen: dict[str, int] = {}
+    for entry in entries:
+        key = entry['seed_key']
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > 1:
+            entry['seed_key'] = f"{key}#{seen[key]}"
+    return entries
+
+
 def load_knowledge_seed():
-    """Load warehouse knowledge from seed file on app startup."""
+    """Load warehouse knowledge from seed file on app startup.
+    Idempotent: only new or changed seed entries are written, and nothing at all if the seed is unchanged.
+    """
     seed_path = os.path.join(os.path.dirname(__file__), 'knowledge_seed.json')
     if not os.path.exists(seed_path):
         return
@@ -52,153 +212,16 @@ def load_knowledge_seed():
         with open(seed_path, 'r', encoding='utf-8') as f:
             seed_data = json.load(f)
         
-        # Create knowledge store for default user (ID=1)
-        from database import SessionLocal
-        db = SessionLocal()
-        try:
-            knowledge_store = KnowledgeStore(user_id=1)
-            
-            # Load warehouse overview
-            if 'warehouse_overview' in seed_data:
-                overview = seed_data['warehouse_overview']
-                knowledge_store.add_knowledge(
-                    name=overview.get('name', 'Berry Hill ITAD Warehouse'),
-                    description=f"Location: {overview.get('location', '')}. Mission: {overview.get('mission', '')}",
-                    keywords=['warehouse', 'overview', 'location', 'mission']
-                )
-            
-            # Load workflow items
-            if 'workflow' in seed_data:
-                for item in seed_data['workflow']:
-                    try:
-                        knowledge_store.add_knowledge(
-                            name=item.get('name', ''),
-                            description=item.get('description', ''),
-                            keywords=item.get('keywords', [])
-                        )
-                    except Exception as e:
-                        logger.warning(f"Failed to load workflow item {item.get('name')}: {e}")
-            
-            # Load erasure procedures (NEW - CRITICAL FOR DEVICE-SPECIFIC KNOWLEDGE)
-            if 'erasure_procedures' in seed_data:
-                procs = seed_data['erasure_procedures']
-                for device_type, procedure in procs.items():
-                    try:
-                        name = procedure.get('name', device_type)
-                        method = procedure.get('method', '')
-                        process = procedure.get('process', [])
-                        process_text = '\n'.join(process) if isinstance(process, list) else str(process)
-                        
-                        knowledge_store.add_knowledge(
-                            name=f"Erasure: {name}",
-                            description=f"Method: {method}\n\nProcedure:\n{process_text}",
-                            keywords=procedure.get('keywords', []) + [device_type, 'erasure', 'procedure']
-                        )
-                    except Exception as e:
-                        logger.warning(f"Failed to load erasure procedure {device_type}: {e}")
-            
-            # Load diagnostics and troubleshooting (NEW)
-            if 'diagnostics_and_troubleshooting' in seed_data:
-                diags = seed_data['diagnostics_and_troubleshooting']
-                for issue_key, issue_data in diags.items():
-                    try:
-                        issue_name = issue_data.get('issue', issue_key)
-                        solutions = issue_data.get('solutions', [])
-                        solutions_text = '\n'.join(solutions) if isinstance(solutions, list) else str(solutions)
-                        
-                        knowledge_store.add_knowledge(
-                            name=f"Troubleshooting: {issue_name}",
-                            description=f"Problem: {issue_name}\n\nSolutions:\n{solutions_text}",
-                            keywords=issue_data.get('keywords', []) + ['troubleshooting', 'diagnostic', 'issue']
-                        )
-                    except Exception as e:
-                        logger.warning(f"Failed to load diagnostic {issue_key}: {e}")
-            
-            # Load general device knowledge (NEW)
-            if 'general_device_knowledge' in seed_data:
-                gen_knowledge = seed_data['general_device_knowledge']
-                
-                # Load BIOS access keys
-                if 'bios_access_keys' in gen_knowledge:
-                    bios_keys = gen_knowledge['bios_access_keys']
-                    description = "BIOS Access Keys by Manufacturer:\n\n"
-                    for mfr, keys in bios_keys.items():
-                        if isinstance(keys, dict) and mfr != 'notes':
-                            description += f"{mfr.upper()}: BIOS={keys.get('bios_entry', 'N/A')}, Boot={keys.get('boot_menu', 'N/A')}\n"
-                    
-                    knowledge_store.add_knowledge(
-                        name="BIOS Access Keys",
-                        description=description,
-                        keywords=['bios', 'keys', 'boot', 'menu', 'access', 'dell', 'hp', 'lenovo', 'acer', 'asus']
-                    )
-                
-                # Load BIOS password recovery
-                if 'bios_password_recovery' in gen_knowledge:
-                    recovery = gen_knowledge['bios_password_recovery']
-                    for recovery_type, details in recovery.items():
-                        try:
-                            knowledge_store.add_knowledge(
-                                name=f"BIOS Recovery: {recovery_type}",
-                                description=details.get('description', '') + '\n\nProcess:\n' + '\n'.join(details.get('process', [])),
-                                keywords=details.get('keywords', []) + ['bios', 'password', 'recovery']
-                            )
-                        except Exception as e:
-                            logger.warning(f"Failed to load BIOS recovery {recovery_type}: {e}")
-            
-            # Load QA grading info
-            if 'qa_grading' in seed_data:
-                qa = seed_data['qa_grading']
-                process_text = '\n'.join(qa.get('process', [])) if 'process' in qa else ''
-                knowledge_store.add_knowledge(
-                    name="QA Grading",
-                    description=f"Grading Scale: {qa.get('grading_scale', 'A-D')}\n\nProcess:\n{process_text}",
-                    keywords=['qa', 'grading', 'quality', 'assessment']
-                )
-            
-            # Load quarantine rules
-            if 'quarantine_rules' in seed_data:
-                quar = seed_data['quarantine_rules']
-                triggers = '\n'.join(quar.get('triggers', [])) if 'triggers' in quar else ''
-                process_text = '\n'.join(quar.get('process', [])) if 'process' in quar else ''
-                knowledge_store.add_knowledge(
-                    name="Quarantine Rules",
-                    description=f"Triggers:\n{triggers}\n\nProcess:\n{process_text}",
-                    keywords=['quarantine', 'locked', 'password', 'mdm', 'firmware']
-                )
-            
-            # Load common issues
-            if 'common_issues' in seed_data:
-                issues = seed_data['common_issues']
-                for issue_key, issue_data in issues.items():
-                    try:
-                        issue_name = issue_data.get('issue', issue_key)
-                        resolution = issue_data.get('resolution', issue_data.get('solutions', ''))
-                        knowledge_store.add_knowledge(
-                            name=f"Known Issue: {issue_name}",
-                            description=f"{issue_name}\n\nResolution: {resolution}",
-                            keywords=issue_data.get('keywords', []) + ['issue', 'known-issue']
-                        )
-                    except Exception as e:
-                        logger.warning(f"Failed to load common issue {issue_key}: {e}")
-            
-            # Load additional resources
-            if 'additional_resources' in seed_data:
-                resources = seed_data['additional_resources']
-                for resource_key, resource_data in resources.items():
-                    try:
-                        location = resource_data.get('location', '')
-                        description = resource_data.get('description', '')
-                        knowledge_store.add_knowledge(
-                            name=f"Resource: {resource_key}",
-                            description=f"Location: {location}\n\nDescription: {description}",
-                            keywords=['resource', resource_key]
-                        )
-                    except Exception as e:
-                        logger.warning(f"Failed to load resource {resource_key}: {e}")
-            
-            logger.info("Knowledge seed loaded successfully")
-        finally:
-            db.close()
+        # Seed knowledge belongs to the default user (ID=1)
+        from database import sync_knowledge_seed
+        counts = sync_knowledge_seed(_seed_entries(seed_data), user_id=1)
+        if counts['skipped']:
+            logger.info("Knowledge seed unchanged, nothing to load")
+        else:
+            logger.info(
+                "Knowledge seed loaded: %d inserted, %d updated, %d unchanged, %d removed",
+                counts['inserted'], counts['updated'], counts['unchanged'], counts['deleted']
+            )
     except Exception as e:
         logger.error(f"Failed to load knowledge seed: {e}")
 
@@ -208,8 +231,18 @@ app = FastAPI()
 # Load knowledge seed on app startup event
 @app.on_event("startup")
 async def startup_event():
-    """Load warehouse knowledge on startup."""
+    """Load warehouse knowledge on startup and start background memory compaction."""
     load_knowledge_seed()
+    global compaction_task
+    if COMPACT_INTERVAL > 0:
+        compaction_task = asyncio.create_task(_memory_compaction_loop())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background jobs and write out anything still queued for the database."""
+    if compaction_task is not None:
+        compaction_task.cancel()
+    _stop_writers()
 
 # Enable CORS for the popup UI to work from any origin
 from fastapi.middleware.cors import CORSMiddleware
@@ -296,10 +329,32 @@ if os.path.isdir(ASSETS_DIR):
     app.mount("/assets", StaticFiles(directory=ASSETS_DIR), name="assets")
 
 # Memory and knowledge store already initialized at top of file
-# ephemeral in-memory session store: session_id -> list of {'role': 'user'|'assistant', 'text': str}
-sessions: dict[str, list[dict]] = {}
-SESSION_MAX = 10
+# conversation sessions: (user_id, session_id) -> list of {'role': 'user'|'assistant', 'text': str}
+# A bounded in-memory hot tier in front of the sessions table. Misses are loaded from the table,
+# appended turns are saved by session_writer in the background, and hot sessions are re-read
+# every GREENIE_SESSION_REVALIDATE seconds so other workers' turns show up.
+SESSION_MAX = 10  # exchanges kept per session
+sessions = SessionStore(
+    max_sessions=int(os.environ.get("GREENIE_SESSION_MAX_COUNT", "5000")),
+    max_turns=SESSION_MAX * 2,
+    idle_ttl=float(os.environ.get("GREENIE_SESSION_TTL", str(6 * 3600))),
+    max_bytes=int(float(os.environ.get("GREENIE_SESSION_MB", "32")) * 1024 * 1024),
+    loader=lambda key: load_session(*key),
+    persister=lambda key, rev, turns, summary: session_writer.submit((key[0], key[1], rev, turns, summary, time.time())),
+    revalidate=float(os.environ.get("GREENIE_SESSION_REVALIDATE", "5")),
+)
 last_prompt: str | None = None
+last_prompt_budget: dict | None = None
+last_retrieval: dict | None = None
+
+# Prompt token budget: the whole prompt, and the most each optional section may take of it.
+# Sections are filled in order (knowledge, memories, conversation) from what the fixed parts
+# (time, identity, topic and the message itself) leave.
+PROMPT_TOKEN_BUDGET = int(os.environ.get("GREENIE_PROMPT_TOKENS", "3000"))
+KNOWLEDGE_TOKEN_BUDGET = int(os.environ.get("GREENIE_KNOWLEDGE_TOKENS", "1200"))
+SESSION_TOKEN_BUDGET = int(os.environ.get("GREENIE_SESSION_TOKENS", "1200"))
+# rendered "System:" prompt block per user, valid while the user's knowledge version is unchanged
+system_block_cache = VersionedCache("system_block")
 
 @app.get("/")
 async def root():
@@ -982,6 +1037,8 @@ class ChatRequest(BaseModel):
     session_id: str | None = None  # client session id for ephemeral conversation memory
     conversation_mode: bool = True  # whether to include ephemeral session history in prompt (default ON)
     fast: bool = False  # prefer lower-latency, reduced-context responses (Fast Mode)
+    retrieval: Literal['keyword', 'semantic'] | None = None  # 'keyword' (default) or 'semantic' (local vector similarity for knowledge and memories)
+    memory_mode: Literal['recent', 'relevant'] | None = None  # 'recent' (default: last N memories) or 'relevant' (ranked against the message, within a token budget)
 
 class MemoryAddRequest(BaseModel):
     text: str
@@ -1035,8 +1092,113 @@ def model_candidates(requested: str | None = None) -> list[str]:
             out.append(m)
     return out
 
-# Initialize Groq client
-groq_client = Groq(api_key=GROQ_API_KEY) if GROQ_API_KEY else None
+# At most LLM_CONCURRENCY upstream calls run at once; the rest wait their turn without blocking the loop
+LLM_CONCURRENCY = int(os.environ.get("GREENIE_LLM_CONCURRENCY", "8"))
+TEST_LLM_DELAY = float(os.environ.get("GREENIE_TEST_LLM_DELAY", "0"))  # simulated latency of the test-mode fake
+
+
+class FakeLLMClient:
+    """Stand-in for AsyncGroq in GREENIE_TEST_MODE: same chat.completions.create interface, nothing sent.
+    A completion takes `delay` seconds and answers "Test reply: " plus the last paragraph of the
+    last message (the user's message, at the end of the prompt); streams yield fixed chunks.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        from types import SimpleNamespace
+        self.delay = delay
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, messages: list[dict], model: str, stream: bool = False, **options):
+        from types import SimpleNamespace
+        await asyncio.sleep(self.delay)
+        if stream:
+            return self._chunks()
+        last = messages[-1]["content"].rsplit("\n\n", 1)[-1] if messages else ""
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"Test reply: {last}"))])
+
+    async def _chunks(self):
+        from types import SimpleNamespace
+        for text in ("Starting stream...", "first chunk", " second chunk"):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+            await asyncio.sleep(0.01)
+
+
+# Initialize Groq client (async, so a slow completion never blocks other requests)
+if os.environ.get('GREENIE_TEST_MODE') == '1':
+    async_groq_client = FakeLLMClient(TEST_LLM_DELAY)
+else:
+    async_groq_client = AsyncGroq(api_key=GROQ_API_KEY) if GROQ_API_KEY else None
+
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+llm_status: dict = {"concurrency": LLM_CONCURRENCY, "in_flight": 0, "waiting": 0, "calls": 0, "max_in_flight": 0}
+
+GREENIE_SYSTEM_PROMPT = (
+    "You are Greenie, an IT support assistant for a warehouse equipment refurbishment operation. "
+    "Be blunt and straight-to-the-point. Tell people exactly what they need to know without fluff. "
+    "Be helpful but direct. If something won't work, say so clearly. "
+    "Reference specific procedures and tools from the knowledge base when available."
+)
+
+def _chat_messages(prompt: str) -> list[dict]:
+    """Messages for a chat completion: Greenie's instructions, then the assembled prompt"""
+    return [
+        {"role": "system", "content": GREENIE_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+stream_status: dict = {"streams": 0, "last_ttft_ms": None, "avg_ttft_ms": None, "max_ttft_ms": None, "avg_total_ms": None}
+
+def _record_stream_timing(first_token_ms: float | None, total_ms: float) -> None:
+    count = stream_status["streams"] + 1
+    stream_status["streams"] = count
+    stream_status["avg_total_ms"] = round(((stream_status["avg_total_ms"] or 0) * (count - 1) + total_ms) / count, 2)
+    if first_token_ms is not None:
+        stream_status["last_ttft_ms"] = round(first_token_ms, 2)
+        stream_status["avg_ttft_ms"] = round(((stream_status["avg_ttft_ms"] or 0) * (count - 1) + first_token_ms) / count, 2)
+        stream_status["max_ttft_ms"] = round(max(stream_status["max_ttft_ms"] or 0, first_token_ms), 2)
+
+async def _acquire_llm_slot() -> None:
+    """Wait for an LLM_CONCURRENCY slot. The call counts as waiting until it gets one,
+    or until the wait is cancelled (e.g. the client disconnected).
+    """
+    llm_status["waiting"] += 1
+    try:
+        await llm_semaphore.acquire()
+    finally:
+        llm_status["waiting"] -= 1
+    llm_status["in_flight"] += 1
+    llm_status["calls"] += 1
+    llm_status["max_in_flight"] = max(llm_status["max_in_flight"], llm_status["in_flight"])
+
+def _release_llm_slot() -> None:
+    llm_status["in_flight"] -= 1
+    llm_semaphore.release()
+
+async def _llm_stream(messages: list[dict], model: str, **options):
+    """Yield the text chunks of a streamed completion from the async client, holding one
+    LLM_CONCURRENCY slot for the whole stream.
+    """
+    await _acquire_llm_slot()
+    try:
+        if not async_groq_client:
+            raise RuntimeError("LLM service not configured")
+        stream = await async_groq_client.chat.completions.create(messages=messages, model=model, stream=True, **options)
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        _release_llm_slot()
+
+async def _llm_complete(messages: list[dict], model: str, **options) -> str:
+    """One chat completion through the async client, within the LLM_CONCURRENCY limit"""
+    await _acquire_llm_slot()
+    try:
+        if not async_groq_client:
+            raise RuntimeError("LLM service not configured")
+        chat_completion = await async_groq_client.chat.completions.create(messages=messages, model=model, **options)
+        return chat_completion.choices[0].message.content
+    finally:
+        _release_llm_slot()
 
 @app.post("/memory/add")
 async def add_memory(req: MemoryAddRequest, current_user: User | None = Depends(get_current_user_optional)):
@@ -1077,89 +1239,435 @@ async def list_knowledge(current_user: User | None = Depends(get_current_user_op
     return {"results": user_knowledge.list_all()}
 
 @app.get("/knowledge/export")
-async def export_knowledge(current_user: User | None = Depends(get_current_user_optional)):
-    """Export all knowledge and memories as JSON for backup/import."""
+async def export_knowledge(format: str = "json", since: float | None = None,
+                           current_user: User | None = Depends(get_current_user_optional)):
+    """Export all knowledge and memories for backup/import, streamed page by page.
+    format=json (default) gives the backup document; format=ndjson gives one record per line
+    ({"type": "meta"|"memory"|"knowledge"|"end", ...}) that /knowledge/import accepts as-is.
+    `since` (unix time) exports only what was added after it, for incremental backups.
+    """
+    import json
     user_id = current_user.id if current_user else 1
     user_memory = Memory(user_id=user_id)
     user_knowledge = KnowledgeStore(user_id=user_id)
+    header = {"export_date": time.time(), "user_id": user_id}
+    if since is not None:
+        header["since"] = since
     
-    try:
-        memories = user_memory.get_recent(1000)  # Get all memories
-        knowledge = user_knowledge.list_all()
+    def ndjson():
+        memory_writer.flush()
+        counts = {"memories": 0, "knowledge": 0}
+        yield json.dumps({"type": "meta", **header}) + "\n"
+        try:
+            for mem in user_memory.iter_all(since=since):
+                counts["memories"] += 1
+                yield json.dumps({"type": "memory", **mem}) + "\n"
+            for item in user_knowledge.iter_all(since=since):
+                counts["knowledge"] += 1
+                yield json.dumps({"type": "knowledge", **item}) + "\n"
+        except Exception as e:
+            logger.exception(f"Export failed: {e}")
+            yield json.dumps({"type": "error", "error": f"Export failed: {str(e)}"}) + "\n"
+            return
+        # lets a client tell a complete export from a dropped connection
+        yield json.dumps({"type": "end", **counts}) + "\n"
+    
+    def document():
+        memory_writer.flush()
+        yield json.dumps(header)[:-1] + ', "memories": ['
+        try:
+            # newest first, as plain strings, like the original export
+            for i, mem in enumerate(user_memory.iter_all(since=since, newest_first=True)):
+                yield ("," if i else "") + json.dumps(mem["text"])
+            yield '], "knowledge": ['
+            for i, item in enumerate(user_knowledge.iter_all(since=since)):
+                item.pop("created_at", None)
+                yield ("," if i else "") + json.dumps(item)
+            yield "]}"
+        except Exception as e:
+            # headers are already sent; the truncated document will not parse on the client
+            logger.exception(f"Export failed: {e}")
+    
+    if format == "ndjson":
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    return StreamingResponse(document(), media_type="application/json")
+
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_ERRORS = 100  # per-item errors echoed back; the rest are only counted
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl', 'application/x-jsonlines')
+# progress of the latest import per user, polled via /knowledge/import/progress
+import_progress: dict[int, dict] = {}
+
+
+def _import_memory(record) -> tuple[str, float | None]:
+    """Validate an imported memory: a plain string or {"text": ..., "timestamp": ...}"""
+    text, ts = (record, None) if isinstance(record, str) else (
+        (record.get('text'), record.get('timestamp')) if isinstance(record, dict) else (None, None)
+    )
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("memory must be a non-empty string or an object with 'text'")
+    if ts is not None and (isinstance(ts, bool) or not isinstance(ts, (int, float))):
+        raise ValueError("memory timestamp must be a number")
+    return text, ts
+
+
+def _import_knowledge(record) -> dict:
+    """Validate an imported knowledge entry"""
+    if not isinstance(record, dict):
+        raise ValueError("knowledge entry must be an object")
+    name, description = record.get('name', ''), record.get('description', '')
+    keywords = record.get('keywords') or []
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("knowledge entry needs a non-empty 'name'")
+    if not isinstance(description, str):
+        raise ValueError("knowledge 'description' must be a string")
+    if not isinstance(keywords, list) or not all(isinstance(kw, str) for kw in keywords):
+        raise ValueError("knowledge 'keywords' must be a list of strings")
+    return {'name': name, 'description': description, 'keywords': keywords}
+
+
+async def _iter_import_records(request: Request):
+    """Yield (kind, position, record) from a JSON backup document or an NDJSON stream.
+    NDJSON lines are {"type": "memory"|"knowledge", ...}; other types (e.g. the export header) are skipped.
+    Lines that are not valid JSON are yielded as ('error', line, message).
+    """
+    content_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    if content_type in NDJSON_TYPES or request.query_params.get('format') == 'ndjson':
+        import json
+        buffer = b''
+        line_no = 0
         
-        export_data = {
-            "export_date": time.time(),
-            "user_id": user_id,
-            "memories": memories,
-            "knowledge": knowledge
-        }
-        return export_data
-    except Exception as e:
-        return {"error": f"Export failed: {str(e)}"}
+        def parse(line: bytes):
+            record = json.loads(line)
+            kind = record.get('type') if isinstance(record, dict) else None
+            return kind, record
+        
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                line_no += 1
+                if not line.strip():
+                    continue
+                try:
+                    kind, record = parse(line)
+                except ValueError as e:
+                    yield 'error', line_no, f"invalid JSON: {e}"
+                    continue
+                yield kind, line_no, record
+        if buffer.strip():
+            line_no += 1
+            try:
+                kind, record = parse(buffer)
+            except ValueError as e:
+                yield 'error', line_no, f"invalid JSON: {e}"
+            else:
+                yield kind, line_no, record
+        return
+    
+    data = await request.json()
+    if not isinstance(data, dict):
+        raise ValueError("backup must be a JSON object with 'memories' and/or 'knowledge'")
+    for kind, key in (('memory', 'memories'), ('knowledge', 'knowledge')):
+        if isinstance(data.get(key), list):
+            for i, record in enumerate(data[key]):
+                yield kind, i, record
+
 
 @app.post("/knowledge/import")
-async def import_knowledge(data: dict, current_user: User | None = Depends(get_current_user_optional)):
-    """Import knowledge and memories from exported backup."""
+async def import_knowledge(request: Request, current_user: User | None = Depends(get_current_user_optional)):
+    """Import knowledge and memories from an exported backup.
+    Accepts the JSON export document or an NDJSON stream (Content-Type: application/x-ndjson).
+    Items are validated one by one and inserted in batches; bad items are reported, not fatal.
+    """
+    from starlette.concurrency import run_in_threadpool
     user_id = current_user.id if current_user else 1
     user_memory = Memory(user_id=user_id)
     user_knowledge = KnowledgeStore(user_id=user_id)
+    imported_count = {"memories": 0, "knowledge": 0}
+    errors: list[dict] = []
+    progress = import_progress[user_id] = {
+        "status": "running", "started": time.time(), "imported": imported_count, "failed": 0
+    }
+    pending = {"memory": [], "knowledge": []}
+    writers = {
+        # memories are trimmed once after the last batch, not per batch
+        "memory": (lambda entries: user_memory.add_memories_bulk(entries, trim=False), "memories"),
+        "knowledge": (user_knowledge.add_knowledge_bulk, "knowledge"),
+    }
     
-    try:
-        imported_count = {"memories": 0, "knowledge": 0}
-        
-        # Import memories
-        if "memories" in data and isinstance(data["memories"], list):
-            for mem in data["memories"]:
-                try:
-                    user_memory.add_memory(mem)
-                    imported_count["memories"] += 1
-                except Exception as e:
-                    logger.warning(f"Failed to import memory: {e}")
-        
-        # Import knowledge
-        if "knowledge" in data and isinstance(data["knowledge"], list):
-            for item in data["knowledge"]:
+    def fail(kind, position, message):
+        progress["failed"] += 1
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append({"type": kind, "item": position, "error": message})
+    
+    async def flush(kind):
+        batch, pending[kind] = pending[kind], []
+        if not batch:
+            return
+        write, counter = writers[kind]
+        try:
+            imported_count[counter] += await run_in_threadpool(write, [value for _, value in batch])
+        except Exception as e:
+            # find the offending rows without losing the rest of the batch
+            logger.warning(f"Batch import of {len(batch)} {counter} failed, retrying one by one: {e}")
+            for position, value in batch:
                 try:
-                    user_knowledge.add_knowledge(
-                        name=item.get("name", ""),
-                        description=item.get("description", ""),
-                        keywords=item.get("keywords", [])
-                    )
-                    imported_count["knowledge"] += 1
-                except Exception as e:
-                    logger.warning(f"Failed to import knowledge item: {e}")
-        
-        return {"ok": True, "imported": imported_count}
+                    imported_count[counter] += await run_in_threadpool(write, [value])
+                except Exception as item_error:
+                    fail(kind, position, str(item_error))
+        logger.info(f"Import for user {user_id}: {imported_count['memories']} memories, "
+                    f"{imported_count['knowledge']} knowledge, {progress['failed']} failed")
+    
+    try:
+        async for kind, position, record in _iter_import_records(request):
+            if kind == 'error':
+                fail(None, position, record)
+                continue
+            if kind not in pending:
+                if kind is None:
+                    fail(None, position, "record has no 'type'")
+                continue
+            try:
+                value = _import_memory(record) if kind == 'memory' else _import_knowledge(record)
+            except ValueError as e:
+                fail(kind, position, str(e))
+                continue
+            pending[kind].append((position, value))
+            if len(pending[kind]) >= IMPORT_BATCH_SIZE:
+                await flush(kind)
+        await flush("memory")
+        await flush("knowledge")
+        progress["status"] = "done"
+        return {
+            "ok": True,
+            "imported": imported_count,
+            "failed": progress["failed"],
+            "errors": errors,
+            "errors_truncated": progress["failed"] > len(errors),
+        }
     except Exception as e:
+        progress["status"] = "failed"
         logger.exception(f"Import failed: {e}")
-        return {"error": f"Import failed: {str(e)}"}
+        return {"error": f"Import failed: {str(e)}", "imported": imported_count}
+    finally:
+        if imported_count["memories"]:
+            # one trim for the whole import (also when it stopped part-way)
+            try:
+                await run_in_threadpool(user_memory.trim)
+            except Exception as e:
+                logger.warning(f"Trim after import failed: {e}")
+        progress["finished"] = time.time()
+
+@app.get("/knowledge/import/progress")
+async def import_status(current_user: User | None = Depends(get_current_user_optional)):
+    """Progress of the current (or last) import for this user"""
+    user_id = current_user.id if current_user else 1
+    return import_progress.get(user_id) or {"status": "idle"}
+
+async def _summarize_text(content: str, model: str | None = None, instruction: str = "Summarize the following text:") -> str:
+    """Summarize `content` with the LLM; raises RuntimeError when no LLM is configured.
+    In GREENIE_TEST_MODE a deterministic fake summary is returned instead.
+    """
+    summary = await _llm_complete(
+        messages=[
+            {
+                "role": "user",
+                "content": f"{instruction}\n\n{content}"
+            }
+        ],
+        model=model or DEFAULT_MODEL,
+        temperature=0.5,
+        max_tokens=512,
+        timeout=60
+    )
+    if os.environ.get('GREENIE_TEST_MODE') == '1':
+        return "Test summary: " + " ".join(content.split())[:200]
+    return summary
 
 @app.post("/tools/summarize")
 async def summarize(req: SummarizeRequest):
     """Summarize a piece of text using the LLM."""
-    if not groq_client:
-        return {"error": "LLM service not configured"}
-    
     try:
-        chat_completion = groq_client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"Summarize the following text:\n\n{req.content}"
-                }
-            ],
-            model=DEFAULT_MODEL,
-            temperature=0.5,
-            max_tokens=512,
-            timeout=60
-        )
-        return {"summary": chat_completion.choices[0].message.content}
+        return {"summary": await _summarize_text(req.content, req.model)}
+    except RuntimeError as e:
+        return {"error": str(e)}
     except Exception as e:
         return {"error": f"Failed to summarize: {str(e)}"}
 
+# ===== Rolling conversation summaries =====
+# Once a session's turns pass SESSION_SUMMARY_TOKENS (or come close to the store's turn limit),
+# all but the newest SESSION_SUMMARY_KEEP turns are folded into the session's rolling summary by
+# the LLM, in the background. The summary lives with the session (hot tier and sessions table).
+SESSION_SUMMARY_TOKENS = int(os.environ.get("GREENIE_SESSION_SUMMARY_TOKENS", "600"))
+SESSION_SUMMARY_KEEP = int(os.environ.get("GREENIE_SESSION_SUMMARY_KEEP", "6"))
+SESSION_SUMMARY_MAX_TOKENS = int(os.environ.get("GREENIE_SESSION_SUMMARY_MAX_TOKENS", "250"))
+SESSION_SUMMARY_INSTRUCTION = (
+    "Update the running summary of a support conversation between a user and an IT assistant. "
+    "Keep the problem, the equipment involved, what was tried and what is still open, in a few short sentences."
+)
+_folding_sessions: set = set()
+_background_tasks: set = set()
+session_summary_status: dict = {"folds": 0, "stale": 0, "failures": 0, "last_error": None}
+
+def _record_exchange(key, message: str, reply: str) -> None:
+    """Append a user message and reply to the session, then fold it into its summary if due"""
+    sessions.append_exchange(key, message, reply)
+    if key in _folding_sessions:
+        return
+    due = sessions.fold_due(key, SESSION_SUMMARY_KEEP, SESSION_SUMMARY_TOKENS, estimate_tokens)
+    if due is None:
+        return
+    _folding_sessions.add(key)
+    task = asyncio.get_running_loop().create_task(_fold_session(key, *due))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _fold_session(key, summary: str | None, folded: list[tuple]) -> None:
+    try:
+        turns = "\n".join(f"{role}: {text}" for role, text, _ in folded)
+        content = f"Summary so far:\n{summary}\n\nNew turns:\n{turns}" if summary else turns
+        new_summary = await _summarize_text(content, instruction=SESSION_SUMMARY_INSTRUCTION)
+        if sessions.apply_summary(key, folded, truncate_tokens(new_summary.strip(), SESSION_SUMMARY_MAX_TOKENS)):
+            session_summary_status["folds"] += 1
+        else:
+            # the session changed underneath (cleared, reloaded); the next turn tries again
+            session_summary_status["stale"] += 1
+    except Exception as e:
+        session_summary_status["failures"] += 1
+        session_summary_status["last_error"] = str(e)
+        logger.warning(f"Session summary failed: {e}")
+    finally:
+        _folding_sessions.discard(key)
+
+# ===== Background memory compaction =====
+# Batches of a user's oldest raw memories are summarized into one digest memory.
+# A pass makes at most COMPACT_MAX_CALLS LLM calls and passes run every COMPACT_INTERVAL
+# seconds, so compaction never competes with chat for the rate limit. The digest replaces
+# its sources in one transaction (see DatabaseBackedMemory.apply_digest), and the user
+# cursor is kept in app_state, so a restart picks up where the last pass stopped.
+COMPACT_INTERVAL = float(os.environ.get("GREENIE_COMPACT_INTERVAL", "300"))  # seconds between passes; 0 disables
+COMPACT_MAX_CALLS = int(os.environ.get("GREENIE_COMPACT_MAX_CALLS", "5"))    # LLM calls per pass
+COMPACT_CURSOR_KEY = "memory_compaction:cursor"
+COMPACT_INSTRUCTION = (
+    "These are notes a user told an IT support assistant over time, oldest first. "
+    "Condense them into a short list of the facts, preferences and open issues worth remembering. "
+    "Leave out small talk."
+)
+compaction_task = None
+compaction_status: dict = {"runs": 0, "skipped": 0, "digests": 0, "compacted": 0, "empty": 0, "failures": 0,
+                           "last_run": None, "last_error": None}
+
+async def compact_user_memories(user_id: int, max_calls: int = COMPACT_MAX_CALLS) -> int:
+    """Fold one user's oldest raw memories into digests; returns the number of digests written"""
+    from starlette.concurrency import run_in_threadpool
+    user_memory = Memory(user_id=user_id)
+    written = 0
+    while written < max_calls:
+        batch = await run_in_threadpool(user_memory.compaction_batch)
+        if not batch:
+            break
+        first, last = batch[0]['timestamp'], batch[-1]['timestamp']
+        summary = (await _summarize_text("\n".join(f"- {m['text']}" for m in batch), instruction=COMPACT_INSTRUCTION) or "").strip()
+        if not summary:
+            # no digest came back: keep the sources and try again next pass
+            compaction_status["empty"] += 1
+            break
+        span = f"{time.strftime('%Y-%m-%d', time.localtime(first))} to {time.strftime('%Y-%m-%d', time.localtime(last))}"
+        digest = f"Digest of {len(batch)} memories ({span}): {summary}"
+        # the digest takes the newest source's timestamp, so it sits where its sources were
+        if await run_in_threadpool(user_memory.apply_digest, [m['id'] for m in batch], digest, last):
+            written += 1
+            compaction_status["digests"] += 1
+            compaction_status["compacted"] += len(batch)
+        else:
+            # the batch changed underneath us (another worker or a trim); look again next pass
+            break
+    return written
+
+async def run_memory_compaction(max_calls: int = COMPACT_MAX_CALLS) -> int:
+    """One rate-limited pass over the users due a compaction, resuming after the stored cursor.
+    Skipped while no LLM is configured, since every digest would fail.
+    """
+    from starlette.concurrency import run_in_threadpool
+    if async_groq_client is None:
+        compaction_status["skipped"] += 1
+        return 0
+    compaction_status["runs"] += 1
+    compaction_status["last_run"] = time.time()
+    cursor = int(await run_in_threadpool(get_app_state, COMPACT_CURSOR_KEY) or 0)
+    calls = 0
+    try:
+        while calls < max_calls:
+            users = await run_in_threadpool(memory_compaction_candidates, cursor)
+            if not users:
+                cursor = 0  # wrapped around: start from the first user next pass
+                break
+            for user_id in users:
+                calls += await compact_user_memories(user_id, max_calls - calls)
+                if calls >= max_calls:
+                    break
+                cursor = user_id
+    except Exception as e:
+        compaction_status["failures"] += 1
+        compaction_status["last_error"] = str(e)
+        logger.warning(f"Memory compaction stopped: {e}")
+    await run_in_threadpool(set_app_state, COMPACT_CURSOR_KEY, str(cursor))
+    return calls
+
+async def _memory_compaction_loop():
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        try:
+            written = await run_memory_compaction()
+            if written:
+                logger.info(f"Memory compaction wrote {written} digests")
+        except Exception as e:
+            logger.exception(f"Memory compaction pass failed: {e}")
+
+@app.post("/memory/compact")
+async def compact_memories(current_user: User | None = Depends(get_current_user_optional)):
+    """Compact the current user's oldest memories into digests now (still capped at COMPACT_MAX_CALLS)"""
+    user_id = current_user.id if current_user else 1
+    try:
+        written = await compact_user_memories(user_id)
+    except Exception as e:
+        return {"error": f"Compaction failed: {str(e)}"}
+    return {"ok": True, "digests": written}
+
+@app.get("/stats/compaction")
+async def compaction_stats():
+    """Totals of the background memory compaction job"""
+    return compaction_status
+
 @app.get("/debug/last_prompt")
 async def debug_last_prompt():
-    return {"last_prompt": last_prompt}
+    return {"last_prompt": last_prompt, "budget": last_prompt_budget}
+
+@app.get("/stats/cache")
+async def cache_stats():
+    """Hit/miss statistics for the in-process caches"""
+    return {"caches": [system_block_cache.stats(), knowledge_search_cache.stats()]}
+
+@app.get("/stats/queues")
+async def queue_stats():
+    """Depth and flush latency of the write-behind queues"""
+    return {"queues": [memory_writer.stats(), session_writer.stats()]}
+
+@app.get("/stats/llm")
+async def llm_stats():
+    """Upstream LLM calls in flight, waiting for a slot and made so far, and streaming latency"""
+    return {**llm_status, "streaming": stream_status}
+
+@app.get("/stats/sessions")
+async def session_stats():
+    """Size, hit rate and evictions of the conversation session store, and summary folds"""
+    return {**sessions.stats(), "summaries": session_summary_status}
+
+@app.get("/debug/retrieval")
+async def debug_retrieval():
+    """Per-stage timings of the most recent chat retrieval"""
+    return {"last_retrieval": last_retrieval}
 
 @app.get('/debug/version')
 async def debug_version():
@@ -1183,6 +1691,25 @@ def register_shutdown_hook(fn):
     global shutdown_hook
     shutdown_hook = fn
 
+
+def _stop_writers():
+    """Write out everything still queued for the database and stop the write-behind workers"""
+    memory_writer.stop()
+    session_writer.stop()
+
+
+def _run_shutdown_hook():
+    """Flush queued writes, then hand over to the registered shutdown hook"""
+    _stop_writers()
+    shutdown_hook()
+
+
+def _exit_process(delay: float):
+    """Fallback when no shutdown hook is installed: flush queued writes and exit after `delay`"""
+    time.sleep(delay)
+    _stop_writers()
+    os._exit(0)
+
 # log runtime tmpdir when running frozen (onefile)
 if getattr(sys, '_MEIPASS', None):
     try:
@@ -1204,36 +1731,95 @@ async def shutdown(request: Request):
     if shutdown_hook:
         try:
             import threading
-            threading.Thread(target=shutdown_hook, daemon=True).start()
+            threading.Thread(target=_run_shutdown_hook, daemon=True).start()
             return {"ok": True, "message": "Server shutting down (hook)"}
         except Exception as e:
             logger.exception('Shutdown hook failed: %s', e)
             return JSONResponse(status_code=500, content={"error": "Shutdown failed", "detail": str(e)})
 
     # fallback: force exit in a separate thread
-    def _exit():
-        import time, os
-        time.sleep(0.2)
-        os._exit(0)
-
     import threading
-    threading.Thread(target=_exit, daemon=True).start()
+    threading.Thread(target=_exit_process, args=(0.2,), daemon=True).start()
     return {"ok": True, "message": "Server shutting down"}
 
-def _build_prompt_and_payload(req: ChatRequest):
-    # Build the prompt and base payload for both streaming and non-streaming endpoints
-    recent_n = req.recent or 5
+def _render_system_block(items: list[dict]) -> str:
+    """The prompt's System block from identity/personality knowledge entries"""
+    if items:
+        return "System:\n" + "\n".join(f"- {it.get('name')}: {it.get('description','')}" for it in items) + "\n\n"
+    # fallback brief identity so model always knows its name
+    return "System:\n- Greenie: an AI assistant that is witty, intelligent, and supportive.\n\n"
+
+
+def _retrieve_context(req: ChatRequest, user_memory: Memory, user_knowledge: KnowledgeStore) -> dict:
+    """Run every retrieval step for a chat turn exactly once.
+    Returns memories, the topic candidate, system/identity entries and top-k knowledge,
+    plus per-stage timings (ms) which are also kept in `last_retrieval` for debugging.
+    """
+    global last_retrieval
+    fast = getattr(req, 'fast', False)
+    semantic = getattr(req, 'retrieval', None) == 'semantic'
+    # fast mode drops recent memories and knowledge to reduce latency
+    recent_n = 0 if fast else (req.recent or 5)
+    include_knowledge = getattr(req, "include_knowledge", True) and not fast
+    timings = {}
+
+    started = time.perf_counter()
     try:
-        if getattr(req, 'fast', False):
-            recent_n = 0
-            req.include_knowledge = False
+        if getattr(req, 'memory_mode', None) == 'relevant':
+            mems = user_memory.recall(req.message, recent_n)
+        elif semantic:
+            mems = user_memory.semantic_search(req.message, recent_n)
+        else:
+            mems = user_memory.get_recent(recent_n)
     except Exception:
-        pass
-    mems = memory.get_recent(recent_n)
-    mem_text = ""
-    if mems:
-        mem_text = "Memories:\n" + "\n".join(f"- {m}" for m in mems) + "\n\n"
+        mems = []
+    timings['memories_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    # the System block only changes when the user's knowledge does, so it is cached per version
+    include_system = getattr(req, "include_system", True)
+    system_block = None
+    if include_system:
+        version = user_knowledge.version
+        system_block = system_block_cache.get(user_knowledge.user_id, version)
+
+    # one ranking pass yields the knowledge results, the topic candidate and (on a cache miss) the system entries
+    stage = time.perf_counter()
+    try:
+        found = user_knowledge.retrieve(
+            req.message,
+            (req.knowledge_n or 5) if include_knowledge else 0,
+            include_system=include_system and system_block is None,
+            semantic_mode=semantic and include_knowledge,
+        )
+    except Exception:
+        logger.exception('Knowledge retrieval failed')
+        found = None
+    if found is None:
+        found = {'results': [], 'best_match': None, 'system': []}
+        if include_system and system_block is None:
+            system_block = _render_system_block([])
+    elif include_system and system_block is None:
+        system_block = _render_system_block(found['system'])
+        system_block_cache.put(user_knowledge.user_id, version, system_block)
+    timings['knowledge_ms'] = round((time.perf_counter() - stage) * 1000, 2)
+    timings['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+    last_retrieval = {"ts": time.time(), "user_id": user_knowledge.user_id, "timings": timings}
+    logger.info('Retrieval timings (user=%s): %s', user_knowledge.user_id, timings)
+    return {
+        "memories": mems,
+        "best_match": found['best_match'],
+        "system_block": system_block or "",
+        "knowledge": found['results'],
+        "timings": timings,
+    }
 
+
+def _build_prompt_and_payload(req: ChatRequest, user_memory: Memory, user_knowledge: KnowledgeStore, stream: bool = True):
+    # Build the prompt and base payload for both streaming and non-streaming endpoints
+    ctx = _retrieve_context(req, user_memory, user_knowledge)
+
+    # detect explicit topic change phrases (e.g. 'talk about X', 'change topic to Y')
     import re
 
     def extract_explicit_topic(msg: str) -> str | None:
@@ -1246,6 +1832,7 @@ def _build_prompt_and_payload(req: ChatRequest):
             m = re.search(pat, msg, re.I)
             if m:
                 return m.group(1).strip().strip('."\'')
+        # generic 'moving on' or 'different topic' phrases mean clear topic
         moving_phrases = ["moving on", "new topic", "different topic", "anyway"]
         if any(p in msg.lower() for p in moving_phrases):
             return "__CLEAR__"
@@ -1266,16 +1853,15 @@ def _build_prompt_and_payload(req: ChatRequest):
         except Exception:
             pass
     elif explicit:
+        # user explicitly set a topic
         try:
             set_topic(explicit)
             current_topic = explicit
         except Exception:
             pass
     else:
-        try:
-            bm = user_knowledge.best_match(req.message)
-        except Exception:
-            bm = None
+        # try to infer topic from the knowledge retrieval's best match
+        bm = ctx["best_match"]
         if bm:
             name = bm.get('name')
             if name and name != current_topic:
@@ -1285,55 +1871,64 @@ def _build_prompt_and_payload(req: ChatRequest):
                 except Exception:
                     pass
 
+    # include the current topic in the prompt
     topic_text = ""
     if current_topic:
         topic_text = f"Current topic: {current_topic}\n\n"
 
-    system_text = ""
+    # include basic system identity/personality knowledge (always near top if requested)
+    system_text = ctx["system_block"]
     try:
+        # include current UK time so model can reference it
         time_info = get_time()
         time_text = f"Time:\n- {time_info['human_short']} (Europe/London)\n\n"
     except Exception:
         time_text = ""
 
-    if getattr(req, "include_system", True):
-        try:
-            items = [
-                it for it in user_knowledge.list_all()
-                if ('identity' in [k.lower() for k in it.get('keywords', [])])
-                or ('personality' in [k.lower() for k in it.get('keywords', [])])
-                or (it.get('name','').lower().startswith('greenie'))
-            ]
-        except Exception:
-            items = []
-        if items:
-            system_text = "System:\n" + "\n".join(f"- {it.get('name')}: {it.get('description','')}" for it in items) + "\n\n"
-        else:
-            system_text = "System:\n- Greenie: an AI assistant that is witty, intelligent, and supportive.\n\n"
-
+    # prepend time information so it is always visible to the model
     system_text = time_text + system_text
 
+    # the fixed parts are always sent; the optional sections share what is left of the budget
+    global last_prompt_budget
+    budget = TokenBudget(PROMPT_TOKEN_BUDGET)
+    budget.charge("fixed", system_text + topic_text + req.message)
+
+    # include relevant knowledge items at the top of the prompt (if requested), best first
     knowledge_text = ""
-    if getattr(req, "include_knowledge", True):
-        k_n = req.knowledge_n or 5
-        try:
-            k_results = user_knowledge.search(req.message, k_n)
-        except Exception:
-            k_results = []
-        if k_results:
-            knowledge_text = "Knowledge:\n" + "\n".join(
-                f"- {item.get('name', item.get('title', ''))}: {item.get('description', '')}"
-                for item in k_results
-            ) + "\n\n"
+    k_lines = budget.pack(
+        "knowledge", ctx["knowledge"], KNOWLEDGE_TOKEN_BUDGET,
+        render=lambda item: f"- {item.get('name', item.get('title', ''))}: {item.get('description', '')}"
+    )
+    if k_lines:
+        knowledge_text = "Knowledge:\n" + "\n".join(k_lines) + "\n\n"
+
+    mem_text = ""
+    mem_lines = budget.pack("memories", ctx["memories"], MEMORY_TOKEN_BUDGET, render=lambda m: f"- {m}")
+    if mem_lines:
+        mem_text = "Memories:\n" + "\n".join(mem_lines) + "\n\n"
 
+    # include session (ephemeral) history if conversation_mode is enabled and a session_id is passed
     session_text = ""
     try:
+        # Skip including session history when fast mode requested to reduce prompt size & latency
         if not getattr(req, 'fast', False) and getattr(req, 'conversation_mode', True) and getattr(req, 'session_id', None):
-            hist = sessions.get(req.session_id, [])
-            if hist:
-                session_text = "Recent conversation:\n" + "\n".join(f"{itm['role']}: {itm['text']}" for itm in hist[-SESSION_MAX:]) + "\n\n"
+            summary, hist = sessions.get_context((user_memory.user_id, req.session_id))
+            # the rolling summary of earlier turns first, then the newest turns, as many as fit;
+            # one huge turn (a pasted log) is clipped
+            summary_lines = budget.pack(
+                "conversation_summary", [summary] if summary else [], SESSION_SUMMARY_MAX_TOKENS, contiguous=True
+            )
+            lines = budget.pack(
+                "conversation", list(reversed(hist)), SESSION_TOKEN_BUDGET - budget.sections["conversation_summary"],
+                render=lambda itm: f"{itm['role']}: {itm['text']}", contiguous=True
+            )
+            if summary_lines:
+                session_text = "Conversation so far (summary):\n" + summary_lines[0] + "\n\n"
+            if lines:
+                session_text += "Recent conversation:\n" + "\n".join(reversed(lines)) + "\n\n"
     except Exception:
         session_text = ""
+    last_prompt_budget = budget.summary()
 
     prompt = system_text + topic_text + knowledge_text + mem_text + session_text + req.message
 
@@ -1342,12 +1937,19 @@ def _build_prompt_and_payload(req: ChatRequest):
         "model": chosen_model,
         "prompt": prompt,
     }
-    ol_timeout = 120
+    if not stream:
+        payload["stream"] = False  # single JSON response
+    # prefer a faster model and shorter read timeout if requested
+    ol_timeout = 120 if stream else 60
     try:
         if getattr(req, 'fast', False):
             ol_timeout = 30
+            # prefer a quicker model option if not explicitly set
             if not req.model:
-                payload['model'] = 'llama3-8b-8192'  # Faster, smaller model for fast mode
+                if stream:
+                    payload['model'] = 'llama3-8b-8192'  # Faster, smaller model for fast mode
+                else:
+                    payload['model'] = model_candidates("llama-3.1-8b-instant")[0]
     except Exception:
         pass
 
@@ -1369,153 +1971,8 @@ async def chat(req: ChatRequest, current_user: User | None = Depends(get_current
     user_knowledge = KnowledgeStore(user_id=user_id)
     
     try:
-        # include recent memories at the top of the prompt
-        recent_n = req.recent or 5
-        # if fast mode requested, drop recent memories and knowledge to reduce latency
-        try:
-            if getattr(req, 'fast', False):
-                recent_n = 0
-                req.include_knowledge = False
-        except Exception:
-            pass
-        mems = user_memory.get_recent(recent_n)
-        mem_text = ""
-        if mems:
-            mem_text = "Memories:\n" + "\n".join(f"- {m}" for m in mems) + "\n\n"
-
-        # detect explicit topic change phrases (e.g. 'talk about X', 'change topic to Y')
-        import re
-
-        def extract_explicit_topic(msg: str) -> str | None:
-            patterns = [
-                r"(?:change topic to|switch to|focus on)\s+(.+)",
-                r"(?:let(?:'s| us) talk about|talk about|now about|now let's talk about|discuss)\s+(.+)",
-                r"^topic:\s*(.+)"
-            ]
-            for pat in patterns:
-                m = re.search(pat, msg, re.I)
-                if m:
-                    return m.group(1).strip().strip('."\'')
-            # generic 'moving on' or 'different topic' phrases mean clear topic
-            moving_phrases = ["moving on", "new topic", "different topic", "anyway"]
-            if any(p in msg.lower() for p in moving_phrases):
-                return "__CLEAR__"
-            return None
-
-        explicit = extract_explicit_topic(req.message)
-        current_topic = None
-        try:
-            from memory import get_topic, set_topic, clear_topic
-            current_topic = get_topic()
-        except Exception:
-            current_topic = None
-
-        if explicit == "__CLEAR__":
-            try:
-                clear_topic()
-                current_topic = None
-            except Exception:
-                pass
-        elif explicit:
-            # user explicitly set a topic
-            try:
-                set_topic(explicit)
-                current_topic = explicit
-            except Exception:
-                pass
-        else:
-            # try to infer topic from knowledge store matches
-            try:
-                bm = user_knowledge.best_match(req.message)
-            except Exception:
-                bm = None
-            if bm:
-                name = bm.get('name')
-                if name and name != current_topic:
-                    try:
-                        set_topic(name)
-                        current_topic = name
-                    except Exception:
-                        pass
-
-        # include the current topic in the prompt
-        topic_text = ""
-        if current_topic:
-            topic_text = f"Current topic: {current_topic}\n\n"
-
-        # include basic system identity/personality knowledge (always near top if requested)
-        system_text = ""
-        try:
-            # include current UK time so model can reference it
-            time_info = get_time()
-            time_text = f"Time:\n- {time_info['human_short']} (Europe/London)\n\n"
-        except Exception:
-            time_text = ""
-
-        if getattr(req, "include_system", True):
-            try:
-                items = [
-                    it for it in user_knowledge.list_all()
-                    if ('identity' in [k.lower() for k in it.get('keywords', [])])
-                    or ('personality' in [k.lower() for k in it.get('keywords', [])])
-                    or (it.get('name','').lower().startswith('greenie'))
-                ]
-            except Exception:
-                items = []
-            if items:
-                system_text = "System:\n" + "\n".join(f"- {it.get('name')}: {it.get('description','')}" for it in items) + "\n\n"
-            else:
-                # fallback brief identity so model always knows its name
-                system_text = "System:\n- Greenie: an AI assistant that is witty, intelligent, and supportive.\n\n"
-
-        # prepend time information so it is always visible to the model
-        system_text = time_text + system_text
-
-        # include relevant knowledge items at the top of the prompt (if requested)
-        knowledge_text = ""
-        if getattr(req, "include_knowledge", True):
-            k_n = req.knowledge_n or 5
-            try:
-                k_results = user_knowledge.search(req.message, k_n)
-            except Exception:
-                k_results = []
-            if k_results:
-                knowledge_text = "Knowledge:\n" + "\n".join(
-                    f"- {item.get('name', item.get('title', ''))}: {item.get('description', '')}"
-                    for item in k_results
-                ) + "\n\n"
-
-        # include session (ephemeral) history if conversation_mode is enabled and a session_id is passed
-        session_text = ""
-        try:
-            # Skip including session history when fast mode requested to reduce prompt size & latency
-            if not getattr(req, 'fast', False) and getattr(req, 'conversation_mode', True) and getattr(req, 'session_id', None):
-                hist = sessions.get(req.session_id, [])
-                if hist:
-                    session_text = "Recent conversation:\n" + "\n".join(f"{itm['role']}: {itm['text']}" for itm in hist[-SESSION_MAX:]) + "\n\n"
-        except Exception:
-            session_text = ""
-
-        prompt = system_text + topic_text + knowledge_text + mem_text + session_text + req.message
-
-        chosen_model = model_candidates(req.model)[0]
-        payload = {
-            "model": chosen_model,
-            "prompt": prompt,
-            "stream": False  # single JSON response
-        }
-        # prefer a faster model and shorter read timeout if requested
-        ol_timeout = 60
-        try:
-            if getattr(req, 'fast', False):
-                ol_timeout = 30
-                # prefer a quicker model option if not explicitly set
-                if not req.model:
-                    fast_model = model_candidates("llama-3.1-8b-instant")[0]
-                    payload['model'] = fast_model
-        except Exception:
-            pass
-
+        # retrieve memories, topic, system identity and knowledge in one pass and build the prompt
+        prompt, payload, ol_timeout = _build_prompt_and_payload(req, user_memory, user_knowledge, stream=False)
 
         # If user asks Greenie to update itself, use a confirmation flow to avoid accidental updates
         import re
@@ -1549,74 +2006,57 @@ async def chat(req: ChatRequest, current_user: User | None = Depends(get_current
             import time as _time
             start_time = _time.time()
 
-            # testing hook and test-mode shortcut
-            if os.environ.get('GREENIE_TEST_MODE') == '1':
-                if req.message.strip().lower() == 'force timeout':
-                    # simulate structured timeout response for tests
-                    return {"error": "timeout", "message": f"Model timed out after {ol_timeout}s.", "suggestions": ["enable_fast", "retry"]}
-                # when in test mode, return deterministic fake replies to avoid external dependency
-                reply = f"Test reply: {req.message}"
-            else:
-                # Use Groq API
-                if not groq_client:
-                    logger.error("Groq API key not set. Set GROQ_API_KEY environment variable.")
-                    return {"error": "LLM service not configured. Please set GROQ_API_KEY environment variable."}
+            # testing hook (in test mode the LLM itself is FakeLLMClient)
+            if os.environ.get('GREENIE_TEST_MODE') == '1' and req.message.strip().lower() == 'force timeout':
+                # simulate structured timeout response for tests
+                return {"error": "timeout", "message": f"Model timed out after {ol_timeout}s.", "suggestions": ["enable_fast", "retry"]}
 
-                try:
-                    models_to_try = model_candidates(payload.get('model'))
-                    last_err = None
-                    for m in models_to_try:
-                        try:
-                            chat_completion = groq_client.chat.completions.create(
-                                messages=[
-                                    {
-                                        "role": "system",
-                                        "content": "You are Greenie, an IT support assistant for a warehouse equipment refurbishment operation. Be blunt and straight-to-the-point. Tell people exactly what they need to know without fluff. Be helpful but direct. If something won't work, say so clearly. Reference specific procedures and tools from the knowledge base when available."
-                                    },
-                                    {
-                                        "role": "user",
-                                        "content": payload["prompt"]
-                                    }
-                                ],
-                                model=m,
-                                temperature=0.7,
-                                max_tokens=2048,
-                                timeout=ol_timeout
-                            )
-                            reply = chat_completion.choices[0].message.content
-                            logger.info(f"Groq reply received ({len(reply)} chars, model={m})")
-                            payload['model'] = m
-                            break
-                        except Exception as e:
-                            last_err = e
-                            msg = str(e).lower()
-                            logger.warning("Groq API error on model %s: %s", m, e)
-                            if any(term in msg for term in ["decommissioned", "not found", "does not exist"]):
-                                continue  # try next model
-                            if "timeout" in msg:
-                                return {"error": "timeout", "message": f"Model timed out after {ol_timeout}s.", "suggestions": ["enable_fast", "retry"]}
-                            if "rate_limit" in msg or "429" in msg:
-                                return {"error": "Rate limit reached. Please wait a moment and try again."}
-                            return {"error": f"LLM API error: {str(e)[:100]}", "models_tried": models_to_try}
-                    else:
-                        return {"error": f"LLM API error: {str(last_err)[:120] if last_err else 'unknown'}", "models_tried": models_to_try}
-                finally:
-                    elapsed = _time.time() - start_time
-                    logger.info('Groq API call took %.2fs (fast=%s, model=%s, prompt_len=%d)', elapsed, getattr(req, 'fast', False), payload.get('model'), len(payload.get('prompt','')))
+            # Use Groq API
+            if not async_groq_client:
+                logger.error("Groq API key not set. Set GROQ_API_KEY environment variable.")
+                return {"error": "LLM service not configured. Please set GROQ_API_KEY environment variable."}
+
+            try:
+                models_to_try = model_candidates(payload.get('model'))
+                last_err = None
+                for m in models_to_try:
+                    try:
+                        reply = await _llm_complete(
+                            messages=_chat_messages(payload["prompt"]),
+                            model=m,
+                            temperature=0.7,
+                            max_tokens=2048,
+                            timeout=ol_timeout
+                        )
+                        logger.info(f"Groq reply received ({len(reply)} chars, model={m})")
+                        payload['model'] = m
+                        break
+                    except Exception as e:
+                        last_err = e
+                        msg = str(e).lower()
+                        logger.warning("Groq API error on model %s: %s", m, e)
+                        if any(term in msg for term in ["decommissioned", "not found", "does not exist"]):
+                            continue  # try next model
+                        if "timeout" in msg:
+                            return {"error": "timeout", "message": f"Model timed out after {ol_timeout}s.", "suggestions": ["enable_fast", "retry"]}
+                        if "rate_limit" in msg or "429" in msg:
+                            return {"error": "Rate limit reached. Please wait a moment and try again."}
+                        return {"error": f"LLM API error: {str(e)[:100]}", "models_tried": models_to_try}
+                else:
+                    return {"error": f"LLM API error: {str(last_err)[:120] if last_err else 'unknown'}", "models_tried": models_to_try}
+            finally:
+                elapsed = _time.time() - start_time
+                logger.info('Groq API call took %.2fs (fast=%s, model=%s, prompt_len=%d)', elapsed, getattr(req, 'fast', False), payload.get('model'), len(payload.get('prompt','')))
             
             # optionally save the user's message as memory
             if req.save:
-                user_memory.add_memory(req.message)
+                # written by the write-behind queue so the reply does not wait on the database
+                user_memory.queue_memory(req.message)
 
             # append session history: user message then assistant reply (if conversation_mode on)
             try:
                 if getattr(req, 'conversation_mode', True) and getattr(req, 'session_id', None):
-                    sid = req.session_id
-                    lst = sessions.get(sid, [])
-                    lst.append({'role': 'user', 'text': req.message})
-                    lst.append({'role': 'assistant', 'text': reply})
-                    # trim to last N messages
-                    sessions[sid] = lst[-(SESSION_MAX*2):]
+                    _record_exchange((user_id, req.session_id), req.message, reply)
             except Exception:
                 pass
 
@@ -1637,88 +2077,46 @@ async def chat(req: ChatRequest, current_user: User | None = Depends(get_current
 
 
 @app.post('/chat/stream')
-async def chat_stream(req: ChatRequest):
+async def chat_stream(req: ChatRequest, current_user: User | None = Depends(get_current_user_optional)):
     """Stream assistant replies using a chunked transfer (SSE-like) interface.
     This endpoint yields text chunks as they arrive from the upstream model.
     Clients should POST JSON and stream the response body to append partial replies.
+    Uses the same per-user retrieval as /chat; a final `event: done` carries the timings
+    (time to first token, total) and the model used.
     """
+    user_id = current_user.id if current_user else 1
     try:
-        prompt, payload, ol_timeout = _build_prompt_and_payload(req)
+        user_memory = Memory(user_id=user_id)
+        user_knowledge = KnowledgeStore(user_id=user_id)
+        prompt, payload, ol_timeout = _build_prompt_and_payload(req, user_memory, user_knowledge)
         payload['stream'] = True
+        global last_prompt
+        last_prompt = prompt
 
-        # When running in test mode, yield some fake chunks to allow unit tests to exercise streaming logic
-        if os.environ.get('GREENIE_TEST_MODE') == '1':
-            async def fake_stream():
-                import asyncio
-                yield "data: " + "Starting stream..." + "\n\n"
-                await asyncio.sleep(0.01)
-                yield "data: " + "first chunk" + "\n\n"
-                await asyncio.sleep(0.01)
-                yield "data: " + " second chunk" + "\n\n"
-                # finally, append to session as completed reply
-            # record last prompt for debug
-            global last_prompt
-            last_prompt = prompt
-            async def wrapper():
-                accumulated = ''
-                async for part in fake_stream():
-                    # strip leading 'data: ' for accumulation
-                    accumulated += part.replace('data: ', '').replace('\n\n','')
-                    yield part
-                # append session history if requested
-                try:
-                    if getattr(req, 'conversation_mode', True) and getattr(req, 'session_id', None):
-                        sid = req.session_id
-                        lst = sessions.get(sid, [])
-                        lst.append({'role': 'user', 'text': req.message})
-                        lst.append({'role': 'assistant', 'text': accumulated})
-                        sessions[sid] = lst[-(SESSION_MAX*2):]
-                except Exception:
-                    pass
-            return StreamingResponse(wrapper(), media_type='text/event-stream')
-
-        # otherwise, use Groq streaming API
-        def iter_stream():
+        async def events():
+            import json
+            started = time.perf_counter()
+            first_token_ms = None
             accumulated = ''
             try:
-                if not groq_client:
-                    yield f"event:error\ndata: LLM service not configured\n\n"
-                    return
-
                 models_to_try = model_candidates(payload.get('model'))
                 last_err = None
-
                 for m in models_to_try:
                     try:
-                        stream = groq_client.chat.completions.create(
-                            messages=[
-                                {
-                                    "role": "system",
-                                    "content": "You are Greenie, an IT support assistant for a warehouse equipment refurbishment operation. Be blunt and straight-to-the-point. Tell people exactly what they need to know without fluff. Be helpful but direct. If something won't work, say so clearly. Reference specific procedures and tools from the knowledge base when available."
-                                },
-                                {
-                                    "role": "user",
-                                    "content": payload["prompt"]
-                                }
-                            ],
-                            model=m,
-                            temperature=0.7,
-                            max_tokens=2048,
-                            stream=True
-                        )
-
-                        for chunk in stream:
-                            if chunk.choices[0].delta.content:
-                                text = chunk.choices[0].delta.content
-                                yield f"data: {text}\n\n"
-                                accumulated += text
+                        async for text in _llm_stream(_chat_messages(payload["prompt"]), m,
+                                                      temperature=0.7, max_tokens=2048, timeout=ol_timeout):
+                            if first_token_ms is None:
+                                first_token_ms = (time.perf_counter() - started) * 1000
+                            accumulated += text
+                            yield f"data: {text}\n\n"
                         payload['model'] = m
                         break
                     except Exception as e:
                         last_err = e
                         msg = str(e).lower()
                         logger.warning("Groq stream error on model %s: %s", m, e)
-                        if any(term in msg for term in ["decommissioned", "not found", "does not exist"]):
+                        # another model can only take over before anything was sent
+                        if not accumulated and any(term in msg for term in ["decommissioned", "not found", "does not exist"]):
                             continue  # try next model
                         yield f"event:error\ndata: {str(e)}\n\n"
                         return
@@ -1726,22 +2124,25 @@ async def chat_stream(req: ChatRequest):
                     yield f"event:error\ndata: LLM API error: {str(last_err) if last_err else 'unknown'} (models tried: {models_to_try})\n\n"
                     return
 
-                # after stream completes, append to session history if needed
-                try:
-                    if getattr(req, 'conversation_mode', True) and getattr(req, 'session_id', None):
-                        sid = req.session_id
-                        lst = sessions.get(sid, [])
-                        lst.append({'role': 'user', 'text': req.message})
-                        lst.append({'role': 'assistant', 'text': accumulated})
-                        sessions[sid] = lst[-(SESSION_MAX*2):]
-                except Exception:
-                    pass
+                # the reply is complete: save the message and the exchange like /chat does
+                if req.save:
+                    user_memory.queue_memory(req.message)
+                if getattr(req, 'conversation_mode', True) and getattr(req, 'session_id', None):
+                    _record_exchange((user_id, req.session_id), req.message, accumulated)
+                total_ms = (time.perf_counter() - started) * 1000
+                _record_stream_timing(first_token_ms, total_ms)
+                done = {
+                    "ttft_ms": round(first_token_ms, 2) if first_token_ms is not None else None,
+                    "total_ms": round(total_ms, 2),
+                    "model": payload.get('model'),
+                }
+                logger.info('Stream complete (user=%s): %s', user_id, done)
+                yield f"event: done\ndata: {json.dumps(done)}\n\n"
             except Exception as e:
                 logger.exception('Error while streaming response: %s', e)
                 yield f"event:error\ndata: {str(e)}\n\n"
-        # store last_prompt too
-        last_prompt = prompt
-        return StreamingResponse(iter_stream(), media_type='text/event-stream')
+
+        return StreamingResponse(events(), media_type='text/event-stream')
     except Exception as e:
         logger.exception('Error in /chat/stream: %s', e)
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -1755,16 +2156,18 @@ async def get_topic_endpoint():
         return {"topic": None}
 
 @app.post('/session/clear')
-async def clear_session(req: dict):
+async def clear_session(req: dict, current_user: User | None = Depends(get_current_user_optional)):
     sid = req.get('session_id') if req else None
     if not sid:
         return {"ok": False, "error": "session_id required"}
-    sessions.pop(sid, None)
+    user_id = current_user.id if current_user else 1
+    sessions.pop((user_id, sid), None)
     return {"ok": True}
 
 @app.get('/session/{sid}')
-async def get_session(sid: str):
-    return {"session": sessions.get(sid, [])}
+async def get_session(sid: str, current_user: User | None = Depends(get_current_user_optional)):
+    user_id = current_user.id if current_user else 1
+    return {"session": sessions.get((user_id, sid), [])}
 
 
 @app.post('/topic')
@@ -1901,7 +2304,7 @@ async def admin_restart(request: Request):
     # If shutdown hook exists, trigger it; otherwise return message indicating restart not performed
     if shutdown_hook:
         try:
-            threading.Thread(target=shutdown_hook, daemon=True).start()
+            threading.Thread(target=_run_shutdown_hook, daemon=True).start()
             return {"ok": True, "message": "Shutdown hook invoked"}
         except Exception as e:
             logger.exception('Admin restart failed: %s', e)
@@ -1936,10 +2339,10 @@ def _perform_git_update(branch: str | None = None) -> dict:
             try:
                 # If an in-process shutdown hook is available, call it to gracefully stop the server
                 if shutdown_hook:
-                    threading.Thread(target=shutdown_hook, daemon=True).start()
+                    threading.Thread(target=_run_shutdown_hook, daemon=True).start()
                 else:
                     # fallback: exit after a brief delay so a supervisor/runner can restart
-                    threading.Thread(target=lambda: (time.sleep(0.5), os._exit(0)), daemon=True).start()
+                    threading.Thread(target=_exit_process, args=(0.5,), daemon=True).start()
             except Exception:
                 pass
         return result
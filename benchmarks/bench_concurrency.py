@@ -0,0 +1,67 @@
+"""
+Benchmark: N parallel /chat requests against the test-mode fake LLM
+Each fake completion takes GREENIE_TEST_LLM_DELAY seconds. With non-blocking LLM calls N chats
+finish in about the time of one (up to GREENIE_LLM_CONCURRENCY), and /health answers meanwhile.
+A blocking call (the old synchronous client) is simulated for comparison.
+Run from the repo root: python benchmarks/bench_concurrency.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+_tmp.close()
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp.name}"
+os.environ["GREENIE_TEST_MODE"] = "1"
+os.environ.setdefault("GREENIE_TEST_LLM_DELAY", "0.5")
+
+import httpx  # noqa: E402
+
+import app  # noqa: E402
+
+PARALLEL = (1, 4, 8, 16)
+
+
+async def run(n: int) -> tuple[float, float]:
+    """Seconds for n parallel chats, and /health latency while they run"""
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        started = time.perf_counter()
+        chats = [
+            asyncio.create_task(client.post("/chat", json={"message": f"bios password dell {i}", "save": False}))
+            for i in range(n)
+        ]
+        # measured from when the probe was due, so time spent waiting for a blocked loop counts
+        await asyncio.sleep(0.05)
+        await client.get("/health")
+        health_ms = (time.perf_counter() - started - 0.05) * 1000
+        for response in await asyncio.gather(*chats):
+            assert response.status_code == 200 and "reply" in response.json(), response.text
+        return time.perf_counter() - started, health_ms
+
+
+async def blocking_fake(*args, **kwargs) -> str:
+    time.sleep(app.TEST_LLM_DELAY)  # what a synchronous client call does to the event loop
+    return ""
+
+
+async def main() -> None:
+    print(f"fake LLM latency {app.TEST_LLM_DELAY:.2f}s, concurrency limit {app.LLM_CONCURRENCY}")
+    for label, fake in (("async", None), ("blocking", blocking_fake)):
+        if fake is not None:
+            app._llm_complete = fake
+        for n in PARALLEL:
+            elapsed, health_ms = await run(n)
+            print(f"{label:9s} {n:3d} parallel chats: {elapsed:6.2f}s total   /health during load: {health_ms:7.1f} ms")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    finally:
+        os.unlink(_tmp.name)
@@ -0,0 +1,64 @@
+"""
+Benchmark: DatabaseBackedMemory.add_memory with a user already at retention (1000 memories)
+Compares the old per-insert count + ORM delete trim against the amortized ring-buffer trim.
+Run from the repo root: python benchmarks/bench_memory.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+_tmp.close()
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp.name}"
+
+import database  # noqa: E402
+from database import Memory, SessionLocal  # noqa: E402
+
+MAX_ITEMS = 1000
+
+
+def legacy_add_memory(user_id: int, text: str) -> None:
+    """add_memory as it was: insert, COUNT(*), load the oldest rows and delete them one by one"""
+    db = SessionLocal()
+    try:
+        db.add(Memory(user_id=user_id, text=text, timestamp=time.time()))
+        db.commit()
+        count = db.query(Memory).filter(Memory.user_id == user_id).count()
+        if count > MAX_ITEMS:
+            oldest = db.query(Memory).filter(
+                Memory.user_id == user_id
+            ).order_by(Memory.timestamp.asc()).limit(count - MAX_ITEMS).all()
+            for m in oldest:
+                db.delete(m)
+            db.commit()
+    finally:
+        db.close()
+
+
+def bench(label: str, user_id: int, add, inserts: int = 500) -> None:
+    memory = database.DatabaseBackedMemory(user_id, max_items=MAX_ITEMS)
+    memory.add_memories_bulk([(f"seed memory {i} about blancco and bios", None) for i in range(MAX_ITEMS)])
+    t0 = time.perf_counter()
+    for i in range(inserts):
+        add(memory, f"new memory {i}: wiped an HP laptop")
+    per_insert = (time.perf_counter() - t0) / inserts
+    db = SessionLocal()
+    try:
+        rows = db.query(Memory).filter(Memory.user_id == user_id).count()
+    finally:
+        db.close()
+    print(f"{label:<12} {per_insert * 1000:7.3f} ms/insert  rows after: {rows}")
+
+
+if __name__ == "__main__":
+    database.init_db()
+    try:
+        bench("legacy", 1, lambda m, text: legacy_add_memory(m.user_id, text))
+        bench("ring buffer", 2, lambda m, text: m.add_memory(text))
+    finally:
+        database.engine.dispose()
+        os.unlink(_tmp.name)
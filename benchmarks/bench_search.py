@@ -0,0 +1,77 @@
+"""
+Benchmark: BM25 knowledge ranking at 1k, 10k and 100k entries
+Queries are timed cold (empty weight cache), right after an add, and warm.
+Run from the repo root: python benchmarks/bench_search.py
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_index import KnowledgeIndex  # noqa: E402
+
+VOCAB = (
+    "bios password dell hp lenovo acer asus laptop desktop server tablet mobile apple macbook "
+    "activation lock mdm blancco erasure wipe drive ssd nvme hdd raid boot menu usb stick "
+    "battery charger screen keyboard grading quarantine firmware tpm secure recovery master "
+    "serial rfid tote pallet engineer diagnose refurbish cable label intake customer report"
+).split()
+
+QUERIES = [
+    "how do I wipe a locked HP laptop",
+    "bios password dell",
+    "blancco erasure failed on nvme drive",
+    "macbook activation lock",
+    "quarantine rules",
+    # typos, served by the fuzzy trigram path
+    "bois password",
+    "blanco failed",
+    "macbok activation lock",
+]
+
+
+def make_corpus(size: int, seed: int = 42) -> list[dict]:
+    # warehouse jargon plus a long tail of model numbers, drawn with a Zipf-like skew
+    rng = random.Random(seed)
+    words = VOCAB + [f"model{i}" for i in range(5000)]
+    weights = [1.0 / (rank + 1) for rank in range(len(words))]
+    return [{
+        'name': " ".join(rng.choices(words, weights, k=4)),
+        'description': " ".join(rng.choices(words, weights, k=40)),
+        'keywords': rng.choices(words, weights, k=5),
+    } for _ in range(size)]
+
+
+def bench(size: int, repeat: int = 20) -> None:
+    corpus = make_corpus(size)
+    t0 = time.perf_counter()
+    index = KnowledgeIndex(corpus)
+    build = time.perf_counter() - t0
+    extra = iter(make_corpus(repeat * len(QUERIES), seed=7))
+
+    def timed(prepare=None) -> float:
+        """ms per query, calling prepare() (untimed) before each one"""
+        total = 0.0
+        for _ in range(repeat):
+            for q in QUERIES:
+                if prepare is not None:
+                    prepare()
+                t0 = time.perf_counter()
+                index.search(q, 5)
+                total += time.perf_counter() - t0
+        return total / (repeat * len(QUERIES)) * 1000
+
+    # cold: no cached term weights; after add: one new entry just went in; warm: repeated queries
+    cold = timed(index._clear_weights)
+    warm = timed()
+    after_add = timed(lambda: index.add(next(extra)))
+    print(f"{size:>7} entries  build {build * 1000:9.1f} ms  search cold {cold:8.3f}  "
+          f"after add {after_add:8.3f}  warm {warm:8.3f} ms/query")
+
+
+if __name__ == "__main__":
+    for size in (1_000, 10_000, 100_000):
+        bench(size)
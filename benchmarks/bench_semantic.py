@@ -0,0 +1,40 @@
+"""
+Benchmark: local semantic retrieval (hashed n-gram vectors, one matrix-vector product)
+Run from the repo root: python benchmarks/bench_semantic.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import semantic  # noqa: E402
+from bench_search import QUERIES, make_corpus  # noqa: E402
+
+
+def bench(size: int, repeat: int = 20) -> None:
+    corpus = make_corpus(size)
+    t0 = time.perf_counter()
+    index = semantic.VectorIndex()
+    index.extend([(f"{d['name']} {' '.join(d['keywords'])} {d['description']}", d, i) for i, d in enumerate(corpus)])
+    build = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    index.add("Erasure: HP laptops wipe with Blancco", {'name': 'extra'}, key=size)
+    add = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for q in QUERIES:
+            index.search(q, 5)
+    per_query = (time.perf_counter() - t0) / (repeat * len(QUERIES))
+    print(f"{size:>7} entries  build {build * 1000:9.1f} ms  add {add * 1000:6.3f} ms  "
+          f"search {per_query * 1000:8.3f} ms/query")
+
+
+if __name__ == "__main__":
+    if not semantic.available:
+        sys.exit("numpy is not installed")
+    for size in (1_000, 10_000, 100_000):
+        bench(size)
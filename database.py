@@ -3,11 +3,18 @@ Database models for multi-user Greenie
 SQLAlchemy ORM models for PostgreSQL
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, Float, DateTime, ForeignKey, Index
+from sqlalchemy import create_engine, Column, Boolean, Integer, String, Text, Float, DateTime, ForeignKey, Index, bindparam, false, func, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from datetime import datetime, timezone
+from knowledge_index import KnowledgeIndex, MemoryIndex, FUZZY_MAX_EXPANSIONS, FUZZY_MIN_LENGTH, STOPWORDS, SYSTEM_KEYWORDS, analyze, merge_scored, stem, tokenize, word_similarity
+import semantic
+from prompt_budget import estimate_tokens
+from cache import LRUCache
+from write_behind import WriteBehindQueue
+import logging
 import os
+import threading
 
 Base = declarative_base()
 
@@ -29,6 +36,22 @@ engine = create_engine(
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Knowledge search backend:
+#   "memory"   - per-process BM25 index (default)
+#   "database" - rank inside the database (SQLite FTS5 / PostgreSQL tsvector, or an
+#                indexed keyword join without full-text support), consistent across
+#                workers without any in-process state
+SEARCH_BACKEND = os.environ.get("GREENIE_SEARCH_BACKEND", "memory").lower()
+
+# Set by init_db() to "sqlite" or "postgresql" once the full-text objects exist
+fulltext_dialect: str | None = None
+# Set by init_db() when a trigram index (FTS5 trigram table or pg_trgm) can serve fuzzy matches
+trigram_available = False
+TRIGRAM_MIN_SIMILARITY = 0.4
+TRIGRAM_CANDIDATES = 50  # entries whose names and keywords are scored per misspelled word
+
+logger = logging.getLogger('greenie')
+
 
 class User(Base):
     """User accounts for multi-user support"""
@@ -56,6 +79,8 @@ class Memory(Base):
     text = Column(Text, nullable=False)
     timestamp = Column(Float, nullable=False)  # Unix timestamp for compatibility
     created_at = Column(DateTime, default=datetime.utcnow)
+    kind = Column(String(16), nullable=False, default="raw", server_default="raw")  # 'raw' or 'digest'
+    content_hash = Column(String(64))  # hash of the normalized text (raw memories), see _memory_hash
     
     # Relationship
     user = relationship("User", back_populates="memories")
@@ -63,6 +88,8 @@ class Memory(Base):
     # Index for fast queries
     __table_args__ = (
         Index('idx_user_timestamp', 'user_id', 'timestamp'),
+        Index('idx_user_kind_timestamp', 'user_id', 'kind', 'timestamp'),
+        Index('idx_user_memory_hash', 'user_id', 'content_hash'),
     )
 
 
@@ -74,18 +101,54 @@ class Knowledge(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     name = Column(String(255), nullable=False)
     description = Column(Text, nullable=False)
-    keywords = Column(Text)  # JSON string of keywords list
+    keywords = Column(Text)  # JSON copy of the keywords list, kept for the full-text index; read keyword_rows instead
+    seed_key = Column(String(255), nullable=True)  # stable id of entries loaded from knowledge_seed.json
+    content_hash = Column(String(64), nullable=True)  # sha256 of name/description/keywords, for seed upserts
+    shared = Column(Boolean, nullable=False, default=False, server_default=false())  # global corpus, visible to every user
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationship
     user = relationship("User", back_populates="knowledge")
+    keyword_rows = relationship(
+        "KnowledgeKeyword", back_populates="knowledge",
+        cascade="all, delete-orphan", order_by="KnowledgeKeyword.position"
+    )
     
-    # Index for fast searches
     __table_args__ = (
-        Index('idx_user_keywords', 'user_id', 'keywords'),
+        Index('idx_user_seed_key', 'user_id', 'seed_key'),
+        Index('idx_knowledge_shared', 'shared'),
     )
 
 
+class KnowledgeKeyword(Base):
+    """One keyword of a knowledge entry, so keyword lookups can use an index"""
+    __tablename__ = "knowledge_keywords"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    knowledge_id = Column(Integer, ForeignKey("knowledge.id", ondelete="CASCADE"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    keyword = Column(String(255), nullable=False)  # lowercased for matching
+    original = Column(String(255), nullable=False)  # as entered, returned to clients
+    position = Column(Integer, nullable=False, default=0)
+    
+    # Relationship
+    knowledge = relationship("Knowledge", back_populates="keyword_rows")
+    
+    # Index for keyword lookups
+    __table_args__ = (
+        Index('idx_user_keyword', 'user_id', 'keyword'),
+    )
+
+
+def keyword_rows_for(user_id: int, keywords: list[str] | None) -> list[KnowledgeKeyword]:
+    """Build the child rows for a knowledge entry's keyword list"""
+    return [
+        KnowledgeKeyword(user_id=user_id, keyword=kw.strip().lower()[:255], original=kw[:255], position=i)
+        for i, kw in enumerate(keywords or [])
+        if kw and kw.strip()
+    ]
+
+
 class Session(Base):
     """Session storage for ephemeral conversation history"""
     __tablename__ = "sessions"
@@ -128,6 +191,15 @@ class ErrorLog(Base):
     )
 
 
+class AppState(Base):
+    """Small key/value store for application bookkeeping (e.g. the loaded seed hash)"""
+    __tablename__ = "app_state"
+    
+    key = Column(String(100), primary_key=True)
+    value = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
 # Database helper functions
 def get_db():
     """Dependency for FastAPI endpoints to get database session"""
@@ -141,6 +213,265 @@ def get_db():
 def init_db():
     """Initialize database tables"""
     Base.metadata.create_all(bind=engine)
+    ensure_columns(Memory, ("kind", "content_hash"))
+    added = ensure_columns(Knowledge, ("seed_key", "content_hash", "shared"))
+    if "shared" in added:
+        # the seed used to be loaded as user 1's private knowledge; it is the shared corpus now
+        with engine.begin() as conn:
+            conn.execute(Knowledge.__table__.update().where(Knowledge.seed_key.isnot(None)).values(shared=True))
+    migrate_knowledge_keywords()
+    dedupe_memories()
+    init_fulltext()
+
+
+def ensure_columns(model, names: tuple[str, ...]) -> list[str]:
+    """Add columns that were introduced after the table was first created.
+    create_all() never alters existing tables, so this covers upgrades in place;
+    the model's indexes are created afterwards if missing. Returns the columns added.
+    """
+    from sqlalchemy import inspect
+    table = model.__table__
+    existing = {col["name"] for col in inspect(engine).get_columns(table.name)}
+    added = [name for name in names if name not in existing]
+    with engine.begin() as conn:
+        for name in added:
+            column = table.c[name]
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(dialect=engine.dialect)}"
+            if column.server_default is not None:
+                default = column.server_default.arg
+                if isinstance(default, str):
+                    default = f"'{default}'"
+                else:
+                    default = str(default.compile(dialect=engine.dialect))
+                ddl += f" DEFAULT {default}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            conn.execute(text(ddl))
+    if added:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+        logger.info("Added columns %s to %s", ", ".join(added), table.name)
+    return added
+
+
+def migrate_knowledge_keywords(batch_size: int = 1000) -> int:
+    """Backfill knowledge_keywords from the legacy JSON keywords column.
+    Only entries without any keyword rows are touched, so this is safe to run on every start.
+    Returns the number of keyword rows written.
+    """
+    import json
+    written = 0
+    with engine.begin() as conn:
+        # the old composite index on the JSON text could never serve a lookup
+        conn.execute(text("DROP INDEX IF EXISTS idx_user_keywords"))
+        rows = conn.execute(text(
+            "SELECT k.id, k.user_id, k.keywords FROM knowledge k "
+            "WHERE k.keywords IS NOT NULL AND k.keywords NOT IN ('', '[]') "
+            "AND NOT EXISTS (SELECT 1 FROM knowledge_keywords kk WHERE kk.knowledge_id = k.id)"
+        )).all()
+        batch = []
+        for knowledge_id, user_id, raw in rows:
+            try:
+                keywords = json.loads(raw)
+            except ValueError:
+                continue
+            for kw in keyword_rows_for(user_id, keywords if isinstance(keywords, list) else []):
+                batch.append({
+                    "knowledge_id": knowledge_id, "user_id": user_id,
+                    "keyword": kw.keyword, "original": kw.original, "position": kw.position
+                })
+            if len(batch) >= batch_size:
+                conn.execute(KnowledgeKeyword.__table__.insert(), batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            conn.execute(KnowledgeKeyword.__table__.insert(), batch)
+            written += len(batch)
+    if written:
+        logger.info("Backfilled %d knowledge keyword rows", written)
+    return written
+
+
+MEMORY_DEDUPE_STATE = "migration:memory_content_hash:v2"
+
+
+def dedupe_memories(batch_size: int = 1000) -> int:
+    """One-off migration: (re)hash every raw memory with the current _memory_hash, then collapse
+    each user's duplicates into the newest copy. An app_state flag records that it has run; its
+    key is versioned so a change to the normalization rehashes the rows hashed the old way.
+    Returns the number of duplicate rows deleted.
+    """
+    from sqlalchemy import select
+    from sqlalchemy.exc import IntegrityError
+    table = Memory.__table__
+    with engine.begin() as conn:
+        if conn.execute(select(AppState.value).where(AppState.key == MEMORY_DEDUPE_STATE)).first() is not None:
+            return 0
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(table.c.id, table.c.text).where(table.c.kind == "raw", table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            conn.execute(
+                table.update().where(table.c.id == bindparam("mem_id")).values(content_hash=bindparam("hash")),
+                [{"mem_id": mem_id, "hash": _memory_hash(content)} for mem_id, content in rows]
+            )
+            last_id = rows[-1].id
+    try:
+        doomed = _collapse_duplicate_memories(batch_size)
+    except IntegrityError:
+        # another process ran the migration at the same time and set the flag first
+        logger.info("Memory dedupe migration already done by another process")
+        return 0
+    if doomed:
+        logger.info("Collapsed %d duplicate memories", doomed)
+    return doomed
+
+
+def _collapse_duplicate_memories(batch_size: int) -> int:
+    """Delete all but the newest copy of each user's duplicate raw memories and set the migration
+    flag, in one transaction (rolled back if the flag is already there); returns the rows deleted"""
+    from sqlalchemy import delete, select
+    table = Memory.__table__
+    with engine.begin() as conn:
+        dupes = select(table.c.user_id, table.c.content_hash).where(
+            table.c.kind == "raw", table.c.content_hash.isnot(None)
+        ).group_by(table.c.user_id, table.c.content_hash).having(func.count() > 1).subquery()
+        rows = conn.execute(
+            select(table.c.id, table.c.user_id, table.c.content_hash).join(
+                dupes, (table.c.user_id == dupes.c.user_id) & (table.c.content_hash == dupes.c.content_hash)
+            ).where(table.c.kind == "raw").order_by(
+                table.c.user_id, table.c.content_hash, table.c.timestamp.desc(), table.c.id.desc()
+            )
+        ).all()
+        seen, doomed = set(), []
+        for mem_id, user_id, content_hash in rows:
+            if (user_id, content_hash) in seen:
+                doomed.append(mem_id)
+            seen.add((user_id, content_hash))
+        for i in range(0, len(doomed), batch_size):
+            conn.execute(delete(table).where(table.c.id.in_(doomed[i:i + batch_size])))
+        conn.execute(AppState.__table__.insert().values(key=MEMORY_DEDUPE_STATE, value=str(len(doomed))))
+    return len(doomed)
+
+
+def init_fulltext() -> str | None:
+    """Create the full-text search objects for the knowledge table if the database supports them.
+    SQLite gets an external-content FTS5 table kept in sync by triggers; PostgreSQL gets a
+    generated, GIN-indexed tsvector column. Returns the dialect name, or None if unavailable.
+    """
+    global fulltext_dialect
+    dialect = engine.dialect.name
+    try:
+        with engine.begin() as conn:
+            if dialect == "sqlite":
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'knowledge_fts'"
+                )).first()
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_fts USING fts5("
+                    "name, keywords, description, "
+                    "content='knowledge', content_rowid='id', tokenize='porter unicode61')"
+                ))
+                conn.execute(text(
+                    "CREATE TRIGGER IF NOT EXISTS knowledge_fts_ai AFTER INSERT ON knowledge BEGIN "
+                    "INSERT INTO knowledge_fts(rowid, name, keywords, description) "
+                    "VALUES (new.id, new.name, new.keywords, new.description); END"
+                ))
+                conn.execute(text(
+                    "CREATE TRIGGER IF NOT EXISTS knowledge_fts_ad AFTER DELETE ON knowledge BEGIN "
+                    "INSERT INTO knowledge_fts(knowledge_fts, rowid, name, keywords, description) "
+                    "VALUES ('delete', old.id, old.name, old.keywords, old.description); END"
+                ))
+                conn.execute(text(
+                    "CREATE TRIGGER IF NOT EXISTS knowledge_fts_au AFTER UPDATE ON knowledge BEGIN "
+                    "INSERT INTO knowledge_fts(knowledge_fts, rowid, name, keywords, description) "
+                    "VALUES ('delete', old.id, old.name, old.keywords, old.description); "
+                    "INSERT INTO knowledge_fts(rowid, name, keywords, description) "
+                    "VALUES (new.id, new.name, new.keywords, new.description); END"
+                ))
+                if not exists:
+                    # first run against an existing database: index the rows already there
+                    conn.execute(text("INSERT INTO knowledge_fts(knowledge_fts) VALUES ('rebuild')"))
+            elif dialect == "postgresql":
+                conn.execute(text(
+                    "ALTER TABLE knowledge ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                    "GENERATED ALWAYS AS ("
+                    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+                    "setweight(to_tsvector('english', coalesce(keywords, '')), 'B') || "
+                    "setweight(to_tsvector('english', coalesce(description, '')), 'C')"
+                    ") STORED"
+                ))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS idx_knowledge_search ON knowledge USING GIN (search_vector)"
+                ))
+            else:
+                return None
+        fulltext_dialect = dialect
+    except Exception as e:
+        # e.g. SQLite built without FTS5; search falls back to the keyword join
+        logger.warning("Full-text search unavailable on %s: %s", dialect, e)
+        fulltext_dialect = None
+    if fulltext_dialect is not None:
+        init_trigram()
+    return fulltext_dialect
+
+
+def init_trigram() -> bool:
+    """Index knowledge names and keywords by character trigrams for typo-tolerant lookups.
+    SQLite gets a second external-content FTS5 table with the trigram tokenizer (SQLite 3.34+);
+    PostgreSQL gets pg_trgm GIN indexes, which needs permission to create the extension.
+    Without them misspelled words are simply not corrected.
+    """
+    global trigram_available
+    dialect = engine.dialect.name
+    try:
+        with engine.begin() as conn:
+            if dialect == "sqlite":
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'knowledge_trgm'"
+                )).first()
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_trgm USING fts5("
+                    "name, keywords, content='knowledge', content_rowid='id', tokenize='trigram')"
+                ))
+                conn.execute(text(
+                    "CREATE TRIGGER IF NOT EXISTS knowledge_trgm_ai AFTER INSERT ON knowledge BEGIN "
+                    "INSERT INTO knowledge_trgm(rowid, name, keywords) VALUES (new.id, new.name, new.keywords); END"
+                ))
+                conn.execute(text(
+                    "CREATE TRIGGER IF NOT EXISTS knowledge_trgm_ad AFTER DELETE ON knowledge BEGIN "
+                    "INSERT INTO knowledge_trgm(knowledge_trgm, rowid, name, keywords) "
+                    "VALUES ('delete', old.id, old.name, old.keywords); END"
+                ))
+                conn.execute(text(
+                    "CREATE TRIGGER IF NOT EXISTS knowledge_trgm_au AFTER UPDATE ON knowledge BEGIN "
+                    "INSERT INTO knowledge_trgm(knowledge_trgm, rowid, name, keywords) "
+                    "VALUES ('delete', old.id, old.name, old.keywords); "
+                    "INSERT INTO knowledge_trgm(rowid, name, keywords) VALUES (new.id, new.name, new.keywords); END"
+                ))
+                if not exists:
+                    conn.execute(text("INSERT INTO knowledge_trgm(knowledge_trgm) VALUES ('rebuild')"))
+            elif dialect == "postgresql":
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS idx_knowledge_keywords_trgm "
+                    "ON knowledge_keywords USING GIN (keyword gin_trgm_ops)"
+                ))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS idx_knowledge_name_trgm "
+                    "ON knowledge USING GIN (lower(name) gin_trgm_ops)"
+                ))
+            else:
+                return False
+        trigram_available = True
+    except Exception as e:
+        logger.warning("Trigram index unavailable on %s, misspelled words are not corrected: %s", dialect, e)
+        trigram_available = False
+    return trigram_available
 
 
 def drop_all():
@@ -148,6 +479,283 @@ def drop_all():
     Base.metadata.drop_all(bind=engine)
 
 
+# Per-user semantic vector indexes (only built when semantic retrieval is requested)
+_memory_vectors: dict[int, "semantic.VectorIndex"] = {}
+_knowledge_vectors: dict[int, "semantic.VectorIndex"] = {}
+_vectors_lock = threading.Lock()
+
+
+def _vector_index(registry: dict, user_id: int, load) -> "semantic.VectorIndex":
+    """Return the user's vector index from `registry`, building it from `load()` entries on first use"""
+    index = registry.get(user_id)
+    if index is not None:
+        return index
+    with _vectors_lock:
+        index = registry.get(user_id)
+        if index is None:
+            index = semantic.VectorIndex()
+            index.extend(load())
+            registry[user_id] = index
+        return index
+
+
+# Per-user memory recall indexes (BM25 with recency decay), built on first relevance-ranked recall
+# and rebuilt when another worker has changed the table (see DatabaseBackedMemory._recall_index)
+_memory_indexes: dict[int, MemoryIndex] = {}
+_memory_indexes_lock = threading.Lock()
+MEMORY_HALF_LIFE_DAYS = float(os.environ.get("GREENIE_MEMORY_HALF_LIFE_DAYS", "30"))
+MEMORY_TOKEN_BUDGET = int(os.environ.get("GREENIE_MEMORY_TOKEN_BUDGET", "400"))
+
+
+def _forget_memory_indexes(user_id: int) -> None:
+    """Drop a user's vector and recall indexes; both are rebuilt from the table on next use"""
+    with _vectors_lock:
+        _memory_vectors.pop(user_id, None)
+    with _memory_indexes_lock:
+        _memory_indexes.pop(user_id, None)
+
+
+# Memory retention is a ring buffer trimmed in arrears: a user may briefly hold up to
+# max_items + MEMORY_TRIM_EVERY rows (the high-water mark) before one DELETE cuts back to max_items
+MEMORY_TRIM_EVERY = 50
+MEMORY_MAX_DIGESTS = int(os.environ.get("GREENIE_MEMORY_MAX_DIGESTS", "100"))  # digests kept per user, besides max_items raw rows
+
+# Compaction folds a user's oldest raw memories into digests once they hold more than
+# MEMORY_COMPACT_KEEP raw rows, MEMORY_COMPACT_BATCH at a time (see compact_memories in app.py)
+MEMORY_COMPACT_KEEP = int(os.environ.get("GREENIE_COMPACT_KEEP", "200"))
+MEMORY_COMPACT_BATCH = int(os.environ.get("GREENIE_COMPACT_BATCH", "50"))
+_memory_inserts: dict[int, int] = {}  # inserts per user since their last trim in this process
+_memory_inserts_lock = threading.Lock()
+
+
+# sentence punctuation, quotes and brackets trimmed from either end of a memory before hashing;
+# symbols, dashes and signs stay, so "-5" and "5" or "C++" and "C#" remain different memories
+MEMORY_HASH_TRIM = ".,;:!?¡¿…\"'`´“”‘’„«»‹›()[]{}"
+
+
+def _memory_hash(text: str) -> str:
+    """Hash of a memory's normalized text (casefolded, whitespace collapsed, surrounding
+    punctuation trimmed), so "Hi!" and "hi" are the same memory"""
+    import hashlib
+    normalized = " ".join(text.casefold().split())
+    normalized = normalized.strip(MEMORY_HASH_TRIM).strip() or normalized
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def _store_memories(db, entries: list[tuple[int, str, float]]) -> tuple[list[tuple], list[tuple]]:
+    """Add-or-touch (user_id, text, timestamp) raw memories without committing.
+    A memory whose normalized text the user already has bumps that row's timestamp instead
+    of adding a row; repeats within `entries` collapse to their newest. Returns (inserted,
+    touched) as lists of (id, user_id, text, timestamp).
+    """
+    from sqlalchemy import insert, update
+    latest: dict[tuple[int, str], tuple[str, float]] = {}
+    for user_id, content, ts in entries:
+        key = (user_id, _memory_hash(content))
+        if key not in latest or ts >= latest[key][1]:
+            latest[key] = (content, ts)
+    existing: dict[tuple[int, str], tuple[int, str, float]] = {}
+    users = sorted({user_id for user_id, _ in latest})
+    hashes = sorted({content_hash for _, content_hash in latest})
+    for i in range(0, len(hashes), 500):
+        rows = db.query(Memory.id, Memory.user_id, Memory.content_hash, Memory.text, Memory.timestamp).filter(
+            Memory.kind == "raw", Memory.user_id.in_(users), Memory.content_hash.in_(hashes[i:i + 500])
+        )
+        for mem_id, user_id, content_hash, content, ts in rows:
+            if (user_id, content_hash) in latest:
+                existing[(user_id, content_hash)] = (mem_id, content, ts)
+    touched = []
+    for key, (mem_id, content, old_ts) in existing.items():
+        ts = latest[key][1]
+        if ts > old_ts:
+            touched.append((mem_id, key[0], content, ts))
+    if touched:
+        db.execute(update(Memory), [{'id': mem_id, 'timestamp': ts} for mem_id, _, _, ts in touched])
+    new = [(key, content, ts) for key, (content, ts) in latest.items() if key not in existing]
+    inserted = []
+    if new:
+        ids = db.scalars(
+            insert(Memory).returning(Memory.id, sort_by_parameter_order=True),
+            [{'user_id': user_id, 'text': content, 'timestamp': ts, 'content_hash': content_hash,
+              'created_at': datetime.utcnow()} for (user_id, content_hash), content, ts in new]
+        ).all()
+        inserted = [(mem_id, user_id, content, ts) for mem_id, ((user_id, _), content, ts) in zip(ids, new)]
+    return inserted, touched
+
+
+def _index_stored_memories(user_id: int, inserted: list[tuple], touched: list[tuple]) -> None:
+    """Apply one user's rows from _store_memories to their loaded vector and recall indexes"""
+    vectors = _memory_vectors.get(user_id)
+    if vectors is not None and inserted:
+        vectors.extend([(content, content, mem_id) for mem_id, _, content, _ in inserted])
+    recall = _memory_indexes.get(user_id)
+    if recall is not None:
+        for mem_id, _, content, ts in inserted:
+            recall.add(mem_id, content, ts)
+        for mem_id, _, _, ts in touched:
+            recall.touch(mem_id, ts)
+
+
+def _write_queued_memories(batch: list[tuple[int, str, float, int]]) -> None:
+    """Flush function of memory_writer: add-or-touch (user_id, text, timestamp, max_items) rows
+    for any number of users in one transaction, then trim the users that are due"""
+    db = SessionLocal()
+    try:
+        inserted, touched = _store_memories(db, [(user_id, text, ts) for user_id, text, ts, _ in batch])
+        db.commit()
+        max_items = {user_id: limit for user_id, _, _, limit in batch}
+        for user_id, limit in max_items.items():
+            own_inserted = [row for row in inserted if row[1] == user_id]
+            _index_stored_memories(user_id, own_inserted, [row for row in touched if row[1] == user_id])
+            memory = DatabaseBackedMemory(user_id, max_items=limit)
+            if own_inserted and memory._trim_due(len(own_inserted)):
+                memory._trim(db)
+    finally:
+        db.close()
+
+
+# Chat turns queue their memories here instead of writing them inline (see queue_memory)
+memory_writer = WriteBehindQueue(
+    "memories", _write_queued_memories,
+    max_batch=int(os.environ.get("GREENIE_WRITE_BATCH", "200")),
+    max_delay=float(os.environ.get("GREENIE_WRITE_DELAY", "0.5")),
+)
+
+
+def memory_compaction_candidates(after_user_id: int = 0, limit: int = 10,
+                                 keep: int = MEMORY_COMPACT_KEEP, size: int = MEMORY_COMPACT_BATCH) -> list[int]:
+    """Ids of users (greater than `after_user_id`, ascending) holding enough raw memories to compact"""
+    db = SessionLocal()
+    try:
+        rows = db.query(Memory.user_id).filter(
+            Memory.kind == "raw", Memory.user_id > after_user_id
+        ).group_by(Memory.user_id).having(func.count(Memory.id) >= keep + size).order_by(
+            Memory.user_id
+        ).limit(limit).all()
+        return [user_id for user_id, in rows]
+    finally:
+        db.close()
+
+
+def get_app_state(key: str) -> str | None:
+    db = SessionLocal()
+    try:
+        state = db.get(AppState, key)
+        return state.value if state is not None else None
+    finally:
+        db.close()
+
+
+def set_app_state(key: str, value: str) -> None:
+    db = SessionLocal()
+    try:
+        state = db.get(AppState, key)
+        if state is None:
+            db.add(AppState(key=key, value=value))
+        else:
+            state.value = value
+        db.commit()
+    finally:
+        db.close()
+
+
+def load_session(user_id: int, session_id: str) -> tuple[int, list[tuple], str | None] | None:
+    """(rev, [(role, text, ts), ...], rolling summary) of a stored conversation session, or None"""
+    import json
+    db = SessionLocal()
+    try:
+        raw = db.query(Session.session_data).filter(
+            Session.user_id == user_id, Session.session_id == session_id
+        ).scalar()
+    finally:
+        db.close()
+    if not raw:
+        return None
+    data = json.loads(raw)
+    if isinstance(data, list):  # bare list of {'role', 'text'} turns
+        return 0, [(turn.get('role'), turn.get('text', ''), 0.0) for turn in data], None
+    return data.get('rev', 0), [tuple(turn) for turn in data.get('turns', [])], data.get('summary')
+
+
+def _merge_turns(base: list, other: list) -> list:
+    """`base` turns plus the turns of `other` it lacks, in time order. Turns of `other` older than
+    the first turn of `base` are left out: those were trimmed or folded into the summary there."""
+    if not base:
+        return list(other)
+    known = {tuple(turn) for turn in base}
+    start = base[0][2]
+    extra = [tuple(turn) for turn in other if tuple(turn) not in known and turn[2] >= start]
+    if not extra:
+        return list(base)
+    return sorted([tuple(turn) for turn in base] + extra, key=lambda turn: turn[2])
+
+
+def _write_sessions(batch: list[tuple[int, str, int, list | None, str | None, float]]) -> None:
+    """Flush function of session_writer: save (user_id, session_id, rev, turns, summary, queued_at)
+    snapshots in one transaction; only the last snapshot per session is written.
+    Turns of None clear the session. The row is not deleted but emptied at the clear's rev and stamped
+    `cleared` with its queue time, so other workers holding the session in memory replace their copy on
+    the next re-read, and turns older than the clear are never written back (a pre-clear copy loses its
+    summary too). A stored copy written by another worker is merged rather than overwritten: the side
+    with the higher rev is kept and the other side's newer turns are added; when the result differs
+    from the snapshot, the rev is bumped past both so the writer's own hot copy is refreshed."""
+    import json
+    from sqlalchemy import or_, and_
+    latest = {}
+    cleared: dict[tuple[int, str], float] = {}
+    for user_id, session_id, rev, turns, summary, queued_at in batch:
+        key = (user_id, session_id)
+        if turns is None:
+            cleared[key] = queued_at
+            latest[key] = (rev, [], None)
+        else:
+            latest[key] = (rev, turns, summary)
+    db = SessionLocal()
+    try:
+        keys = list(latest)
+        rows = {(row.user_id, row.session_id): row for row in db.query(Session).filter(or_(*(
+            and_(Session.user_id == user_id, Session.session_id == session_id) for user_id, session_id in keys
+        )))}
+        for key in keys:
+            rev, snapshot, summary = latest[key]
+            row = rows.get(key)
+            stored = json.loads(row.session_data) if row is not None and row.session_data else None
+            if not isinstance(stored, dict):
+                stored = {}
+            clear = max(cleared.get(key, 0.0), stored.get('cleared') or 0.0)
+            turns = [tuple(turn) for turn in snapshot if turn[2] >= clear]
+            if len(turns) < len(snapshot):
+                summary = None  # the snapshot predates the clear
+            stored_rev = stored.get('rev', 0)
+            stored_turns = [tuple(turn) for turn in stored.get('turns', []) if turn[2] >= clear]
+            if stored_rev < rev:
+                merged = _merge_turns(turns, stored_turns)
+            else:
+                merged = _merge_turns(stored_turns, turns)
+                if merged == [tuple(turn) for turn in stored.get('turns', [])]:
+                    continue
+                summary = stored.get('summary')
+            if merged != [tuple(turn) for turn in snapshot]:
+                rev = max(rev, stored_rev) + 1
+            data = json.dumps({'rev': rev, 'turns': [list(turn) for turn in merged], 'summary': summary,
+                               'cleared': clear or None}, ensure_ascii=False)
+            if row is None:
+                db.add(Session(user_id=key[0], session_id=key[1], session_data=data))
+            else:
+                row.session_data = data
+        db.commit()
+    finally:
+        db.close()
+
+
+# Conversation sessions are saved through this queue so a chat turn never waits on the write
+session_writer = WriteBehindQueue(
+    "sessions", _write_sessions,
+    max_batch=int(os.environ.get("GREENIE_WRITE_BATCH", "200")),
+    max_delay=float(os.environ.get("GREENIE_WRITE_DELAY", "0.5")),
+)
+
+
 # For backwards compatibility with existing JSON-based code
 class DatabaseBackedMemory:
     """Memory class that uses database instead of JSON file"""
@@ -156,42 +764,277 @@ class DatabaseBackedMemory:
         self.user_id = user_id or 1  # Default to user 1 for single-user mode
         self.max_items = max_items
     
+    def _trim_due(self, inserted: int) -> bool:
+        """Count `inserted` new rows; True when the user is due a trim.
+        The first insert for a user in this process always trims, since rows written by
+        earlier processes (or other workers) are not counted here.
+        """
+        with _memory_inserts_lock:
+            pending = _memory_inserts.get(self.user_id)
+            if pending is not None and pending + inserted < MEMORY_TRIM_EVERY:
+                _memory_inserts[self.user_id] = pending + inserted
+                return False
+            _memory_inserts[self.user_id] = 0
+            return True
+    
     def add_memory(self, text: str) -> None:
-        """Add a memory for the user"""
+        """Add a memory for the user, or bump the timestamp of the one it repeats"""
         db = SessionLocal()
         try:
             import time
-            memory = Memory(
-                user_id=self.user_id,
-                text=text,
-                timestamp=time.time()
-            )
-            db.add(memory)
+            inserted, touched = _store_memories(db, [(self.user_id, text, time.time())])
+            db.commit()
+            _index_stored_memories(self.user_id, inserted, touched)
+            # Keep only most recent max_items (amortized, see MEMORY_TRIM_EVERY)
+            if inserted and self._trim_due(1):
+                self._trim(db)
+        finally:
+            db.close()
+    
+    def queue_memory(self, text: str) -> None:
+        """Add a memory through the write-behind queue: returns at once, written within
+        memory_writer.max_delay seconds. Readers of this instance see it immediately."""
+        import time
+        memory_writer.submit((self.user_id, text, time.time(), self.max_items))
+    
+    def _pending(self) -> list[tuple[float, str]]:
+        """(timestamp, text) of this user's memories still in the write-behind queue, oldest first"""
+        return [(ts, text) for user_id, text, ts, _ in memory_writer.pending(lambda item: item[0] == self.user_id)]
+    
+    def add_memories_bulk(self, entries: list[tuple[str, float | None]], trim: bool = True) -> int:
+        """Add-or-touch many (text, timestamp) memories in one transaction, then trim once
+        (unless `trim` is False: a caller writing several batches calls trim() after the last).
+        Missing timestamps are filled in so the entries keep their order. Returns the number
+        of entries stored (new rows plus repeats that touched an existing one).
+        """
+        if not entries:
+            return 0
+        import time
+        now = time.time()
+        db = SessionLocal()
+        try:
+            inserted, touched = _store_memories(db, [
+                (self.user_id, text, ts if ts is not None else now + i * 1e-6)
+                for i, (text, ts) in enumerate(entries)
+            ])
             db.commit()
-            
-            # Keep only most recent max_items
-            count = db.query(Memory).filter(Memory.user_id == self.user_id).count()
-            if count > self.max_items:
-                # Delete oldest memories
-                oldest = db.query(Memory).filter(
-                    Memory.user_id == self.user_id
-                ).order_by(Memory.timestamp.asc()).limit(count - self.max_items).all()
-                for m in oldest:
-                    db.delete(m)
-                db.commit()
+            if trim:
+                self._trim_due(len(inserted))
+                self._trim(db)
         finally:
             db.close()
+        # rebuilt from the table on next semantic lookup or recall
+        _forget_memory_indexes(self.user_id)
+        return len(entries)
+    
+    def trim(self) -> int:
+        """Cut the user back to max_items raw memories now; returns the number of rows deleted"""
+        self._trim_due(0)  # resets the user's insert count
+        db = SessionLocal()
+        try:
+            return self._trim(db)
+        finally:
+            db.close()
+    
+    def _trim(self, db) -> int:
+        """Delete everything but the newest max_items raw memories and MEMORY_MAX_DIGESTS digests
+        in one statement; returns the count"""
+        from sqlalchemy import delete, or_, select
+
+        def overflow(kind, keep):
+            return select(Memory.id).where(Memory.user_id == self.user_id, Memory.kind == kind).order_by(
+                Memory.timestamp.desc(), Memory.id.desc()
+            ).offset(keep)
+        stmt = delete(Memory).where(or_(
+            Memory.id.in_(overflow("raw", self.max_items)),
+            Memory.id.in_(overflow("digest", MEMORY_MAX_DIGESTS)),
+        ))
+        if engine.dialect.delete_returning:
+            trimmed = db.scalars(stmt.returning(Memory.id)).all()
+            count = len(trimmed)
+        else:
+            trimmed, count = None, db.execute(stmt).rowcount
+        db.commit()
+        if count:
+            if trimmed is None:
+                _forget_memory_indexes(self.user_id)
+            else:
+                for index in (_memory_vectors.get(self.user_id), _memory_indexes.get(self.user_id)):
+                    if index is not None:
+                        index.remove(trimmed)
+        return count
     
     def get_recent(self, n: int = 5) -> list[str]:
-        """Get recent memories for the user"""
+        """Get recent memories for the user (including ones still queued for writing)"""
+        pending = self._pending()
         db = SessionLocal()
         try:
-            memories = db.query(Memory).filter(
+            rows = db.query(Memory.timestamp, Memory.text).filter(
                 Memory.user_id == self.user_id
             ).order_by(Memory.timestamp.desc()).limit(n).all()
-            return [m.text for m in memories]
         finally:
             db.close()
+        if not pending:
+            return [content for _, content in rows]
+        # a batch may have been written (or have touched a stored repeat) between the two reads,
+        # so keep only the newest copy of each memory
+        merged: dict[str, tuple[float, str]] = {}
+        for ts, content in list(pending) + [tuple(row) for row in rows]:
+            key = _memory_hash(content)
+            if key not in merged or ts > merged[key][0]:
+                merged[key] = (ts, content)
+        return [content for _, content in sorted(merged.values(), key=lambda m: -m[0])[:n]]
+    
+    def iter_all(self, since: float | None = None, newest_first: bool = False, page_size: int = 500):
+        """Yield every memory as {'text', 'timestamp'}, a page at a time.
+        Keyset pagination on (timestamp, id) keeps each page an index range scan however
+        deep the export goes; `since` limits the output to memories newer than that unix time.
+        """
+        from sqlalchemy import and_, or_
+        db = SessionLocal()
+        try:
+            last = None
+            while True:
+                query = db.query(Memory.id, Memory.text, Memory.timestamp).filter(Memory.user_id == self.user_id)
+                if since is not None:
+                    query = query.filter(Memory.timestamp > since)
+                if last is not None:
+                    ts, mem_id = last
+                    if newest_first:
+                        query = query.filter(or_(Memory.timestamp < ts, and_(Memory.timestamp == ts, Memory.id < mem_id)))
+                    else:
+                        query = query.filter(or_(Memory.timestamp > ts, and_(Memory.timestamp == ts, Memory.id > mem_id)))
+                order = (Memory.timestamp.desc(), Memory.id.desc()) if newest_first else (Memory.timestamp.asc(), Memory.id.asc())
+                count = 0
+                # yield_per streams the page from a server-side cursor instead of buffering it
+                for row in query.order_by(*order).limit(page_size).yield_per(page_size):
+                    count += 1
+                    last = (row.timestamp, row.id)
+                    yield {'text': row.text, 'timestamp': row.timestamp}
+                if count < page_size:
+                    return
+        finally:
+            db.close()
+    
+    def semantic_search(self, query: str, n: int = 5) -> list[str]:
+        """Get the memories most similar to `query` (falls back to recent ones without numpy)"""
+        if not semantic.available:
+            return self.get_recent(n)
+        return _vector_index(_memory_vectors, self.user_id, self._load_vector_entries).search(query, n)
+    
+    def _load_vector_entries(self) -> list[tuple]:
+        db = SessionLocal()
+        try:
+            rows = db.query(Memory.id, Memory.text).filter(
+                Memory.user_id == self.user_id
+            ).order_by(Memory.timestamp.asc()).all()
+            return [(text, text, mem_id) for mem_id, text in rows]
+        finally:
+            db.close()
+    
+    def _recall_index(self) -> MemoryIndex:
+        """The user's recall index, rebuilt when the table no longer matches it.
+        Writes in this process keep the index current; rows added, trimmed or compacted by
+        other workers show up as a different row count or newest id, so one aggregate query
+        per recall is enough to notice them (timestamp-only touches are not noticed).
+        """
+        from sqlalchemy import func
+        db = SessionLocal()
+        try:
+            count, newest = db.query(func.count(Memory.id), func.max(Memory.id)).filter(
+                Memory.user_id == self.user_id
+            ).one()
+        finally:
+            db.close()
+        index = _memory_indexes.get(self.user_id)
+        if index is not None and len(index) == count and (newest is None or newest in index):
+            return index
+        with _memory_indexes_lock:
+            if _memory_indexes.get(self.user_id) is index:
+                _memory_indexes.pop(self.user_id, None)
+            index = _memory_indexes.get(self.user_id)
+            if index is None:
+                db = SessionLocal()
+                try:
+                    rows = db.query(Memory.id, Memory.text, Memory.timestamp).filter(
+                        Memory.user_id == self.user_id
+                    ).all()
+                finally:
+                    db.close()
+                index = MemoryIndex(rows)
+                _memory_indexes[self.user_id] = index
+            return index
+    
+    def recall(self, query: str, n: int = 5, token_budget: int | None = None,
+               half_life_days: float | None = None) -> list[str]:
+        """Get up to n memories relevant to `query`, ranked by BM25 with recency decay.
+        Memories are taken best first while they fit in `token_budget` (estimated tokens);
+        with nothing relevant this falls back to the most recent ones.
+        """
+        if n <= 0:
+            return []
+        budget = MEMORY_TOKEN_BUDGET if token_budget is None else token_budget
+        half_life = (half_life_days or MEMORY_HALF_LIFE_DAYS) * 86400
+        pending = [(content, ts) for ts, content in self._pending()]
+        hits = self._recall_index().search(query, n, half_life=half_life, extra=pending)
+        if not hits:
+            hits = [(0.0, content, 0.0) for content in self.get_recent(n)]
+        selected, used = [], 0
+        for _, content, _ in hits:
+            if content in selected:
+                continue
+            cost = estimate_tokens(content)
+            if used + cost > budget:
+                continue
+            selected.append(content)
+            used += cost
+        return selected
+    
+    def compaction_batch(self, keep: int = MEMORY_COMPACT_KEEP, size: int = MEMORY_COMPACT_BATCH) -> list[dict]:
+        """The oldest `size` raw memories beyond the newest `keep`, oldest first, as {'id', 'text', 'timestamp'}.
+        Empty until a full batch is available, so every digest covers the same number of memories.
+        """
+        db = SessionLocal()
+        try:
+            raw = db.query(Memory.id, Memory.text, Memory.timestamp).filter(
+                Memory.user_id == self.user_id, Memory.kind == "raw"
+            )
+            if raw.count() - keep < size:
+                return []
+            rows = raw.order_by(Memory.timestamp.asc(), Memory.id.asc()).limit(size).all()
+            return [{'id': mem_id, 'text': text, 'timestamp': ts} for mem_id, text, ts in rows]
+        finally:
+            db.close()
+    
+    def apply_digest(self, source_ids: list[int], digest: str, timestamp: float) -> bool:
+        """Replace the memories `source_ids` with one digest memory stamped `timestamp`, in one transaction.
+        Returns False (and changes nothing) if any source row is already gone, e.g. because another
+        worker compacted or trimmed it first, so applying the same batch twice is harmless.
+        """
+        from sqlalchemy import delete
+        db = SessionLocal()
+        try:
+            deleted = db.execute(delete(Memory).where(
+                Memory.user_id == self.user_id, Memory.kind == "raw", Memory.id.in_(source_ids)
+            )).rowcount
+            if deleted != len(set(source_ids)):
+                db.rollback()
+                return False
+            memory = Memory(user_id=self.user_id, text=digest, timestamp=timestamp, kind="digest")
+            db.add(memory)
+            db.commit()
+            digest_id = memory.id
+        finally:
+            db.close()
+        vectors = _memory_vectors.get(self.user_id)
+        if vectors is not None:
+            vectors.remove(source_ids)
+            vectors.add(digest, digest, key=digest_id)
+        recall = _memory_indexes.get(self.user_id)
+        if recall is not None:
+            recall.remove(source_ids)
+            recall.add(digest_id, digest, timestamp)
+        return True
     
     def clear(self) -> None:
         """Clear all memories for the user"""
@@ -201,6 +1044,241 @@ class DatabaseBackedMemory:
             db.commit()
         finally:
             db.close()
+        _forget_memory_indexes(self.user_id)
+
+
+# Per-user knowledge indexes, built lazily on first lookup and kept in sync by add_knowledge
+_knowledge_indexes: dict[int, KnowledgeIndex] = {}
+_knowledge_indexes_lock = threading.Lock()
+
+# The shared corpus (seed knowledge, shared=True) visible to every user: one index per
+# process, layered under each user's private index, which only holds their own entries
+_shared_index: KnowledgeIndex | None = None
+_shared_vectors: dict[None, "semantic.VectorIndex"] = {}
+
+
+# Per-user knowledge version, bumped on every change so derived caches can tell they are stale.
+# Process-local: other workers' writes are not seen (use GREENIE_SEARCH_BACKEND=database there).
+_knowledge_versions: dict[int, int] = {}
+_knowledge_versions_lock = threading.Lock()
+_knowledge_version_clock = 0   # every bump takes the next tick, so versions never repeat
+_knowledge_version_floor = 0   # tick of the last bump that applied to every user
+_shared_knowledge_version = 0  # tick of the last change to the shared corpus
+
+
+# Knowledge lookups per (user, version, n, normalized query). A version bump makes old keys
+# unreachable and purges them. With GREENIE_SEARCH_BACKEND=database the TTL bounds staleness
+# from writes in other workers, which the process-local version never sees. The default memory
+# backend gains nothing from the TTL: its indexes are built once per process and never see
+# those writes either, so it needs a single worker (see _knowledge_versions above).
+knowledge_search_cache = LRUCache(
+    "knowledge_search",
+    max_entries=int(os.environ.get("GREENIE_SEARCH_CACHE_ENTRIES", "2048")),
+    max_bytes=int(os.environ.get("GREENIE_SEARCH_CACHE_MB", "16")) * 1024 * 1024,
+    ttl=float(os.environ.get("GREENIE_SEARCH_CACHE_TTL", "300")),
+)
+
+
+def knowledge_version(user_id: int) -> int:
+    """Current knowledge version for a user, covering the shared corpus as well.
+    Ticks come from one clock, so the max moves whenever either layer changes.
+    """
+    return max(_knowledge_versions.get(user_id, 0), _knowledge_version_floor, _shared_knowledge_version)
+
+
+def bump_knowledge_version(user_id: int | None = None) -> None:
+    """Mark one user's (or every user's) knowledge as changed"""
+    global _knowledge_version_clock, _knowledge_version_floor
+    with _knowledge_versions_lock:
+        _knowledge_version_clock += 1
+        if user_id is None:
+            _knowledge_version_floor = _knowledge_version_clock
+        else:
+            _knowledge_versions[user_id] = _knowledge_version_clock
+    knowledge_search_cache.invalidate(None if user_id is None else (lambda key: key[0] == user_id))
+
+
+def bump_shared_knowledge_version() -> None:
+    """Mark the shared corpus as changed (which changes every user's version)"""
+    global _knowledge_version_clock, _shared_knowledge_version
+    with _knowledge_versions_lock:
+        _knowledge_version_clock += 1
+        _shared_knowledge_version = _knowledge_version_clock
+    knowledge_search_cache.invalidate()
+
+
+def invalidate_knowledge_index(user_id: int | None = None) -> None:
+    """Drop the cached index for one user (or all users) so it is rebuilt on next use.
+    The version is bumped after the drop, so nothing cached under it came from the old index.
+    """
+    with _knowledge_indexes_lock:
+        if user_id is None:
+            _knowledge_indexes.clear()
+        else:
+            _knowledge_indexes.pop(user_id, None)
+    with _vectors_lock:
+        if user_id is None:
+            _knowledge_vectors.clear()
+        else:
+            _knowledge_vectors.pop(user_id, None)
+    bump_knowledge_version(user_id)
+
+
+def invalidate_shared_knowledge() -> None:
+    """Drop the shared corpus index so it is rebuilt on next use (then bump, as above)"""
+    global _shared_index
+    with _knowledge_indexes_lock:
+        _shared_index = None
+    with _vectors_lock:
+        _shared_vectors.clear()
+    bump_shared_knowledge_version()
+
+
+def _load_knowledge(condition) -> list[dict]:
+    """Read the knowledge entries matching `condition` in id order, with their keywords"""
+    db = SessionLocal()
+    try:
+        results = db.query(Knowledge.id, Knowledge.name, Knowledge.description).filter(
+            condition
+        ).order_by(Knowledge.id.asc()).all()
+        keywords: dict[int, list[str]] = {}
+        for knowledge_id, original in db.query(KnowledgeKeyword.knowledge_id, KnowledgeKeyword.original).join(
+            Knowledge, Knowledge.id == KnowledgeKeyword.knowledge_id
+        ).filter(condition).order_by(KnowledgeKeyword.knowledge_id, KnowledgeKeyword.position):
+            keywords.setdefault(knowledge_id, []).append(original)
+        return [{
+            'name': name,
+            'description': description,
+            'keywords': keywords.get(knowledge_id, [])
+        } for knowledge_id, name, description in results]
+    finally:
+        db.close()
+
+
+def shared_knowledge_index() -> KnowledgeIndex:
+    """The process-wide index of the shared corpus, built on first use"""
+    global _shared_index
+    index = _shared_index
+    if index is not None:
+        return index
+    with _knowledge_indexes_lock:
+        if _shared_index is None:
+            _shared_index = KnowledgeIndex(_load_knowledge(Knowledge.shared.is_(True)))
+        return _shared_index
+
+
+def _shared_vector_entries() -> list[tuple]:
+    return [(_knowledge_text(item), item, None) for item in shared_knowledge_index().all()]
+
+
+def _covering_best(query: str, top: list[dict], min_coverage: float = 0.5,
+                   corrections: dict[str, list[str]] | None = None) -> dict | None:
+    """Top hit if it covers enough of the query terms (same rule as KnowledgeIndex.best_match).
+    A misspelled word counts as covered if one of its `corrections` is found.
+    """
+    groups: dict[str, set[str]] = {}
+    for word in tokenize(query):
+        if word not in STOPWORDS:
+            groups.setdefault(stem(word), set()).update(stem(w) for w in (corrections or {}).get(word, ()))
+    if not top or not groups:
+        return None
+    item = top[0]
+    found = set(analyze(f"{item['name']} {' '.join(item['keywords'])} {item['description']}"))
+    covered = sum(1 for term, alternatives in groups.items() if term in found or alternatives & found)
+    return item if covered / len(groups) >= min_coverage else None
+
+
+def _knowledge_text(item: dict) -> str:
+    """Text a knowledge entry is embedded from (name counted twice for weight)"""
+    return f"{item['name']} {item['name']} {' '.join(item['keywords'])} {item['description']}"
+
+
+def _content_hash(name: str, description: str, keywords: list[str]) -> str:
+    """Stable hash of a knowledge entry's content"""
+    import hashlib
+    import json
+    payload = json.dumps([name, description, list(keywords)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def sync_knowledge_seed(entries: list[dict], user_id: int = 1) -> dict:
+    """Make the shared corpus match `entries` (dicts with seed_key, name, description, keywords).
+    Seed rows are owned by `user_id` but flagged shared, so every user sees them.
+    Unchanged entries are skipped, changed ones updated in place, new ones inserted and ones no
+    longer in the seed deleted, all in one transaction. The hash of the whole seed is kept in
+    app_state, so a restart with an unchanged seed touches nothing else.
+    Returns counts of what was done.
+    """
+    import hashlib
+    import json
+    from sqlalchemy.orm import selectinload
+    hashes = {e['seed_key']: _content_hash(e['name'], e['description'], e['keywords']) for e in entries}
+    seed_hash = hashlib.sha256(json.dumps(sorted(hashes.items())).encode('utf-8')).hexdigest()
+    state_key = f"knowledge_seed:{user_id}"
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0, 'skipped': False}
+    db = SessionLocal()
+    try:
+        state = db.get(AppState, state_key)
+        if state is not None and state.value == seed_hash:
+            counts['skipped'] = True
+            return counts
+        by_key = {row.seed_key: row for row in db.query(Knowledge).options(selectinload(Knowledge.keyword_rows)).filter(
+            Knowledge.user_id == user_id, Knowledge.seed_key.isnot(None)
+        )}
+        # Seed rows written before seeds were tracked (one more copy on every restart):
+        # the oldest copy is adopted, the rest are deleted
+        legacy: dict[str, list[Knowledge]] = {}
+        for row in db.query(Knowledge).options(selectinload(Knowledge.keyword_rows)).filter(
+            Knowledge.user_id == user_id, Knowledge.seed_key.is_(None),
+            Knowledge.name.in_({e['name'] for e in entries})
+        ).order_by(Knowledge.id.asc()):
+            legacy.setdefault(row.name, []).append(row)
+        
+        for entry in entries:
+            key, content_hash = entry['seed_key'], hashes[entry['seed_key']]
+            row = by_key.pop(key, None)
+            if row is None and legacy.get(entry['name']):
+                row = legacy[entry['name']].pop(0)
+                row.seed_key = key
+                row.shared = True
+            if row is None:
+                db.add(Knowledge(
+                    user_id=user_id,
+                    name=entry['name'],
+                    description=entry['description'],
+                    keywords=json.dumps(entry['keywords']),
+                    seed_key=key,
+                    content_hash=content_hash,
+                    shared=True,
+                    keyword_rows=keyword_rows_for(user_id, entry['keywords'])
+                ))
+                counts['inserted'] += 1
+            elif row.content_hash == content_hash:
+                counts['unchanged'] += 1
+            else:
+                row.name = entry['name']
+                row.description = entry['description']
+                row.keywords = json.dumps(entry['keywords'])
+                row.content_hash = content_hash
+                row.keyword_rows = keyword_rows_for(user_id, entry['keywords'])
+                counts['updated'] += 1
+        
+        for row in list(by_key.values()) + [dupe for dupes in legacy.values() for dupe in dupes]:
+            db.delete(row)
+            counts['deleted'] += 1
+        if state is None:
+            db.add(AppState(key=state_key, value=seed_hash))
+        else:
+            state.value = seed_hash
+        db.commit()
+    finally:
+        db.close()
+    
+    if counts['inserted'] or counts['updated'] or counts['deleted']:
+        invalidate_shared_knowledge()
+        # adopted legacy rows just left the owner's private index
+        invalidate_knowledge_index(user_id)
+    return counts
 
 
 class DatabaseBackedKnowledgeStore:
@@ -209,8 +1287,48 @@ class DatabaseBackedKnowledgeStore:
     def __init__(self, user_id: int | None = None):
         self.user_id = user_id or 1  # Default to user 1 for single-user mode
     
-    def add_knowledge(self, name: str, description: str, keywords: list[str] | None = None) -> None:
-        """Add knowledge entry"""
+    @property
+    def version(self) -> int:
+        """Changes whenever this user's knowledge changes"""
+        return knowledge_version(self.user_id)
+    
+    def _private(self):
+        """Filter for the user's own entries (the shared corpus excluded)"""
+        return (Knowledge.user_id == self.user_id) & Knowledge.shared.is_(False)
+    
+    def _visible(self):
+        """Filter for everything the user can see: their own entries plus the shared corpus"""
+        return (Knowledge.user_id == self.user_id) | Knowledge.shared.is_(True)
+    
+    def _load_items(self) -> list[dict]:
+        """Read the user's private knowledge entries from the database"""
+        return _load_knowledge(self._private())
+    
+    def _keywords_by_id(self, db, knowledge_ids: list[int]) -> dict[int, list[str]]:
+        """Keyword lists keyed by knowledge id"""
+        query = db.query(KnowledgeKeyword.knowledge_id, KnowledgeKeyword.original).filter(
+            KnowledgeKeyword.knowledge_id.in_(knowledge_ids)
+        )
+        keywords: dict[int, list[str]] = {}
+        for knowledge_id, original in query.order_by(KnowledgeKeyword.knowledge_id, KnowledgeKeyword.position):
+            keywords.setdefault(knowledge_id, []).append(original)
+        return keywords
+    
+    def _index(self) -> KnowledgeIndex:
+        """Return the user's private in-process index, building it on first use"""
+        index = _knowledge_indexes.get(self.user_id)
+        if index is not None:
+            return index
+        with _knowledge_indexes_lock:
+            index = _knowledge_indexes.get(self.user_id)
+            if index is None:
+                index = KnowledgeIndex(self._load_items())
+                _knowledge_indexes[self.user_id] = index
+            return index
+    
+    def add_knowledge(self, name: str, description: str, keywords: list[str] | None = None,
+                      shared: bool = False) -> None:
+        """Add knowledge entry (to the shared corpus instead of the user's own if `shared`)"""
         db = SessionLocal()
         try:
             import json
@@ -218,62 +1336,299 @@ class DatabaseBackedKnowledgeStore:
                 user_id=self.user_id,
                 name=name,
                 description=description,
-                keywords=json.dumps(keywords or [])
+                keywords=json.dumps(keywords or []),
+                shared=shared,
+                keyword_rows=keyword_rows_for(self.user_id, keywords)
             )
             db.add(knowledge)
             db.commit()
         finally:
             db.close()
+        
+        if shared:
+            index, vectors = _shared_index, _shared_vectors.get(None)
+        else:
+            index, vectors = _knowledge_indexes.get(self.user_id), _knowledge_vectors.get(self.user_id)
+        # Keep already-built indexes current; unbuilt ones will pick the row up when loaded
+        item = {'name': name, 'description': description, 'keywords': list(keywords or [])}
+        if index is not None:
+            index.add(item)
+        if vectors is not None:
+            vectors.add(_knowledge_text(item), item)
+        # bump only once the indexes have the entry: a lookup in between would otherwise
+        # cache results without it under the new version
+        if shared:
+            bump_shared_knowledge_version()
+        else:
+            bump_knowledge_version(self.user_id)
     
-    def search(self, query: str, n: int = 5) -> list[dict]:
-        """Search knowledge base"""
+    def add_knowledge_bulk(self, items: list[dict]) -> int:
+        """Insert many knowledge entries (dicts with name/description/keywords) in one transaction.
+        Entries and their keyword rows each go in with a single executemany. Returns the number inserted.
+        """
+        if not items:
+            return 0
+        import json
+        from sqlalchemy import insert
         db = SessionLocal()
         try:
-            import json
-            # Simple case-insensitive search
-            query_lower = query.lower()
-            results = db.query(Knowledge).filter(
-                Knowledge.user_id == self.user_id
+            ids = db.scalars(
+                insert(Knowledge).returning(Knowledge.id, sort_by_parameter_order=True),
+                [{
+                    'user_id': self.user_id,
+                    'name': item['name'],
+                    'description': item['description'],
+                    'keywords': json.dumps(item.get('keywords') or []),
+                    'created_at': datetime.utcnow(),
+                } for item in items]
             ).all()
-            
-            # Score and filter results
-            scored = []
-            for k in results:
-                score = 0
-                if query_lower in k.name.lower():
-                    score += 10
-                if query_lower in k.description.lower():
-                    score += 5
-                keywords = json.loads(k.keywords) if k.keywords else []
-                for kw in keywords:
-                    if query_lower in kw.lower():
-                        score += 3
-                
-                if score > 0:
-                    scored.append((score, {
-                        'name': k.name,
-                        'description': k.description,
-                        'keywords': keywords
-                    }))
-            
-            # Sort by score and return top n
-            scored.sort(reverse=True, key=lambda x: x[0])
-            return [item[1] for item in scored[:n]]
+            keyword_rows = [{
+                'knowledge_id': knowledge_id, 'user_id': self.user_id,
+                'keyword': kw.keyword, 'original': kw.original, 'position': kw.position
+            } for knowledge_id, item in zip(ids, items) for kw in keyword_rows_for(self.user_id, item.get('keywords'))]
+            if keyword_rows:
+                db.execute(insert(KnowledgeKeyword), keyword_rows)
+            db.commit()
         finally:
             db.close()
+        # cheaper to rebuild once than to add thousands of items one by one
+        invalidate_knowledge_index(self.user_id)
+        return len(ids)
     
-    def list_all(self) -> list[dict]:
-        """List all knowledge entries"""
+    def _use_database(self) -> bool:
+        return SEARCH_BACKEND == "database"
+    
+    def _search_database(self, query: str, n: int) -> tuple[list[dict], dict[str, list[str]]]:
+        """Rank inside the database and fetch only the top-n rows.
+        Uses the full-text index when available, otherwise an indexed keyword join.
+        Returns (rows, corrections): with a trigram index, misspelled words are also searched
+        as the most similar words of entry names and keywords, listed in corrections.
+        """
+        terms = [t for t in dict.fromkeys(tokenize(query)) if t not in STOPWORDS]
+        if not terms or n <= 0:
+            return [], {}
+        params = {"user_id": self.user_id, "n": n}
+        corrections: dict[str, list[str]] = {}
         db = SessionLocal()
         try:
-            import json
-            results = db.query(Knowledge).filter(
-                Knowledge.user_id == self.user_id
-            ).all()
+            if fulltext_dialect == "sqlite":
+                sql = text(
+                    "SELECT k.id, k.name, k.description FROM knowledge_fts "
+                    "JOIN knowledge k ON k.id = knowledge_fts.rowid "
+                    "WHERE knowledge_fts MATCH :q AND (k.user_id = :user_id OR k.shared) "
+                    "ORDER BY bm25(knowledge_fts, 3.0, 2.0, 1.0), k.id LIMIT :n"
+                )
+                if trigram_available:
+                    corrections = self._trigram_corrections(db, terms)
+                extra = [w for words in corrections.values() for w in words]
+                params["q"] = " OR ".join(f'"{t}"' for t in dict.fromkeys(terms + extra))
+            elif fulltext_dialect == "postgresql":
+                sql = text(
+                    "SELECT id, name, description FROM knowledge "
+                    "WHERE (user_id = :user_id OR shared) AND search_vector @@ to_tsquery('english', :q) "
+                    "ORDER BY ts_rank_cd(search_vector, to_tsquery('english', :q)) DESC, id LIMIT :n"
+                )
+                if trigram_available:
+                    corrections = self._trigram_corrections(db, terms)
+                extra = [w for words in corrections.values() for w in words]
+                params["q"] = " | ".join(dict.fromkeys(terms + extra))
+            else:
+                # no full-text support: rank by how many query terms are keywords of the entry
+                sql = text(
+                    "SELECT k.id, k.name, k.description FROM knowledge_keywords kk "
+                    "JOIN knowledge k ON k.id = kk.knowledge_id "
+                    "WHERE kk.keyword IN :terms AND (kk.user_id = :user_id OR k.shared) "
+                    "GROUP BY k.id, k.name, k.description "
+                    "ORDER BY COUNT(*) DESC, k.id LIMIT :n"
+                ).bindparams(bindparam("terms", expanding=True))
+                params["terms"] = terms + [query.strip().lower()]
+            rows = db.execute(sql, params).all()
+            keywords = self._keywords_by_id(db, [row[0] for row in rows])
+            return [{
+                'name': name,
+                'description': description,
+                'keywords': keywords.get(knowledge_id, [])
+            } for knowledge_id, name, description in rows], corrections
+        finally:
+            db.close()
+    
+    def _trigram_corrections(self, db, terms: list[str]) -> dict[str, list[str]]:
+        """Closest words of entry names and keywords for each query word no visible entry contains.
+        The trigram index narrows the candidates in the database; they are scored like the
+        in-process fuzzy lookup (trigram similarity, or one edit apart).
+        """
+        words = [t for t in terms if len(t) >= FUZZY_MIN_LENGTH and not t.isdigit()]
+        if not words:
+            return {}
+        params = {"user_id": self.user_id, "limit": TRIGRAM_CANDIDATES}
+        candidates: dict[str, list[str]] = {}
+        if fulltext_dialect == "sqlite":
+            for word in words:
+                known = db.execute(text(
+                    "SELECT 1 FROM knowledge_fts JOIN knowledge k ON k.id = knowledge_fts.rowid "
+                    "WHERE knowledge_fts MATCH :q AND (k.user_id = :user_id OR k.shared) LIMIT 1"
+                ), {**params, "q": f'"{word}"'}).first()
+                if known:
+                    continue
+                # an adjacent swap ("bois"/"bios") changes most trigrams, so the swapped forms' count too
+                variants = [word] + [word[:i] + word[i + 1] + word[i] + word[i + 2:] for i in range(len(word) - 1)]
+                grams = dict.fromkeys(v[i:i + 3] for v in variants for i in range(len(v) - 2))
+                rows = db.execute(text(
+                    "SELECT k.name, k.keywords FROM knowledge_trgm "
+                    "JOIN knowledge k ON k.id = knowledge_trgm.rowid "
+                    "WHERE knowledge_trgm MATCH :q AND (k.user_id = :user_id OR k.shared) "
+                    "ORDER BY bm25(knowledge_trgm) LIMIT :limit"
+                ), {**params, "q": " OR ".join(f'"{g}"' for g in grams)}).all()
+                candidates[word] = [f"{name} {keywords or ''}" for name, keywords in rows]
+        else:
+            rows = db.execute(text(
+                "WITH t(word) AS ("
+                "  SELECT u.word FROM unnest(CAST(:words AS text[])) AS u(word) WHERE NOT EXISTS ("
+                "    SELECT 1 FROM knowledge k WHERE (k.user_id = :user_id OR k.shared) "
+                "    AND k.search_vector @@ plainto_tsquery('english', u.word))) "
+                "SELECT t.word, m.keyword FROM t CROSS JOIN LATERAL ("
+                "  SELECT keyword FROM knowledge_keywords "
+                "  WHERE keyword % t.word "
+                "  AND (user_id = :user_id OR knowledge_id IN (SELECT id FROM knowledge WHERE shared)) "
+                "  GROUP BY keyword ORDER BY max(similarity(keyword, t.word)) DESC LIMIT :limit"
+                ") m "
+                "UNION ALL "
+                "SELECT t.word, n.name FROM t CROSS JOIN LATERAL ("
+                "  SELECT name FROM knowledge "
+                "  WHERE t.word <% lower(name) AND (user_id = :user_id OR shared) "
+                "  ORDER BY word_similarity(t.word, lower(name)) DESC LIMIT :limit"
+                ") n"
+            ), {**params, "words": words}).all()
+            for word, found in rows:
+                candidates.setdefault(word, []).append(found)
+        corrections: dict[str, list[str]] = {}
+        for word, texts in candidates.items():
+            own = stem(word)
+            scored = {}
+            for part in tokenize(" ".join(texts)):
+                if part not in scored and part not in STOPWORDS and stem(part) != own:
+                    scored[part] = word_similarity(word, part)
+            best = sorted((w for w, score in scored.items() if score >= TRIGRAM_MIN_SIMILARITY),
+                          key=lambda w: (-scored[w], w))[:FUZZY_MAX_EXPANSIONS]
+            if best:
+                corrections[word] = best
+        return corrections
+    
+    def _lookup_database(self, query: str, n: int) -> tuple[list[dict], dict | None]:
+        """Database ranking with the same (results, best match) contract as KnowledgeIndex.lookup"""
+        results, corrections = self._search_database(query, max(n, 1))
+        return results[:n], _covering_best(query, results[:1], corrections=corrections)
+    
+    def _lookup_memory(self, query: str, n: int) -> tuple[list[dict], dict | None]:
+        """Rank the user's private index and the shared index and merge the two.
+        Each is scored with the other as background, so both score on one scale and a word
+        either layer knows is never fuzzy-corrected in the other.
+        """
+        shared = shared_knowledge_index()
+        private = self._index()
+        return merge_scored([private.scored(query, n, background=shared), shared.scored(query, n, background=private)], n)
+    
+    def _lookup(self, query: str, n: int) -> tuple[list[dict], dict | None]:
+        """(top-n results, best match) for `query`, served from knowledge_search_cache when possible"""
+        # ranking only sees the lowercase alphanumeric terms, so this is a safe cache key
+        key = (self.user_id, self.version, n, " ".join(tokenize(query)))
+        cached = knowledge_search_cache.get(key)
+        if cached is None:
+            if self._use_database():
+                cached = self._lookup_database(query, n)
+            else:
+                cached = self._lookup_memory(query, n)
+            knowledge_search_cache.put(key, cached)
+        results, best = cached
+        # callers own their copies
+        return [dict(item) for item in results], dict(best) if best is not None else None
+    
+    def search(self, query: str, n: int = 5) -> list[dict]:
+        """Search knowledge base (BM25 ranked, typo tolerant)"""
+        return self._lookup(query, n)[0]
+    
+    def best_match(self, query: str) -> dict | None:
+        """Return the single best matching knowledge entry, or None"""
+        return self._lookup(query, 1)[1]
+    
+    def system_items(self) -> list[dict]:
+        """Identity/personality entries used for the prompt's System block"""
+        if not self._use_database():
+            return shared_knowledge_index().system_items() + self._index().system_items()
+        db = SessionLocal()
+        try:
+            flagged = db.query(KnowledgeKeyword.knowledge_id).filter(
+                KnowledgeKeyword.keyword.in_(sorted(SYSTEM_KEYWORDS))
+            )
+            rows = db.query(Knowledge.id, Knowledge.name, Knowledge.description).filter(
+                self._visible(),
+                (Knowledge.id.in_(flagged)) | (func.lower(Knowledge.name).like('greenie%'))
+            ).order_by(Knowledge.shared.desc(), Knowledge.id.asc()).all()
+            keywords = self._keywords_by_id(db, [row[0] for row in rows])
             return [{
-                'name': k.name,
-                'description': k.description,
-                'keywords': json.loads(k.keywords) if k.keywords else []
-            } for k in results]
+                'name': name,
+                'description': description,
+                'keywords': keywords.get(knowledge_id, [])
+            } for knowledge_id, name, description in rows]
+        finally:
+            db.close()
+    
+    def retrieve(self, query: str, n: int = 5, include_system: bool = True, semantic_mode: bool = False) -> dict:
+        """Everything a chat turn needs from the knowledge base in one pass:
+        {'results': top-n entries, 'best_match': topic candidate or None, 'system': identity entries}
+        """
+        results, best = self._lookup(query, n)
+        if semantic_mode:
+            results = self.semantic_search(query, n)
+        return {
+            'results': results,
+            'best_match': best,
+            'system': self.system_items() if include_system else [],
+        }
+    
+    def semantic_search(self, query: str, n: int = 5) -> list[dict]:
+        """Search knowledge by local vector similarity (falls back to keyword search without numpy)"""
+        if not semantic.available:
+            return self.search(query, n)
+        own = _vector_index(_knowledge_vectors, self.user_id, self._load_vector_entries).search_scored(query, n)
+        shared = _vector_index(_shared_vectors, None, _shared_vector_entries).search_scored(query, n)
+        ranked = sorted(own + shared, key=lambda hit: -hit[0])
+        return [dict(item) for _, item in ranked[:n]]
+    
+    def _load_vector_entries(self) -> list[tuple]:
+        return [(_knowledge_text(item), item, None) for item in self._load_items()]
+    
+    def list_all(self) -> list[dict]:
+        """List all knowledge entries the user can see: the shared corpus, then their own"""
+        if self._use_database():
+            return _load_knowledge(self._visible())
+        return shared_knowledge_index().all() + self._index().all()
+    
+    def iter_all(self, since: float | None = None, page_size: int = 500):
+        """Yield the user's own knowledge entries in id order, a page at a time (keyset pagination on id).
+        The shared corpus is left out; it comes from the seed. `since` (unix time) limits the
+        output to entries created after it.
+        """
+        db = SessionLocal()
+        try:
+            last_id = 0
+            while True:
+                query = db.query(Knowledge.id, Knowledge.name, Knowledge.description, Knowledge.created_at).filter(
+                    self._private(), Knowledge.id > last_id
+                )
+                if since is not None:
+                    query = query.filter(Knowledge.created_at > datetime.fromtimestamp(since, timezone.utc).replace(tzinfo=None))
+                page = query.order_by(Knowledge.id.asc()).limit(page_size).all()
+                if not page:
+                    return
+                keywords = self._keywords_by_id(db, [row.id for row in page])
+                for row in page:
+                    yield {
+                        'name': row.name,
+                        'description': row.description,
+                        'keywords': keywords.get(row.id, []),
+                        'created_at': row.created_at.replace(tzinfo=timezone.utc).timestamp() if row.created_at else None,
+                    }
+                last_id = page[-1].id
         finally:
             db.close()
@@ -0,0 +1,521 @@
+"""
+In-process search indexes for knowledge entries and memories
+Keeps an inverted index over name, description and keywords and ranks
+matches with BM25, so a search only touches the entries that share
+terms with the query
+"""
+
+import heapq
+import math
+import re
+import threading
+import time
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Words that carry no meaning for ranking ("how do I wipe a locked HP laptop")
+STOPWORDS = frozenset("""
+a about after all also am an and any are as at be been before being but by can
+could did do does doing for from had has have having he her here hers him his how
+i if in into is it its just me my of on or our out over please she should so some
+than that the their them then there these they this those through to too under
+until up us very was we were what when where which while who whom why will with
+would you your
+""".split())
+
+# Field boosts: a hit in the name says more than one buried in the description
+FIELD_BOOSTS = (3.0, 2.0, 1.0)  # name, keywords, description
+FIELD_B = (0.5, 0.5, 0.75)       # length normalisation per field
+K1 = 1.2
+# Cached per-term weights; with a background index they are cached per background state too
+# (the shared index caches one set per user), so the cache is emptied when it gets this big
+WEIGHT_CACHE_MAX = 20000
+# An add only drops the cached weights of the new entry's own terms. The other terms keep the doc
+# count and average lengths they were computed with until the index has grown by this fraction
+# since the cache was last emptied, so their scores drift by a few percent at most.
+REWEIGHT_GROWTH = 0.05
+# Top-n ranking reads the impact-sorted postings this many at a time between stopping checks
+TOP_BLOCK = 64
+
+# Typo tolerance: query words with no postings are matched against the vocabulary of
+# names and keywords by character-trigram similarity ("blanco" -> "blancco") or, for
+# transpositions that share few trigrams, by a single edit ("bois" -> "bios")
+FUZZY_MIN_LENGTH = 4        # shorter words are too ambiguous to correct
+FUZZY_MIN_SIMILARITY = 0.4  # trigram Jaccard similarity needed to count as a match
+FUZZY_MAX_EXPANSIONS = 3    # corrections tried per misspelled word
+
+# Entries describing Greenie itself, always shown in the prompt's System block
+SYSTEM_KEYWORDS = frozenset(('identity', 'personality'))
+
+
+def is_system_item(item: dict) -> bool:
+    """True for identity/personality entries and entries named 'Greenie...'"""
+    return (
+        any((kw or '').lower() in SYSTEM_KEYWORDS for kw in item.get('keywords', []) or [])
+        or (item.get('name', '') or '').lower().startswith('greenie')
+    )
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lowercase alphanumeric terms"""
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+def stem(term: str) -> str:
+    """Light suffix-stripping stemmer (plurals, -ing, -ed, trailing e)"""
+    if len(term) <= 3 or term.isdigit():
+        return term
+    if term.endswith('ies') and len(term) > 4:
+        term = term[:-3] + 'y'
+    elif term.endswith('sses'):
+        term = term[:-2]
+    elif term.endswith('s') and not term.endswith(('ss', 'us', 'is')):
+        term = term[:-1]
+    for suffix in ('ing', 'ed'):
+        if term.endswith(suffix) and len(term) - len(suffix) >= 3:
+            term = term[:-len(suffix)]
+            # undouble: "stopped" -> "stopp" -> "stop"
+            if len(term) > 3 and term[-1] == term[-2] and term[-1] not in 'lsz':
+                term = term[:-1]
+            break
+    if term.endswith('e') and len(term) > 3:
+        term = term[:-1]
+    return term
+
+
+def analyze(text: str) -> list[str]:
+    """Tokenize, drop stopwords and stem"""
+    return [stem(t) for t in tokenize(text) if t not in STOPWORDS]
+
+
+def trigrams(word: str) -> set[str]:
+    """Character trigrams of a word, padded like pg_trgm ("  w", " wo", ..., "rd ")"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _deletes(word: str) -> set[str]:
+    """Every string one deletion away from `word`"""
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def within_one_edit(a: str, b: str) -> bool:
+    """True if a and b differ by at most one insertion, deletion, substitution or adjacent swap"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:] or (a[i:i + 2] == b[i:i + 2][::-1] and a[i + 2:] == b[i + 2:])
+    longer, shorter = (a, b) if len(a) > len(b) else (b, a)
+    return longer[i + 1:] == shorter[i:]
+
+
+def word_similarity(word: str, candidate: str) -> float:
+    """How close `candidate` is to a misspelled `word`, scored as the fuzzy lookup does:
+    trigram Jaccard similarity, or 1 - 1/len(word) if they are one edit apart, whichever is higher
+    """
+    grams, other = trigrams(word), trigrams(candidate)
+    common = len(grams & other)
+    score = common / (len(grams) + len(other) - common)
+    if within_one_edit(word, candidate):
+        score = max(score, 1.0 - 1.0 / len(word))
+    return score
+
+
+def merge_scored(ranked: list[list[tuple[float, float, dict]]], n: int = 5,
+                 min_coverage: float = 0.5) -> tuple[list[dict], dict | None]:
+    """Merge (score, coverage, item) lists from several indexes into (top-n items, best match or None).
+    Earlier lists win ties, so a user's own entries rank ahead of equally good shared ones.
+    """
+    merged = sorted(
+        ((score, i, j, coverage, item) for i, hits in enumerate(ranked) for j, (score, coverage, item) in enumerate(hits)),
+        key=lambda x: (-x[0], x[1], x[2])
+    )
+    if not merged:
+        return [], None
+    best = merged[0][4] if merged[0][3] >= min_coverage else None
+    return [entry[4] for entry in merged[:n]], best
+
+
+class KnowledgeIndex:
+    """BM25 index over a list of knowledge items (dicts with name/description/keywords)
+
+    Per-document term frequencies and field lengths are computed once when an
+    item is added; document frequencies and average field lengths are kept as
+    running totals, so a query only walks the postings of its own terms. The
+    per-posting BM25 contribution of a term is cached until an added item
+    contains the term (see REWEIGHT_GROWTH), together with the postings sorted
+    by that contribution, so a top-n query can stop reading long postings
+    once nothing further down can make the top n (see _top).
+    
+    Words in names and keywords also go into a trigram index and a one-deletion
+    index, so a query word with no postings can be corrected to its closest
+    vocabulary words without scanning the vocabulary.
+    """
+
+    def __init__(self, items: list[dict] | None = None):
+        self._lock = threading.Lock()
+        self._docs: list[dict] = []
+        self._lengths: list[tuple[int, int, int]] = []
+        self._total_lengths = [0, 0, 0]
+        self._postings: dict[str, dict[int, tuple[int, int, int]]] = {}
+        self._weights: dict[str, dict[tuple | None, tuple[dict, list]]] = {}  # term -> background stats -> (weights, impacts)
+        self._weight_entries = 0
+        self._weights_docs = 0  # doc count when the weight cache was last emptied
+        self._system: list[int] = []
+        self._vocab: dict[str, int] = {}
+        self._vocab_words: list[str] = []
+        self._vocab_sizes: list[int] = []
+        self._gram_postings: dict[str, list[int]] = {}
+        self._delete_postings: dict[str, list[int]] = {}
+        self._fuzzy: dict[str, list[tuple[str, float]]] = {}
+        for item in items or []:
+            self._add(item)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add(self, item: dict) -> None:
+        """Index a new knowledge item"""
+        with self._lock:
+            self._add(item)
+
+    def _add(self, item: dict) -> None:
+        doc_id = len(self._docs)
+        keywords = item.get('keywords', []) or []
+        fields = (
+            analyze(item.get('name', '') or ''),
+            [t for kw in keywords for t in analyze(kw)],
+            analyze(item.get('description', '') or ''),
+        )
+        self._docs.append(item)
+        if is_system_item(item):
+            self._system.append(doc_id)
+        lengths = tuple(len(f) for f in fields)
+        self._lengths.append(lengths)
+        for i, length in enumerate(lengths):
+            self._total_lengths[i] += length
+        tfs: dict[str, list[int]] = {}
+        for i, terms in enumerate(fields):
+            for term in terms:
+                tfs.setdefault(term, [0, 0, 0])[i] += 1
+        for term, tf in tfs.items():
+            self._postings.setdefault(term, {})[doc_id] = tuple(tf)
+        # the new entry's terms changed document frequency; everything else only drifts
+        for term in tfs:
+            dropped = self._weights.pop(term, None)
+            if dropped:
+                self._weight_entries -= len(dropped)
+        if len(self._docs) > self._weights_docs * (1.0 + REWEIGHT_GROWTH):
+            self._clear_weights()
+        for text in [item.get('name', '') or ''] + list(keywords):
+            for word in tokenize(text):
+                if word not in self._vocab and word not in STOPWORDS and len(word) >= 3 and not word.isdigit():
+                    self._add_word(word)
+    
+    def _clear_weights(self) -> None:
+        self._weights.clear()
+        self._weight_entries = 0
+        self._weights_docs = len(self._docs)
+
+    def _add_word(self, word: str) -> None:
+        word_id = len(self._vocab_words)
+        self._vocab[word] = word_id
+        self._vocab_words.append(word)
+        grams = trigrams(word)
+        self._vocab_sizes.append(len(grams))
+        for gram in grams:
+            self._gram_postings.setdefault(gram, []).append(word_id)
+        for variant in _deletes(word) | {word}:
+            self._delete_postings.setdefault(variant, []).append(word_id)
+        self._fuzzy.clear()
+    
+    def _fuzzy_terms(self, word: str) -> list[tuple[str, float]]:
+        """Index terms of the vocabulary words closest to a misspelled query word, with their similarity"""
+        cached = self._fuzzy.get(word)
+        if cached is not None:
+            return cached
+        grams = trigrams(word)
+        # a word reaching the threshold shares at least ceil(t * |grams|) trigrams with the query,
+        # so it must appear in one of the |grams| - min_shared + 1 rarest ones: walk only those
+        min_shared = math.ceil(FUZZY_MIN_SIMILARITY * len(grams))
+        rarest = sorted(grams, key=lambda g: len(self._gram_postings.get(g, ())))[:len(grams) - min_shared + 1]
+        candidates = {word_id for gram in rarest for word_id in self._gram_postings.get(gram, ())}
+        similar: dict[int, float] = {}
+        for word_id in candidates:
+            common = len(grams & trigrams(self._vocab_words[word_id]))
+            score = common / (len(grams) + self._vocab_sizes[word_id] - common)
+            if score >= FUZZY_MIN_SIMILARITY:
+                similar[word_id] = score
+        # one edit away (swaps like "bois"/"bios" share almost no trigrams)
+        edit_score = 1.0 - 1.0 / len(word)
+        for variant in _deletes(word) | {word}:
+            for word_id in self._delete_postings.get(variant, ()):
+                if similar.get(word_id, 0.0) < edit_score and within_one_edit(word, self._vocab_words[word_id]):
+                    similar[word_id] = edit_score
+        own = stem(word)
+        terms: dict[str, float] = {}
+        for word_id, score in sorted(similar.items(), key=lambda x: (-x[1], x[0])):
+            term = stem(self._vocab_words[word_id])
+            if term != own and term in self._postings and term not in terms:
+                terms[term] = score
+                if len(terms) == FUZZY_MAX_EXPANSIONS:
+                    break
+        self._fuzzy[word] = list(terms.items())
+        return self._fuzzy[word]
+    
+    def _query_groups(self, query: str, background: "KnowledgeIndex | None" = None) -> list[list[tuple[str, float]]]:
+        """One group of (term, weight) alternatives per distinct query term.
+        Terms that are in the index (or in the `background` index) stand alone; words unknown
+        to both are replaced by their fuzzy matches.
+        """
+        groups: dict[str, list[tuple[str, float]]] = {}
+        for word in tokenize(query):
+            if word in STOPWORDS:
+                continue
+            term = stem(word)
+            if term in groups:
+                continue
+            if (term in self._postings or (background is not None and background._knows(term))
+                    or len(word) < FUZZY_MIN_LENGTH or word.isdigit()):
+                groups[term] = [(term, 1.0)]
+            else:
+                groups[term] = self._fuzzy_terms(word) or [(term, 1.0)]
+        return list(groups.values())
+
+    # The two methods below are called by the index this one is the background of, while that
+    # index holds its own lock. They take no lock (each read is atomic), so two indexes used as
+    # each other's background cannot deadlock; a concurrent add shifts the stats by one doc at most.
+
+    def _knows(self, term: str) -> bool:
+        """True if some entry contains `term`"""
+        return term in self._postings
+
+    def _stats(self, term: str) -> tuple[int, int, list[int]]:
+        """(doc count, doc frequency of `term`, total field lengths) for use as a background corpus"""
+        return len(self._docs), len(self._postings.get(term, ())), list(self._total_lengths)
+
+    def _term_weights(self, term: str, background: "KnowledgeIndex | None" = None) -> tuple[dict[int, float], list[tuple[float, int]]]:
+        """BM25 contribution of `term` to each doc containing it, as ({doc_id: weight}, impacts)
+        where impacts lists the same (weight, doc_id) pairs highest first.
+        With a `background` index, idf and average lengths are taken over both corpora.
+        """
+        bg_stats = background._stats(term) if background is not None else None
+        bg_key = None if bg_stats is None else (bg_stats[0], bg_stats[1], *bg_stats[2])
+        cached = self._weights.get(term, {}).get(bg_key)
+        if cached is not None:
+            return cached
+        postings = self._postings.get(term)
+        if not postings:
+            return {}, []
+        n_docs = len(self._docs)
+        totals = list(self._total_lengths)
+        df = len(postings)
+        if bg_stats is not None:
+            n_docs += bg_stats[0]
+            df += bg_stats[1]
+            totals = [own + bg for own, bg in zip(totals, bg_stats[2])]
+        avg = [max(total / n_docs, 1.0) for total in totals]
+        idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+        weights = {}
+        for doc_id, tf in postings.items():
+            lengths = self._lengths[doc_id]
+            weighted = 0.0
+            for i in range(3):
+                if tf[i]:
+                    norm = 1.0 - FIELD_B[i] + FIELD_B[i] * lengths[i] / avg[i]
+                    weighted += FIELD_BOOSTS[i] * tf[i] / norm
+            weights[doc_id] = idf * weighted / (K1 + weighted)
+        impacts = sorted(((weight, doc_id) for doc_id, weight in weights.items()), key=lambda x: (-x[0], x[1]))
+        if self._weight_entries >= WEIGHT_CACHE_MAX:
+            self._clear_weights()
+        self._weights.setdefault(term, {})[bg_key] = weights, impacts
+        self._weight_entries += 1
+        return weights, impacts
+
+    def _top(self, groups: list[list[tuple[str, float]]], n: int,
+             background: "KnowledgeIndex | None" = None) -> list[tuple[float, int, int]]:
+        """The n best (score, doc_id, matched groups), best first (ties to the lower doc_id).
+        A doc scores, per query group it matches, its best alternative scaled by that alternative's
+        weight. Each alternative's impacts are read in step, highest first, and every doc met is
+        scored in full by dict lookups; the walk stops once the n-th best score beats the most an
+        unseen doc could still get (the sum of each group's next impact), as in Fagin's threshold
+        algorithm. The result is the same as scoring every matching doc.
+        """
+        streams = []  # (group, factor, impacts)
+        lookups: list[list[tuple[float, dict]]] = []
+        for g, group in enumerate(groups):
+            alternatives = []
+            for term, factor in group:
+                weights, impacts = self._term_weights(term, background)
+                if impacts:
+                    streams.append((g, factor, impacts))
+                    alternatives.append((factor, weights))
+            lookups.append(alternatives)
+        heap: list[tuple[float, int, int]] = []  # (score, -doc_id, matched), worst kept first
+        seen: set[int] = set()
+        depth = 0
+        while streams:
+            # read TOP_BLOCK impacts of every stream per round, then check whether to stop
+            end = depth + TOP_BLOCK
+            bounds = [0.0] * len(groups)
+            for g, factor, impacts in streams:
+                for _, doc_id in impacts[depth:end]:
+                    if doc_id in seen:
+                        continue
+                    seen.add(doc_id)
+                    score, matched = 0.0, 0
+                    for alternatives in lookups:
+                        best = 0.0
+                        for alt_factor, weights in alternatives:
+                            weight = weights.get(doc_id, 0.0) * alt_factor
+                            if weight > best:
+                                best = weight
+                        if best:
+                            score += best
+                            matched += 1
+                    entry = (score, -doc_id, matched)
+                    if len(heap) < n:
+                        heapq.heappush(heap, entry)
+                    elif entry > heap[0]:
+                        heapq.heapreplace(heap, entry)
+                if end < len(impacts) and impacts[end][0] * factor > bounds[g]:
+                    bounds[g] = impacts[end][0] * factor
+            depth = end
+            streams = [stream for stream in streams if depth < len(stream[2])]
+            if len(heap) == n and heap[0][0] > sum(bounds):
+                break
+        return [(score, -neg_id, matched) for score, neg_id, matched in sorted(heap, reverse=True)]
+
+    def scored(self, query: str, n: int = 5, background: "KnowledgeIndex | None" = None) -> list[tuple[float, float, dict]]:
+        """Top-n (score, coverage, item) for `query`, best first.
+        Coverage is the fraction of distinct query terms the item matched; a misspelled
+        term counts as matched when one of its corrections did. Passing a `background`
+        index scores against the statistics of both and only corrects words neither one
+        knows; two indexes each ranked with the other as background can be merged.
+        """
+        with self._lock:
+            groups = self._query_groups(query, background)
+            top = self._top(groups, max(n, 1), background)
+            return [(score, matched / len(groups), dict(self._docs[doc_id])) for score, doc_id, matched in top]
+
+    def lookup(self, query: str, n: int = 5, min_coverage: float = 0.5) -> tuple[list[dict], dict | None]:
+        """Rank once and return (top-n items, best match or None).
+        The best match must cover at least `min_coverage` of the distinct query terms.
+        """
+        return merge_scored([self.scored(query, n)], n, min_coverage)
+
+    def search(self, query: str, n: int = 5) -> list[dict]:
+        """Return the top-n items for `query` ranked by BM25"""
+        return self.lookup(query, n)[0]
+
+    def best_match(self, query: str, min_coverage: float = 0.5) -> dict | None:
+        """Return the best item for `query` if it covers enough of the query terms, or None"""
+        return self.lookup(query, 1, min_coverage)[1]
+
+    def system_items(self) -> list[dict]:
+        """Identity/personality entries, in insertion order"""
+        with self._lock:
+            return [dict(self._docs[doc_id]) for doc_id in self._system]
+
+    def all(self) -> list[dict]:
+        """Return every indexed item in insertion order"""
+        with self._lock:
+            return [dict(item) for item in self._docs]
+
+
+class MemoryIndex:
+    """BM25 index over one user's memories, with removals, for relevance-ranked recall
+
+    Each memory is (key, text, timestamp). Scores are BM25 over the text scaled by
+    an exponential recency decay, so an old memory needs a stronger match to beat
+    a recent one.
+    """
+
+    def __init__(self, entries: list[tuple] | None = None):
+        self._lock = threading.Lock()
+        self._docs: dict = {}  # key -> (text, timestamp, length)
+        self._postings: dict[str, dict] = {}
+        self._total_length = 0
+        for key, text, ts in entries or []:
+            self._add(key, text, ts)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __contains__(self, key) -> bool:
+        return key in self._docs
+
+    def add(self, key, text: str, timestamp: float) -> None:
+        with self._lock:
+            self._add(key, text, timestamp)
+
+    def _add(self, key, text: str, timestamp: float) -> None:
+        if key in self._docs:
+            return
+        terms = analyze(text)
+        self._docs[key] = (text, timestamp, len(terms))
+        self._total_length += len(terms)
+        tfs: dict[str, int] = {}
+        for term in terms:
+            tfs[term] = tfs.get(term, 0) + 1
+        for term, tf in tfs.items():
+            self._postings.setdefault(term, {})[key] = tf
+
+    def touch(self, key, timestamp: float) -> None:
+        """Move the memory stored under `key` to a new timestamp"""
+        with self._lock:
+            doc = self._docs.get(key)
+            if doc is not None:
+                self._docs[key] = (doc[0], timestamp, doc[2])
+
+    def remove(self, keys) -> None:
+        """Forget the memories stored under `keys`"""
+        with self._lock:
+            for key in keys:
+                doc = self._docs.pop(key, None)
+                if doc is None:
+                    continue
+                self._total_length -= doc[2]
+                for term in set(analyze(doc[0])):
+                    postings = self._postings.get(term)
+                    if postings is not None:
+                        postings.pop(key, None)
+                        if not postings:
+                            del self._postings[term]
+
+    def search(self, query: str, k: int = 5, half_life: float = 30 * 86400, now: float | None = None,
+               extra: list[tuple[str, float]] = ()) -> list[tuple[float, str, float]]:
+        """Top-k (score, text, timestamp) for `query`, best first.
+        Score is BM25 times 0.5 ** (age / half_life). `extra` (text, timestamp) pairs, e.g.
+        memories not yet written, are scored against this index's statistics without being added.
+        """
+        now = time.time() if now is None else now
+        terms = set(analyze(query))
+        with self._lock:
+            n_docs = max(len(self._docs), 1)
+            avg = max(self._total_length / n_docs, 1.0)
+            idf = {}
+            for term in terms:
+                df = len(self._postings.get(term, ()))
+                idf[term] = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+
+            def bm25(tf: int, length: int) -> float:
+                return tf * (K1 + 1) / (tf + K1 * (1 - FIELD_B[2] + FIELD_B[2] * length / avg))
+
+            scores: dict = {}
+            for term in terms:
+                for key, tf in self._postings.get(term, {}).items():
+                    scores[key] = scores.get(key, 0.0) + idf[term] * bm25(tf, self._docs[key][2])
+            hits = [(score, *self._docs[key][:2]) for key, score in scores.items()]
+        for text, ts in extra:
+            doc_terms = analyze(text)
+            score = sum(idf[t] * bm25(doc_terms.count(t), len(doc_terms)) for t in terms if t in doc_terms)
+            if score:
+                hits.append((score, text, ts))
+        decayed = [(score * 0.5 ** (max(now - ts, 0.0) / half_life), text, ts) for score, text, ts in hits]
+        return heapq.nlargest(k, decayed, key=lambda hit: (hit[0], hit[2]))
@@ -0,0 +1,94 @@
+"""
+Token budgeting for chat prompts
+A local token estimate (no tokenizer download or network call) and an allocator
+that packs the prompt's sections into one overall budget, so the size of what
+is sent to the LLM is bounded however long the history or knowledge gets.
+"""
+
+import math
+import re
+
+# Pieces the estimate is counted over: runs of letters, runs of digits, single symbols
+_PIECE_RE = re.compile(r"[A-Za-z]+|[0-9]+|[^\sA-Za-z0-9]")
+
+MIN_TRUNCATED = 32  # a clipped item must keep at least this many tokens to be worth including
+
+
+def _piece_tokens(piece: str) -> int:
+    if piece[0].isalpha():
+        return math.ceil(len(piece) / 5) if len(piece) > 4 else 1
+    if piece[0].isdigit():
+        return math.ceil(len(piece) / 3)
+    return 1
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate LLM token count of `text`.
+    Short words count as one token and longer ones as one per ~5 letters, digit runs one
+    per 3 digits and every symbol one, which tracks BPE tokenizers on prose, logs and code.
+    """
+    return sum(_piece_tokens(piece) for piece in _PIECE_RE.findall(text or ""))
+
+
+def truncate_tokens(text: str, max_tokens: int, marker: str = " …") -> str:
+    """Cut `text` to about `max_tokens` tokens (ending with `marker` when cut)"""
+    used = 0
+    for match in _PIECE_RE.finditer(text or ""):
+        used += _piece_tokens(match.group())
+        if used > max_tokens:
+            return text[:match.start()].rstrip() + marker
+    return text
+
+
+class TokenBudget:
+    """Token allowance shared by the sections of one prompt.
+
+    Fixed parts (instructions, the user's message) are charged first; optional sections
+    are then packed in priority order, each taking at most its own cap and never more
+    than what is left of `total`.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.used = 0
+        self.sections: dict[str, int] = {}
+
+    @property
+    def remaining(self) -> int:
+        return max(self.total - self.used, 0)
+
+    def charge(self, name: str, text: str) -> int:
+        """Count text that is always sent, even past the budget; returns its estimate"""
+        tokens = estimate_tokens(text)
+        self.used += tokens
+        self.sections[name] = self.sections.get(name, 0) + tokens
+        return tokens
+
+    def pack(self, name: str, items: list, cap: int | None = None, render=str, contiguous: bool = False) -> list[str]:
+        """Render `items` (most important first) and keep those that fit in the section's allowance.
+        Ranked sections skip an item that is too big and try the next. `contiguous` sections
+        (conversation history, newest first) stop at the first misfit instead, after clipping
+        it if enough room is left, so the history never has gaps.
+        """
+        allowance = self.remaining if cap is None else min(cap, self.remaining)
+        taken, spent = [], 0
+        for item in items:
+            line = render(item)
+            tokens = estimate_tokens(line)
+            if spent + tokens <= allowance:
+                taken.append(line)
+                spent += tokens
+                continue
+            if contiguous:
+                room = allowance - spent
+                if room >= MIN_TRUNCATED:
+                    line = truncate_tokens(line, room - 1)
+                    taken.append(line)
+                    spent += estimate_tokens(line)
+                break
+        self.used += spent
+        self.sections[name] = self.sections.get(name, 0) + spent
+        return taken
+
+    def summary(self) -> dict:
+        return {"total": self.total, "used": self.used, "sections": dict(self.sections)}
@@ -0,0 +1,137 @@
+"""
+Local semantic retrieval for knowledge and memories
+Hashed character n-gram TF-IDF vectors held in a contiguous NumPy matrix,
+scored against a query with a single matrix-vector product. No network calls.
+"""
+
+import functools
+import math
+import threading
+
+from knowledge_index import STOPWORDS, stem, tokenize
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; callers fall back to keyword retrieval
+    np = None
+
+available = np is not None
+
+DIM = 512              # hashed feature space (100k rows * 512 * float32 ~= 200 MB)
+NGRAM_SIZES = (3, 4)   # character n-grams taken inside each word
+MAX_CHARS = 2000       # only the head of very long texts is vectorized
+MIN_SCORE = 0.05       # cosine below this is treated as unrelated
+
+
+@functools.lru_cache(maxsize=65536)
+def _word_features(word: str) -> tuple[int, ...]:
+    """Signed hash buckets for a word's stem and character n-grams (+/-(bucket + 1))"""
+    padded = f" {word} "
+    grams = [stem(word)]
+    for size in NGRAM_SIZES:
+        grams.extend(padded[i:i + size] for i in range(len(padded) - size + 1))
+    features = []
+    for gram in grams:
+        h = hash(gram)
+        # signed hashing keeps bucket collisions from only ever adding up
+        bucket = h % DIM + 1
+        features.append(bucket if (h // DIM) & 1 else -bucket)
+    return tuple(features)
+
+
+def vectorize(text: str):
+    """L2-normalised float32 vector of hashed, sublinear term frequencies"""
+    counts: dict[int, int] = {}
+    for word in tokenize(text[:MAX_CHARS]):
+        if word in STOPWORDS:
+            continue
+        for feature in _word_features(word):
+            counts[feature] = counts.get(feature, 0) + 1
+    vec = np.zeros(DIM, dtype=np.float32)
+    for feature, tf in counts.items():
+        weight = 1.0 + math.log(tf)
+        vec[abs(feature) - 1] += weight if feature > 0 else -weight
+    norm = float(np.linalg.norm(vec))
+    if norm:
+        vec /= norm
+    return vec
+
+
+class VectorIndex:
+    """Growable row-per-item matrix of document vectors with incremental adds and removals
+
+    Rows are tf vectors; document frequencies are tracked per feature so the
+    query can be idf-weighted at search time without re-encoding the corpus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._matrix = np.zeros((16, DIM), dtype=np.float32)
+        self._size = 0
+        self._df = np.zeros(DIM, dtype=np.float32)
+        self._keys: list = []
+        self._payloads: list = []
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, text: str, payload, key=None) -> None:
+        """Append one document"""
+        self.extend([(text, payload, key)])
+
+    def extend(self, entries: list[tuple]) -> None:
+        """Append (text, payload, key) entries; the matrix doubles its capacity when full"""
+        if not entries:
+            return
+        vecs = np.stack([vectorize(text) for text, _, _ in entries])
+        with self._lock:
+            needed = self._size + len(vecs)
+            if needed > len(self._matrix):
+                capacity = len(self._matrix)
+                while capacity < needed:
+                    capacity *= 2
+                grown = np.zeros((capacity, DIM), dtype=np.float32)
+                grown[:self._size] = self._matrix[:self._size]
+                self._matrix = grown
+            self._matrix[self._size:needed] = vecs
+            self._size = needed
+            self._df += (vecs != 0).sum(axis=0)
+            self._keys.extend(key for _, _, key in entries)
+            self._payloads.extend(payload for _, payload, _ in entries)
+
+    def remove(self, keys) -> None:
+        """Drop the rows stored under any of `keys`, compacting the matrix in place"""
+        keys = set(keys)
+        with self._lock:
+            keep = [i for i, k in enumerate(self._keys) if k not in keys]
+            if len(keep) == self._size:
+                return
+            removed = self._matrix[:self._size][np.setdiff1d(np.arange(self._size), keep)]
+            self._df -= (removed != 0).sum(axis=0)
+            self._matrix[:len(keep)] = self._matrix[keep]
+            self._size = len(keep)
+            self._keys = [self._keys[i] for i in keep]
+            self._payloads = [self._payloads[i] for i in keep]
+
+    def search(self, query: str, k: int = 5) -> list:
+        """Return the payloads of the k rows most similar to `query`"""
+        return [payload for _, payload in self.search_scored(query, k)]
+
+    def search_scored(self, query: str, k: int = 5) -> list[tuple[float, object]]:
+        """(cosine score, payload) of the k rows most similar to `query`, best first"""
+        if k <= 0:
+            return []
+        q = vectorize(query)
+        with self._lock:
+            if not self._size or not q.any():
+                return []
+            # idf-weight the query only; stored rows never need re-encoding
+            q = q * np.log1p(self._size / (1.0 + self._df))
+            norm = float(np.linalg.norm(q))
+            if not norm:
+                return []
+            scores = self._matrix[:self._size] @ (q / norm)
+            k = min(k, self._size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [(float(scores[i]), self._payloads[i]) for i in top if scores[i] >= MIN_SCORE]
@@ -0,0 +1,283 @@
+"""
+Bounded in-process store for conversation sessions
+Sessions are kept in least-recently-used order and evicted when idle for too
+long or when the store exceeds its session count or byte budget, so a
+long-running server no longer grows with every session id it has seen.
+With a loader and a persister the store is the hot tier in front of a
+database: misses are loaded, changes are handed off to be written in the
+background, and hot sessions are re-read now and then so that several
+workers can serve the same conversation.
+A session can also carry a rolling summary of the turns folded out of it
+(see fold_due / apply_summary), so long conversations keep their context.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('greenie')
+
+
+class Turn:
+    """One message of a conversation"""
+    __slots__ = ("role", "text", "ts")
+
+    def __init__(self, role: str, text: str, ts: float | None = None):
+        self.role = role
+        self.text = text
+        self.ts = time.time() if ts is None else ts
+
+    def size(self) -> int:
+        # object header + three slots, plus the text itself (role strings are interned)
+        return 72 + 49 + len(self.text)
+
+    def as_dict(self) -> dict:
+        return {'role': self.role, 'text': self.text}
+
+
+SESSION_OVERHEAD = 200  # bytes per session besides its turns (record, list, key)
+
+
+class _Session:
+    __slots__ = ("turns", "summary", "size", "last_seen", "rev", "checked_at")
+
+    def __init__(self, turns: list[Turn] | None = None, rev: int = 0, summary: str | None = None):
+        self.turns: list[Turn] = turns or []
+        self.summary = summary              # rolling summary of the turns folded out of `turns`
+        self.size = SESSION_OVERHEAD + len(summary or "") + sum(turn.size() for turn in self.turns)
+        self.last_seen = time.monotonic()
+        self.rev = rev                      # bumped on every change; the newer copy wins
+        self.checked_at = self.last_seen    # last time the backing store was consulted
+
+    def snapshot(self) -> tuple[int, list[tuple], str | None]:
+        return self.rev, [(turn.role, turn.text, turn.ts) for turn in self.turns], self.summary
+
+
+class SessionStore:
+    """session key -> recent turns, bounded by count, bytes and idle time.
+
+    Each session keeps at most `max_turns` turns (oldest dropped first). A session
+    idle for `idle_ttl` seconds expires; beyond `max_sessions` sessions or `max_bytes`
+    (approximate) the least recently used ones are evicted. `get` and `pop` mirror
+    the dict methods they replace and return turns as {'role', 'text'} dicts.
+
+    Optional backing store: `loader(key)` returns (rev, [(role, text, ts), ...], summary) or
+    None, and `persister(key, rev, turns, summary)` saves a session (turns None clears it). The
+    persister should not block, e.g. by queueing the write. A hot session is re-read
+    when it was last checked more than `revalidate` seconds ago, and it is replaced
+    if the stored copy has a newer rev.
+    """
+
+    def __init__(self, max_sessions: int = 5000, max_turns: int = 20, idle_ttl: float = 6 * 3600,
+                 max_bytes: int = 32 * 1024 * 1024, loader=None, persister=None, revalidate: float = 5.0):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.persister = persister
+        self.revalidate = revalidate
+        self._lock = threading.Lock()
+        self._sessions: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.loads = 0
+        self.refreshes = 0
+        self.load_errors = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _drop(self, sid) -> _Session | None:
+        session = self._sessions.pop(sid, None)
+        if session is not None:
+            self._bytes -= session.size
+        return session
+
+    def _expire(self, now: float) -> None:
+        # sessions sit in last-use order, so the idle ones are all at the front
+        while self._sessions:
+            sid, session = next(iter(self._sessions.items()))
+            if now - session.last_seen <= self.idle_ttl:
+                break
+            self._drop(sid)
+            self.expirations += 1
+
+    def _install(self, sid, session: _Session) -> _Session:
+        """Put a session under `sid` (replacing any older copy) and evict to fit; caller holds the lock"""
+        self._drop(sid)
+        self._sessions[sid] = session
+        self._bytes += session.size
+        # never evict the session just written, even if it alone is over budget
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._sessions)))
+            self.evictions += 1
+        return session
+
+    def _load(self, sid) -> _Session | None:
+        """Read a session from the backing store (None if absent or unreadable); called without the lock"""
+        try:
+            found = self.loader(sid)
+        except Exception as e:
+            self.load_errors += 1
+            logger.warning("Session load failed for %s: %s", sid, e)
+            return None
+        self.loads += 1
+        if found is None:
+            return None
+        rev, turns, summary = found
+        return _Session([Turn(role, text, ts) for role, text, ts in turns[-self.max_turns:]], rev, summary)
+
+    def _session(self, sid, create: bool = False) -> _Session | None:
+        """The live session for `sid`: from the hot tier, re-read if due, or loaded on a miss.
+        With `create`, an empty session is made when there is none anywhere. Caller holds the lock,
+        which is released around backing-store reads.
+        """
+        now = time.monotonic()
+        self._expire(now)
+        session = self._sessions.get(sid)
+        if session is not None:
+            self.hits += 1
+            if self.loader is None or now - session.checked_at < self.revalidate:
+                return session
+        else:
+            self.misses += 1
+            if self.loader is None:
+                return self._install(sid, _Session()) if create else None
+        self._lock.release()
+        try:
+            stored = self._load(sid)
+        finally:
+            self._lock.acquire()
+        current = self._sessions.get(sid)
+        if stored is not None and (current is None or stored.rev > current.rev):
+            if current is not None:
+                self.refreshes += 1
+            current = self._install(sid, stored)
+        elif current is None and create:
+            current = self._install(sid, _Session())
+        if current is not None:
+            current.checked_at = now
+        return current
+
+    def get(self, sid, default=None) -> list[dict]:
+        """The session's turns as {'role', 'text'} dicts, oldest first (`default` if unknown)"""
+        summary, turns = self.get_context(sid)
+        if not turns and summary is None:
+            return [] if default is None else default
+        return turns
+
+    def get_context(self, sid) -> tuple[str | None, list[dict]]:
+        """(rolling summary or None, turns as {'role', 'text'} dicts) of a session"""
+        with self._lock:
+            session = self._session(sid)
+            if session is None:
+                return None, []
+            session.last_seen = time.monotonic()
+            self._sessions.move_to_end(sid)
+            return session.summary, [turn.as_dict() for turn in session.turns]
+
+    def append(self, sid, *turns: tuple[str, str]) -> None:
+        """Add (role, text) turns to a session, creating it if needed, and hand it to the persister"""
+        with self._lock:
+            session = self._session(sid, create=True)
+            session.last_seen = time.monotonic()
+            self._sessions.move_to_end(sid)
+            added = 0
+            for role, text in turns:
+                turn = Turn(role, text)
+                session.turns.append(turn)
+                added += turn.size()
+            overflow = len(session.turns) - self.max_turns
+            if overflow > 0:
+                added -= sum(turn.size() for turn in session.turns[:overflow])
+                del session.turns[:overflow]
+            session.size += added
+            self._bytes += added
+            session.rev += 1
+            snapshot = session.snapshot()
+            while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._sessions)))
+                self.evictions += 1
+        if self.persister is not None:
+            self.persister(sid, *snapshot)
+
+    def fold_due(self, sid, keep: int, max_tokens: int, estimate=len) -> tuple[str | None, list[tuple[str, str, float]]] | None:
+        """(current summary, turns to fold) when a session should be summarized, else None.
+        A session is due once its turns exceed `max_tokens` (by `estimate`) or are within two
+        turns of `max_turns`, so they are folded before the store drops them; everything but the
+        newest `keep` turns is folded. Reads the hot tier only.
+        """
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None or len(session.turns) <= keep:
+                return None
+            if (len(session.turns) < self.max_turns - 2
+                    and sum(estimate(turn.text) for turn in session.turns) <= max_tokens):
+                return None
+            return session.summary, [(turn.role, turn.text, turn.ts) for turn in session.turns[:-keep]]
+
+    def apply_summary(self, sid, folded: list[tuple[str, str, float]], summary: str) -> bool:
+        """Replace the `folded` turns (as returned by fold_due) with the new rolling `summary`.
+        Returns False, changing nothing, if the session no longer starts with those turns.
+        """
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None or len(session.turns) < len(folded):
+                return False
+            head = session.turns[:len(folded)]
+            if any((turn.role, turn.text, turn.ts) != tuple(old) for turn, old in zip(head, folded)):
+                return False
+            freed = sum(turn.size() for turn in head) + len(session.summary or "") - len(summary)
+            del session.turns[:len(folded)]
+            session.summary = summary
+            session.size -= freed
+            self._bytes -= freed
+            session.rev += 1
+            snapshot = session.snapshot()
+        if self.persister is not None:
+            self.persister(sid, *snapshot)
+        return True
+
+    def append_exchange(self, sid: str, user_text: str, assistant_text: str) -> None:
+        """Record one user message and the assistant's reply"""
+        self.append(sid, ('user', user_text), ('assistant', assistant_text))
+
+    def pop(self, sid, default=None):
+        """Remove a session (clearing it in the backing store too); returns its turns as dicts, or `default`.
+        With a backing store an empty session is left behind as a tombstone: its rev is above the
+        stored copy's, so a re-read before the queued delete is written cannot bring the turns back.
+        """
+        with self._lock:
+            session = self._session(sid) if self.loader is not None else self._drop(sid)
+            if self.loader is not None:
+                self._install(sid, _Session(rev=session.rev + 1 if session is not None else 1))
+        if self.persister is not None:
+            self.persister(sid, session.rev + 1 if session is not None else 0, None, None)
+        return default if session is None else [turn.as_dict() for turn in session.turns]
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._sessions),
+                "turns": sum(len(session.turns) for session in self._sessions.values()),
+                "bytes": self._bytes,
+                "max_sessions": self.max_sessions,
+                "max_turns": self.max_turns,
+                "max_bytes": self.max_bytes,
+                "idle_ttl": self.idle_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "loads": self.loads,
+                "refreshes": self.refreshes,
+                "load_errors": self.load_errors,
+            }
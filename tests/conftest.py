@@ -0,0 +1,23 @@
+"""
+Shared test setup: every test module runs against one throwaway SQLite database in test mode.
+The environment is set before any repo module is imported, since they read it at import time.
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+_tmp.close()
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp.name}"
+os.environ["GREENIE_TEST_MODE"] = "1"
+os.environ["GREENIE_COMPACT_INTERVAL"] = "0"
+
+
+def pytest_sessionfinish(session, exitstatus):
+    try:
+        os.unlink(_tmp.name)
+    except OSError:
+        pass
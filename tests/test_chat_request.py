@@ -0,0 +1,28 @@
+"""Invalid /chat options are rejected with 422 instead of silently falling back to the default"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import app
+
+
+async def _post_chat(body: dict) -> httpx.Response:
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post("/chat", json={"message": "hello", "save": False, **body})
+
+
+@pytest.mark.parametrize("body", [{"retrieval": "semantik"}, {"memory_mode": "relevent"}])
+def test_unknown_option_is_rejected(body):
+    response = asyncio.run(_post_chat(body))
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", next(iter(body))]
+
+
+@pytest.mark.parametrize("body", [{}, {"retrieval": "keyword"}, {"retrieval": "semantic"},
+                                  {"memory_mode": "recent"}, {"memory_mode": "relevant"}])
+def test_known_options_are_accepted(body):
+    response = asyncio.run(_post_chat(body))
+    assert response.status_code == 200, response.text
@@ -0,0 +1,51 @@
+"""/chat/stream streams the fake LLM's chunks, then records the exchange for the caller's user"""
+
+import asyncio
+import json
+
+import httpx
+
+import app
+import auth
+import database
+
+
+async def _stream(body: dict, headers: dict) -> list[str]:
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        async with client.stream("POST", "/chat/stream", json=body, headers=headers) as response:
+            assert response.status_code == 200
+            return [event async for event in _events(response)]
+
+
+async def _events(response):
+    buffer = ""
+    async for chunk in response.aiter_text():
+        buffer += chunk
+        *events, buffer = buffer.split("\n\n")
+        for event in events:
+            yield event
+
+
+def test_stream_yields_chunks_then_done_and_records_the_session():
+    database.init_db()
+    db = database.SessionLocal()
+    try:
+        auth.create_user(db, "streamer", "streamer@example.com", "secret-pass")
+        user_id = db.query(database.User.id).filter(database.User.username == "streamer").scalar()
+    finally:
+        db.close()
+    headers = {"Authorization": f"Bearer {auth.create_access_token({'sub': 'streamer'})}"}
+    events = asyncio.run(_stream({"message": "hello there", "session_id": "s1", "save": False}, headers))
+
+    chunks = [event[len("data: "):] for event in events if event.startswith("data: ")]
+    assert "".join(chunks) == "Starting stream...first chunk second chunk"
+    kind, data = events[-1].split("\n")
+    assert kind == "event: done"
+    done = json.loads(data[len("data: "):])
+    assert done["ttft_ms"] is not None and done["total_ms"] >= done["ttft_ms"]
+    # the reply is recorded once complete, under the authenticated user's session
+    assert app.sessions.get((user_id, "s1")) == [
+        {"role": "user", "text": "hello there"},
+        {"role": "assistant", "text": "Starting stream...first chunk second chunk"},
+    ]
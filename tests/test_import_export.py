@@ -0,0 +1,103 @@
+import asyncio
+import itertools
+import json
+
+import httpx
+import pytest
+
+import app
+import auth
+import database
+
+_ids = itertools.count()
+
+
+def _user() -> tuple[int, dict]:
+    """A fresh user and the auth header to act as them"""
+    name = f"backup{next(_ids)}"
+    db = database.SessionLocal()
+    try:
+        user = auth.create_user(db, name, f"{name}@example.com", "secret-pass")
+        return user.id, {"Authorization": f"Bearer {auth.create_access_token({'sub': name})}"}
+    finally:
+        db.close()
+
+
+async def _call(method: str, url: str, **kwargs) -> httpx.Response:
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.request(method, url, **kwargs)
+
+
+def _request(method: str, url: str, **kwargs) -> httpx.Response:
+    return asyncio.run(_call(method, url, **kwargs))
+
+
+@pytest.fixture
+def source():
+    database.init_db()
+    user_id, headers = _user()
+    memory = database.DatabaseBackedMemory(user_id=user_id)
+    memory.add_memories_bulk([("likes green tea", 100.0), ("works nights", 100.0), ("has a dog", 50.0)])
+    store = database.DatabaseBackedKnowledgeStore(user_id=user_id)
+    store.add_knowledge_bulk([
+        {'name': "Dock 4", 'description': "Pallets for quarantine", 'keywords': ["dock", "quarantine"]},
+        {'name': "Tote labels", 'description': "Print at intake", 'keywords': []},
+    ])
+    return user_id, headers
+
+
+def _records(body: str) -> list[dict]:
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def test_ndjson_export_round_trips_through_import(source):
+    _, headers = source
+    exported = _request("GET", "/knowledge/export?format=ndjson", headers=headers)
+    assert exported.status_code == 200
+    records = _records(exported.text)
+    assert records[0]["type"] == "meta"
+    assert records[-1] == {"type": "end", "memories": 3, "knowledge": 2}
+
+    _, target = _user()
+    imported = _request("POST", "/knowledge/import", content=exported.text,
+                        headers={**target, "Content-Type": "application/x-ndjson"})
+    assert imported.json()["imported"] == {"memories": 3, "knowledge": 2}
+    assert imported.json()["failed"] == 0
+
+    again = _records(_request("GET", "/knowledge/export?format=ndjson", headers=target).text)
+
+    def body(rows):
+        return [{k: v for k, v in row.items() if k != "created_at"} for row in rows if row["type"] in ("memory", "knowledge")]
+    assert body(again) == body(records)
+
+
+def test_json_export_imports_and_bad_items_are_reported(source):
+    _, headers = source
+    document = _request("GET", "/knowledge/export", headers=headers).json()
+    assert document["memories"] == ["works nights", "likes green tea", "has a dog"]
+    assert [item["name"] for item in document["knowledge"]] == ["Dock 4", "Tote labels"]
+
+    document["knowledge"].append({"description": "no name"})
+    document["memories"].append("")
+    _, target = _user()
+    result = _request("POST", "/knowledge/import", json=document, headers=target).json()
+    assert result["imported"] == {"memories": 3, "knowledge": 2}
+    assert sorted(error["type"] for error in result["errors"]) == ["knowledge", "memory"]
+    assert _request("GET", "/knowledge/import/progress", headers=target).json()["status"] == "done"
+
+
+def test_keyset_pages_visit_every_memory_once(source):
+    user_id, _ = source
+    memory = database.DatabaseBackedMemory(user_id=user_id)
+    memory.add_memories_bulk([(f"tied {i}", 100.0) for i in range(7)])
+    oldest_first = [m["text"] for m in memory.iter_all(page_size=2)]
+    assert len(oldest_first) == len(set(oldest_first)) == 10
+    assert [m["text"] for m in memory.iter_all(page_size=3, newest_first=True)] == oldest_first[::-1]
+    assert [m["text"] for m in memory.iter_all(since=60.0, page_size=2)] == oldest_first[1:]
+
+
+def test_export_since_skips_older_entries(source):
+    _, headers = source
+    records = _records(_request("GET", "/knowledge/export?format=ndjson&since=75", headers=headers).text)
+    assert [r["text"] for r in records if r["type"] == "memory"] == ["likes green tea", "works nights"]
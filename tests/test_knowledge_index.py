@@ -0,0 +1,43 @@
+import random
+
+import pytest
+
+from knowledge_index import KnowledgeIndex
+
+WORDS = "bios password dell hp laptop wipe drive blancco erasure macbook activation lock ssd".split()
+
+
+def _corpus(size: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    return [{
+        'name': " ".join(rng.choices(WORDS, k=3)),
+        'description': " ".join(rng.choices(WORDS, k=rng.randint(5, 30))),
+        'keywords': rng.choices(WORDS, k=2),
+    } for _ in range(size)]
+
+
+def _exhaustive(index: KnowledgeIndex, query: str, n: int, background=None) -> list[tuple]:
+    """Score every matching doc, the way _top's result is defined"""
+    groups = index._query_groups(query, background)
+    scores: dict[int, list] = {}
+    for group in groups:
+        best: dict[int, float] = {}
+        for term, factor in group:
+            for doc_id, weight in index._term_weights(term, background)[0].items():
+                best[doc_id] = max(best.get(doc_id, 0.0), weight * factor)
+        for doc_id, weight in best.items():
+            entry = scores.setdefault(doc_id, [0.0, 0])
+            entry[0] += weight
+            entry[1] += 1
+    ranked = sorted(scores.items(), key=lambda x: (-x[1][0], x[0]))[:n]
+    return [(score, matched / len(groups), index._docs[doc_id]) for doc_id, (score, matched) in ranked]
+
+
+@pytest.mark.parametrize("n", [1, 5, 40])
+def test_pruned_top_n_matches_exhaustive_scoring(n):
+    own, shared = KnowledgeIndex(_corpus(1500, 1)), KnowledgeIndex(_corpus(500, 2))
+    rng = random.Random(3)
+    queries = [" ".join(rng.choices(WORDS + ["bois", "macbok", "blanco"], k=rng.randint(1, 4))) for _ in range(50)]
+    for query in queries:
+        assert own.scored(query, n) == _exhaustive(own, query, n)
+        assert own.scored(query, n, background=shared) == _exhaustive(own, query, n, shared)
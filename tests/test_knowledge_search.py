@@ -0,0 +1,62 @@
+import itertools
+
+import pytest
+
+import database
+
+_user_ids = itertools.count(300)
+
+ENTRIES = [
+    ("BIOS settings", "How to enter the firmware setup screen at boot", ["bios", "firmware"]),
+    ("Raspberry Pi", "A small single-board computer", ["raspberry", "computer"]),
+    ("Quixotic widget", "An entry only its name describes", []),
+    ("Tea brewing", "Steep green leaves for three minutes", ["tea"]),
+]
+
+
+@pytest.fixture(params=["memory", "database"])
+def store(request, monkeypatch):
+    database.init_db()
+    monkeypatch.setattr(database, "SEARCH_BACKEND", request.param)
+    store = database.DatabaseBackedKnowledgeStore(user_id=next(_user_ids))
+    for name, description, keywords in ENTRIES:
+        store.add_knowledge(name, description, keywords)
+    return store
+
+
+def _names(results):
+    return [item['name'] for item in results]
+
+
+def test_full_text_match_on_description(store):
+    assert _names(store.search("steep leaves"))[0] == "Tea brewing"
+
+
+def test_misspelled_keyword_is_corrected(store):
+    assert store.best_match("raspbery")['name'] == "Raspberry Pi"
+
+
+def test_adjacent_swap_is_corrected(store):
+    assert store.best_match("bois")['name'] == "BIOS settings"
+
+
+def test_misspelling_of_a_name_word_is_corrected(store):
+    assert store.best_match("quixotc")['name'] == "Quixotic widget"
+
+
+def test_new_entry_is_found_by_a_typo(store):
+    store.add_knowledge("Sourdough starter", "Feed it flour and water daily", ["sourdough"])
+    assert store.best_match("sourdouhg starter")['name'] == "Sourdough starter"
+
+
+def test_other_users_entries_are_not_suggested(store):
+    other = database.DatabaseBackedKnowledgeStore(user_id=next(_user_ids))
+    other.add_knowledge("Kombucha", "Fermented tea", ["kombucha"])
+    assert "Kombucha" not in _names(store.search("kombuca"))
+
+
+def test_database_backend_keeps_no_in_process_index(store):
+    if database.SEARCH_BACKEND != "database":
+        pytest.skip("memory backend")
+    store.search("quixotc")
+    assert store.user_id not in database._knowledge_indexes
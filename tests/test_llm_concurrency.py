@@ -0,0 +1,66 @@
+"""
+LLM calls must not block the event loop: N parallel /chat requests against a fake LLM
+that takes DELAY seconds finish in about one DELAY, and /health answers meanwhile.
+Run from the repo root: python -m pytest tests
+"""
+
+import asyncio
+import time
+
+import httpx
+
+import app
+
+PARALLEL = 8
+DELAY = 0.5
+
+
+async def _parallel_chats() -> tuple[float, float, list]:
+    """(seconds for PARALLEL chats, seconds /health took while they ran, chat responses)"""
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        started = time.perf_counter()
+        chats = [
+            asyncio.create_task(client.post("/chat", json={"message": f"bios password dell {i}", "save": False}))
+            for i in range(PARALLEL)
+        ]
+        await asyncio.sleep(DELAY / 5)  # let the chats reach the LLM
+        probe = time.perf_counter()
+        health = await client.get("/health")
+        health_s = time.perf_counter() - probe
+        assert health.status_code == 200
+        responses = await asyncio.gather(*chats)
+        return time.perf_counter() - started, health_s, responses
+
+
+def test_parallel_chats_do_not_serialize(monkeypatch):
+    monkeypatch.setattr(app.async_groq_client, "delay", DELAY)
+    elapsed, health_s, responses = asyncio.run(_parallel_chats())
+    for i, response in enumerate(responses):
+        assert response.status_code == 200, response.text
+        assert response.json()["reply"] == f"Test reply: bios password dell {i}"
+    # serialized calls would take PARALLEL * DELAY = 4 s
+    assert elapsed < 3 * DELAY
+    # a blocked loop would hold /health until the fake calls were done
+    assert health_s < DELAY / 2
+    assert app.llm_status["max_in_flight"] > 1
+
+
+async def _cancel_a_waiting_call() -> tuple[int, int]:
+    """(calls waiting while one call holds the only slot, calls waiting after that one is cancelled)"""
+    messages = [{"role": "user", "content": "hi"}]
+    holder = asyncio.create_task(app._llm_complete(messages, "test"))
+    waiter = asyncio.create_task(app._llm_complete(messages, "test"))
+    await asyncio.sleep(DELAY / 5)
+    waiting = app.llm_status["waiting"]
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    await holder
+    return waiting, app.llm_status["waiting"]
+
+
+def test_cancelled_wait_is_not_counted(monkeypatch):
+    monkeypatch.setattr(app.async_groq_client, "delay", DELAY)
+    monkeypatch.setattr(app, "llm_semaphore", asyncio.Semaphore(1))
+    assert asyncio.run(_cancel_a_waiting_call()) == (1, 0)
+    assert app.llm_status["in_flight"] == 0
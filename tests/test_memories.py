@@ -0,0 +1,82 @@
+import itertools
+
+import pytest
+from sqlalchemy import delete, func, select
+
+import database
+
+_user_ids = itertools.count(500)
+
+
+@pytest.fixture
+def memory():
+    database.init_db()
+    return database.DatabaseBackedMemory(user_id=next(_user_ids))
+
+
+def _rows(user_id: int) -> list[tuple[str, float]]:
+    with database.engine.begin() as conn:
+        table = database.Memory.__table__
+        return [tuple(row) for row in conn.execute(
+            select(table.c.text, table.c.timestamp).where(table.c.user_id == user_id).order_by(table.c.id)
+        )]
+
+
+def test_repeat_touches_the_stored_memory(memory):
+    memory.add_memories_bulk([("I like tea", 1.0)])
+    memory.add_memories_bulk([("  i LIKE   tea! ", 2.0)])
+    assert _rows(memory.user_id) == [("I like tea", 2.0)]
+
+
+@pytest.mark.parametrize("a, b", [("£5", "€5"), ("C++", "C#"), ("-5", "5"), ("I ♥ tea", "I ☕ tea")])
+def test_symbols_and_non_ascii_keep_memories_apart(memory, a, b):
+    memory.add_memories_bulk([(a, 1.0), (b, 2.0)])
+    assert len(_rows(memory.user_id)) == 2
+
+
+def test_repeats_within_a_batch_collapse_to_the_newest(memory):
+    memory.add_memories_bulk([("Hi!", 1.0), ("hi", 3.0), ("(hi)", 2.0)])
+    assert [ts for _, ts in _rows(memory.user_id)] == [3.0]
+
+
+def test_upgrade_migration_collapses_duplicates(memory):
+    table = database.Memory.__table__
+    with database.engine.begin() as conn:
+        # rows from before content hashing, and one hashed by an older normalization
+        conn.execute(table.insert(), [
+            {"user_id": memory.user_id, "text": "Walks at dawn", "timestamp": 1.0, "kind": "raw"},
+            {"user_id": memory.user_id, "text": "walks at dawn.", "timestamp": 5.0, "kind": "raw"},
+            {"user_id": memory.user_id, "text": "Walks at dawn!", "timestamp": 3.0, "kind": "raw",
+             "content_hash": "stale"},
+            {"user_id": memory.user_id, "text": "Runs at dusk", "timestamp": 2.0, "kind": "raw"},
+        ])
+        conn.execute(delete(database.AppState).where(database.AppState.key == database.MEMORY_DEDUPE_STATE))
+    assert database.dedupe_memories(batch_size=2) >= 2
+    assert _rows(memory.user_id) == [("walks at dawn.", 5.0), ("Runs at dusk", 2.0)]
+    with database.engine.begin() as conn:
+        assert conn.execute(select(func.count()).select_from(table).where(
+            table.c.user_id == memory.user_id, table.c.content_hash.is_(None)
+        )).scalar() == 0
+    # later inserts match the migrated rows, and the migration does not run twice
+    memory.add_memories_bulk([("WALKS AT DAWN", 9.0)])
+    assert _rows(memory.user_id) == [("walks at dawn.", 9.0), ("Runs at dusk", 2.0)]
+    assert database.dedupe_memories() == 0
+
+
+def test_trim_keeps_the_newest_raw_memories_and_digests(memory, monkeypatch):
+    monkeypatch.setattr(database, "MEMORY_MAX_DIGESTS", 2)
+    memory.max_items = 5
+    with database.engine.begin() as conn:
+        conn.execute(database.Memory.__table__.insert(), [
+            {"user_id": memory.user_id, "text": f"digest {i}", "timestamp": float(i), "kind": "digest"}
+            for i in range(4)
+        ])
+    memory.add_memories_bulk([(f"memory {i}", 10.0 + i) for i in range(8)])
+    assert [text for text, _ in _rows(memory.user_id)] == ["digest 2", "digest 3"] + [f"memory {i}" for i in range(3, 8)]
+
+
+def test_first_add_in_a_process_trims(memory):
+    memory.max_items = 3
+    memory.add_memories_bulk([(f"memory {i}", float(i)) for i in range(6)], trim=False)
+    memory.add_memory("one more")
+    assert [text for text, _ in _rows(memory.user_id)] == ["memory 4", "memory 5", "one more"]
@@ -0,0 +1,50 @@
+import pytest
+
+import database
+
+OWNER = 900
+
+
+def _entry(key: str, name: str, description: str, keywords=()) -> dict:
+    return {'seed_key': key, 'name': name, 'description': description, 'keywords': list(keywords)}
+
+
+SEED = [
+    _entry("zephyr", "Zephyr bay", "Inbound zephyr pallets", ["zephyr"]),
+    _entry("quasar", "Quasar cage", "Locked quasar storage", ["quasar"]),
+]
+
+
+@pytest.fixture(autouse=True)
+def clean_seed():
+    database.init_db()
+    yield
+    database.sync_knowledge_seed([], user_id=OWNER)
+
+
+def _visible_names(query: str) -> list[str]:
+    return [item['name'] for item in database.DatabaseBackedKnowledgeStore(user_id=OWNER + 1).search(query)]
+
+
+def test_resync_only_writes_what_changed():
+    assert database.sync_knowledge_seed(SEED, user_id=OWNER)['inserted'] == 2
+    assert database.sync_knowledge_seed(SEED, user_id=OWNER)['skipped'] is True
+    changed = [SEED[0], _entry("quasar", "Quasar cage", "Moved to the nebula room", ["quasar"])]
+    counts = database.sync_knowledge_seed(changed, user_id=OWNER)
+    assert (counts['updated'], counts['unchanged'], counts['inserted'], counts['deleted']) == (1, 1, 0, 0)
+    # the seed is the shared corpus: other users see the update
+    assert _visible_names("nebula") == ["Quasar cage"]
+    counts = database.sync_knowledge_seed(changed[:1], user_id=OWNER)
+    assert counts['deleted'] == 1
+    assert _visible_names("quasar") == []
+
+
+def test_untracked_copies_are_adopted_once():
+    owner = database.DatabaseBackedKnowledgeStore(user_id=OWNER)
+    for _ in range(3):  # one copy per restart before seeds were tracked
+        owner.add_knowledge("Zephyr bay", "Inbound zephyr pallets", ["zephyr"])
+    counts = database.sync_knowledge_seed(SEED, user_id=OWNER)
+    assert (counts['updated'], counts['inserted'], counts['deleted']) == (1, 1, 2)
+    assert _visible_names("zephyr") == ["Zephyr bay"]
+    assert list(owner.iter_all()) == []
+
@@ -0,0 +1,137 @@
+"""
+Conversation sessions: the bounded hot tier, and persistence through the sessions table
+shared by several workers (each worker is a SessionStore over the same database).
+"""
+
+import itertools
+import time
+
+import pytest
+
+import database
+from session_store import SessionStore
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def db():
+    database.init_db()
+
+
+def _key():
+    return (1, f"test-session-{next(_ids)}")
+
+
+def _worker(**options) -> SessionStore:
+    """A store as app.py builds it: loaded from and written to the sessions table"""
+    return SessionStore(
+        loader=lambda key: database.load_session(*key),
+        persister=lambda key, rev, turns, summary: database.session_writer.submit(
+            (key[0], key[1], rev, turns, summary, time.time())),
+        **options,
+    )
+
+
+def _texts(turns) -> list[str]:
+    return [turn['text'] for turn in turns]
+
+
+def test_lru_eviction_and_turn_limit():
+    store = SessionStore(max_sessions=2, max_turns=4)
+    for i in range(3):
+        store.append_exchange(f"s{i}", f"q{i}", f"a{i}")
+    assert store.get("s0") == [] and len(store) == 2
+    for i in range(3):
+        store.append_exchange("s2", f"more{i}", f"reply{i}")
+    assert _texts(store.get("s2")) == ["more1", "reply1", "more2", "reply2"]
+    assert store.stats()["evictions"] == 1
+
+
+def test_idle_sessions_expire():
+    store = SessionStore(idle_ttl=0.05)
+    store.append_exchange("s", "q", "a")
+    time.sleep(0.1)
+    assert store.get("s") == []
+    assert store.stats()["expirations"] == 1
+
+
+def test_byte_budget_evicts_oldest():
+    store = SessionStore(max_bytes=2000)
+    store.append_exchange("old", "x" * 600, "y" * 600)
+    store.append_exchange("new", "x" * 600, "y" * 600)
+    assert store.get("old") == [] and store.get("new")
+    assert store.stats()["bytes"] <= 2000
+
+
+def test_session_survives_a_restart():
+    key = _key()
+    _worker().append_exchange(key, "bios password", "use the master code")
+    database.session_writer.flush()
+    assert _texts(_worker().get(key)) == ["bios password", "use the master code"]
+
+
+def test_clear_then_chat_does_not_bring_back_old_turns():
+    key = _key()
+    store = _worker()
+    for i in range(3):
+        store.append_exchange(key, f"q{i}", f"a{i}")
+    database.session_writer.flush()
+    store.pop(key)
+    store.append_exchange(key, "new", "reply")  # before the clear is written
+    assert _texts(store.get(key)) == ["new", "reply"]
+    database.session_writer.flush()
+    assert [turn[1] for turn in database.load_session(*key)[1]] == ["new", "reply"]
+
+
+def test_clear_on_one_worker_reaches_another():
+    key = _key()
+    a, b = _worker(revalidate=0), _worker(revalidate=60)
+    for i in range(3):
+        a.append_exchange(key, f"q{i}", f"a{i}")
+    database.session_writer.flush()
+    assert len(b.get(key)) == 6
+    a.pop(key)
+    database.session_writer.flush()
+    # b still holds the old turns in memory and appends before re-reading
+    b.append_exchange(key, "after clear", "ok")
+    database.session_writer.flush()
+    assert [turn[1] for turn in database.load_session(*key)[1]] == ["after clear", "ok"]
+    b.revalidate = 0
+    assert _texts(b.get(key)) == ["after clear", "ok"]
+    assert _texts(a.get(key)) == ["after clear", "ok"]
+
+
+def test_concurrent_appends_on_two_workers_are_merged():
+    key = _key()
+    a, b = _worker(revalidate=60), _worker(revalidate=60)
+    a.append_exchange(key, "x", "y")
+    database.session_writer.flush()
+    b.get(key)
+    a.append_exchange(key, "from a", "ra")
+    database.session_writer.flush()
+    b.append_exchange(key, "from b", "rb")  # same rev as a's write
+    database.session_writer.flush()
+    stored = [turn[1] for turn in database.load_session(*key)[1]]
+    assert stored == ["x", "y", "from a", "ra", "from b", "rb"]
+
+
+def test_rolling_summary_replaces_folded_turns():
+    key = _key()
+    store = _worker(max_turns=20)
+    for i in range(5):
+        store.append_exchange(key, f"q{i}", f"a{i}")
+    due = store.fold_due(key, keep=4, max_tokens=1)
+    assert due is not None
+    summary, folded = due
+    assert summary is None and len(folded) == 6
+    assert store.apply_summary(key, folded, "earlier: q0-q2")
+    assert store.get_context(key) == ("earlier: q0-q2", [
+        {'role': 'user', 'text': 'q3'}, {'role': 'assistant', 'text': 'a3'},
+        {'role': 'user', 'text': 'q4'}, {'role': 'assistant', 'text': 'a4'},
+    ])
+    # a fold computed before the session changed is refused
+    assert not store.apply_summary(key, folded, "stale")
+    database.session_writer.flush()
+    rev, turns, stored_summary = database.load_session(*key)
+    assert stored_summary == "earlier: q0-q2" and len(turns) == 4
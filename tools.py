@@ -1,10 +1,12 @@
+import codecs
 import json
+import mmap
 import os
 import threading
 from typing import List, Dict
 from datetime import datetime
 from zoneinfo import ZoneInfo
-import json
+from knowledge_index import KnowledgeIndex
 
 
 import sys
@@ -17,19 +19,161 @@ class Greenie:
 
     
 
+# Journal entries appended before a background compaction folds them into the snapshot
+COMPACT_THRESHOLD = 500
+# Files at least this large are parsed through mmap instead of buffered reads
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+
+MMAP_CHUNK = 1024 * 1024  # bytes decoded at a time when walking a mapped snapshot
+
+
+def _read_json_list(path: str) -> list:
+    """Parse a JSON array file. Large files are walked through mmap element by element,
+    so the file is never copied into one bytes object (or one str) first."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            items = json.loads(f.read())
+            return items if isinstance(items, list) else []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return list(_iter_json_array(mm[i:i + MMAP_CHUNK] for i in range(0, size, MMAP_CHUNK)))
+
+
+def _iter_json_array(chunks):
+    """Yield the elements of a JSON array whose UTF-8 bytes arrive in `chunks`"""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, opened = '', 0, False
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        final = chunk is None
+        buf = buf[pos:] + utf8.decode(chunk or b'', final)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf):
+                break
+            if not opened:
+                if buf[pos] != '[':
+                    raise json.JSONDecodeError("expected a JSON array", buf, pos)
+                opened = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break  # the element runs on into the next chunk
+            after = end
+            while after < len(buf) and buf[after] in ' \t\r\n':
+                after += 1
+            if after == len(buf) or buf[after] not in ',]':
+                if final:
+                    raise json.JSONDecodeError("expected ',' or ']'", buf, after)
+                break  # only part of the element was seen, e.g. "2" of "2.5"
+            yield item
+            pos = end
+    raise json.JSONDecodeError("unterminated JSON array", buf, len(buf))
+
+
+def _iter_journal(path: str):
+    """Yield the JSON records of a journal file, skipping a torn last line"""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                lines = iter(mm.readline, b'')
+                yield from _parse_lines(lines)
+        else:
+            yield from _parse_lines(f)
+
+
+def _parse_lines(lines):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            # a write interrupted mid-line; everything before it is intact
+            continue
+
+
 class KnowledgeStore:
-    def __init__(self, path: str | None = None):
+    """File-backed knowledge store for the desktop build.
+
+    `path` holds a compacted JSON snapshot and `path + '.journal'` an append-only
+    JSONL log of entries added since. Adds append one line; reads are served from
+    an in-memory copy that is only reloaded when either file's mtime/size changes.
+    Once the journal grows past `compact_threshold` entries a background thread
+    folds it into the snapshot.
+    """
+
+    def __init__(self, path: str | None = None, compact_threshold: int = COMPACT_THRESHOLD):
         self.path = path or DEFAULT_PATH
+        self.compact_threshold = compact_threshold
         self._lock = threading.Lock()
+        self._items: List[Dict] = []
+        self._index: KnowledgeIndex | None = None
+        self._signature = None
+        self._journal_count = 0
+        self._compacting = False
         if not os.path.exists(self.path):
             self._write([])
 
-    def _read(self) -> List[Dict]:
+    @property
+    def journal_path(self) -> str:
+        return self.path + '.journal'
+
+    def _stat_signature(self):
+        sig = []
+        for p in (self.path, self.journal_path):
+            try:
+                st = os.stat(p)
+                sig.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                sig.append(None)
+        return tuple(sig)
+
+    def _load(self) -> None:
+        """(Re)build the in-memory snapshot from the files. Caller holds the lock."""
+        signature = self._stat_signature()
         try:
-            with open(self.path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            items = _read_json_list(self.path)
         except (FileNotFoundError, json.JSONDecodeError):
-            return []
+            items = []
+        journal_count = 0
+        for record in _iter_journal(self.journal_path):
+            journal_count += 1
+            # entries already folded into the snapshot by an interrupted compaction
+            if record.pop('_seq', len(items)) < len(items):
+                continue
+            items.append(record)
+        self._items = items
+        self._index = None
+        self._journal_count = journal_count
+        self._signature = signature
+
+    def _snapshot(self) -> List[Dict]:
+        """Current items, reloading only if the files changed on disk. Caller holds the lock."""
+        if self._signature is None or self._stat_signature() != self._signature:
+            self._load()
+        return self._items
+
+    def _read(self) -> List[Dict]:
+        with self._lock:
+            return [dict(item) for item in self._snapshot()]
 
     def _write(self, data: List[Dict]) -> None:
         tmp = self.path + '.tmp'
@@ -47,30 +191,69 @@ class KnowledgeStore:
                 json.dump(data, f, ensure_ascii=False, indent=2)
             os.replace(tmp, self.path)
 
+    def _append(self, item: Dict, seq: int) -> None:
+        line = (json.dumps({**item, '_seq': seq}, ensure_ascii=False) + '\n').encode('utf-8')
+        try:
+            with open(self.journal_path, 'ab+') as f:
+                # don't glue the new record onto a torn line left by an interrupted write
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        line = b'\n' + line
+                f.write(line)
+        except OSError:
+            # unwritable location: move the snapshot somewhere writable and journal there
+            self._write(self._items[:seq])
+            with open(self.journal_path, 'wb') as f:
+                f.write(line)
+
     def add_knowledge(self, name: str, description: str, keywords: List[str] = None) -> None:
         # Keep both `name` and `title` for backward compatibility with tests/older clients
         item = {"name": name, "title": name, "description": description, "keywords": keywords or []}
         with self._lock:
-            data = self._read()
-            data.append(item)
-            self._write(data)
+            items = self._snapshot()
+            self._append(item, len(items))
+            items.append(item)
+            if self._index is not None:
+                self._index.add(item)
+            self._journal_count += 1
+            # our own append should not force a reload
+            self._signature = self._stat_signature()
+            start_compaction = self._journal_count >= self.compact_threshold and not self._compacting
+            if start_compaction:
+                self._compacting = True
+        if start_compaction:
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self) -> None:
+        """Fold the journal into the snapshot file and truncate it"""
+        try:
+            with self._lock:
+                items = self._snapshot()
+                if self._journal_count:
+                    self._write(items)
+                    # a crash here is harmless: replay skips entries whose _seq is in the snapshot
+                    try:
+                        os.remove(self.journal_path)
+                    except FileNotFoundError:
+                        pass
+                    self._journal_count = 0
+                    self._signature = self._stat_signature()
+        finally:
+            self._compacting = False
+
+    def _get_index(self) -> KnowledgeIndex:
+        """BM25 index over the snapshot, built on first use. Caller holds the lock."""
+        items = self._snapshot()
+        if self._index is None:
+            self._index = KnowledgeIndex(items)
+        return self._index
 
     def search(self, query: str, n: int = 5) -> List[Dict]:
-        # naive substring search across title+content, returns top-n matches
+        # BM25 ranking across name, keywords and description, returns top-n matches
         with self._lock:
-            data = self._read()
-        matches = []
-        q = query.lower()
-        for item in data:
-            score = 0
-            if q in item.get('name','').lower():
-                score += 10
-            if q in item.get('description','').lower():
-                score += 5
-            if score > 0:
-                matches.append((score, item))
-        matches.sort(key=lambda x: x[0], reverse=True)
-        return [m[1] for m in matches[:n]]
+            index = self._get_index()
+        return index.search(query, n)
 
     def list_all(self) -> List[Dict]:
         return self._read()
@@ -78,25 +261,8 @@ class KnowledgeStore:
     def best_match(self, query: str) -> Dict | None:
         """Return the single best matching knowledge item for `query`, or None."""
         with self._lock:
-            data = self._read()
-        q = query.lower().strip()
-        best_item = None
-        best_score = 0
-        for item in data:
-            score = 0
-            if q in item.get('name','').lower():
-                score += 10
-            if q in item.get('description','').lower():
-                score += 5
-            for kw in item.get('keywords', []):
-                if q in kw.lower():
-                    score += 3
-            if score > best_score:
-                best_score = score
-                best_item = item
-        if best_score > 0:
-            return best_item
-        return None
+            index = self._get_index()
+        return index.best_match(query)
 
 # convenience instance for small apps
 store = KnowledgeStore()
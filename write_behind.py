@@ -0,0 +1,169 @@
+"""
+Write-behind queue for background persistence
+Callers enqueue and return immediately; a worker thread hands batches (across
+users) to a flush function once enough items are waiting or the oldest has
+waited long enough, so each flush is one transaction instead of one per request.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('greenie')
+
+
+class WriteBehindQueue:
+    """Batches submitted items and writes them from a background thread.
+
+    `flush_fn(batch)` receives a list of items and must write them in one go.
+    A failed batch is retried up to `max_retries` times before it is dropped
+    (and counted). Items stay visible through `pending()` until their batch
+    has been written, so readers can merge them with what is already stored.
+    """
+
+    def __init__(self, name: str, flush_fn, max_batch: int = 200, max_delay: float = 0.5, max_retries: int = 3):
+        self.name = name
+        self._flush_fn = flush_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._queue: deque = deque()       # (enqueued_at, item)
+        self._inflight: list = []          # items of the batch being written
+        self._thread: threading.Thread | None = None
+        self._stopping = False
+        self._flush_lock = threading.Lock()  # one writer at a time (worker or an explicit flush)
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_flush_ms: float | None = None
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.last_wait_ms: float | None = None
+
+    def submit(self, item) -> None:
+        """Queue an item for the next flush"""
+        with self._cond:
+            if self._thread is None and not self._stopping:
+                self._start()
+            self._queue.append((time.monotonic(), item))
+            self.enqueued += 1
+            if len(self._queue) >= self.max_batch:
+                self._cond.notify()
+            stopped = self._stopping
+        if stopped:
+            # the worker is gone (shutting down): write through
+            self.flush()
+
+    def pending(self, predicate=None) -> list:
+        """Items submitted but not yet written, oldest first"""
+        with self._cond:
+            items = list(self._inflight) + [item for _, item in self._queue]
+        return [item for item in items if predicate is None or predicate(item)]
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._queue) + len(self._inflight)
+
+    def flush(self) -> int:
+        """Write everything queued so far from the calling thread; returns the number written"""
+        written = 0
+        while True:
+            with self._cond:
+                if not self._queue:
+                    return written
+            written += self._write_batch()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop the worker after writing whatever is still queued"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        self.flush()
+
+    def _start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.name}", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    if len(self._queue) >= self.max_batch:
+                        break
+                    if self._queue:
+                        wait = self._queue[0][0] + self.max_delay - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if self._stopping and not self._queue:
+                    return
+            self._write_batch()
+            if self._stopping:
+                with self._cond:
+                    if not self._queue:
+                        return
+
+    def _write_batch(self) -> int:
+        with self._flush_lock:
+            with self._cond:
+                if not self._queue:
+                    return 0
+                count = min(len(self._queue), self.max_batch)
+                entries = [self._queue.popleft() for _ in range(count)]
+                self._inflight = [item for _, item in entries]
+            batch = self._inflight
+            self.last_wait_ms = round((time.monotonic() - entries[0][0]) * 1000, 2)
+            for attempt in range(1, self.max_retries + 1):
+                started = time.perf_counter()
+                try:
+                    self._flush_fn(batch)
+                except Exception as e:
+                    self.failures += 1
+                    logger.warning("Write-behind %s: flush of %d items failed (attempt %d/%d): %s",
+                                   self.name, len(batch), attempt, self.max_retries, e)
+                    time.sleep(min(self.max_delay * attempt, 2.0))
+                    continue
+                elapsed = (time.perf_counter() - started) * 1000
+                self.batches += 1
+                self.written += len(batch)
+                self.last_flush_ms = round(elapsed, 2)
+                self.max_flush_ms = max(self.max_flush_ms, elapsed)
+                self.total_flush_ms += elapsed
+                break
+            else:
+                self.dropped += len(batch)
+                logger.error("Write-behind %s: dropped %d items after %d failed attempts",
+                             self.name, len(batch), self.max_retries)
+            with self._cond:
+                self._inflight = []
+            return len(batch)
+
+    def stats(self) -> dict:
+        with self._cond:
+            depth = len(self._queue) + len(self._inflight)
+            oldest = self._queue[0][0] if self._queue else None
+        return {
+            "name": self.name,
+            "depth": depth,
+            "oldest_ms": round((time.monotonic() - oldest) * 1000, 2) if oldest is not None else None,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "failures": self.failures,
+            "last_flush_ms": self.last_flush_ms,
+            "avg_flush_ms": round(self.total_flush_ms / self.batches, 2) if self.batches else None,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "last_wait_ms": self.last_wait_ms,
+        }